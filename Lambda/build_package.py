@@ -0,0 +1,47 @@
+"""Builds the deployment package for the sendMessage Lambda function.
+
+sendMessage.py shares its answer cache, Bedrock scheduler, metrics and response formatting code with
+the Flask backend. Those modules live in backend/ and are copied next to the handler at the root of
+the zip, where the Lambda runtime imports them like any other top-level module. Deploy the zip with
+the handler "sendMessage.lambda_handler"; boto3 comes with the Python runtime.
+
+Example:
+    python Lambda/build_package.py --output dist/sendMessage.zip
+"""
+import argparse
+import os
+import sys
+import zipfile
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HANDLER = os.path.join(REPO_ROOT, "Lambda", "sendMessage.py")
+# backend/ modules imported by sendMessage.py (keep in sync with its imports)
+SHARED_MODULES = ("answer_cache", "bedrock_scheduler", "metrics", "response_format")
+
+
+def package_files():
+    """Returns [(source path, path inside the zip), ...]."""
+    files = [(HANDLER, "sendMessage.py")]
+    files += [(os.path.join(REPO_ROOT, "backend", f"{module}.py"), f"{module}.py") for module in SHARED_MODULES]
+    return files
+
+
+def build(output):
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as package:
+        for source, name in package_files():
+            package.write(source, name)
+    return output
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default=os.path.join(REPO_ROOT, "dist", "sendMessage.zip"),
+                        help="Where to write the zip")
+    args = parser.parse_args(argv)
+    print(f"Wrote {build(args.output)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,9 +1,22 @@
+import time # Import time module
+_module_started = time.perf_counter() # Start of cold-start accounting, see STARTUP_TIMINGS
+
 import boto3
 import json
 import os
-import sys
-import time # Import time module
+import random
+import threading
 import traceback
+from botocore.config import Config
+
+# Shared with the Flask backend: these modules live in ../backend and Lambda/build_package.py bundles
+# them next to this file in the deployment package
+from answer_cache import AnswerCache, LRUCache, DynamoDBAnswerStore, make_cache_key
+from bedrock_scheduler import AdaptiveTokenBucket, BedrockScheduler, LoadShedError
+from metrics import StageTimer
+from response_format import compact_citations, truncate_snippet
+
+_imports_done = time.perf_counter()
 
 # --- Configuration from Environment Variables ---
 
@@ -41,52 +54,139 @@ except KeyError:
     CHAT_HISTORY_TABLE = None
     # Optionally, raise ValueError(error_message) if history is absolutely mandatory
 
+# Response Streaming (Optional)
+# When enabled, answers are forwarded to the client as they are generated (RetrieveAndGenerateStream)
+STREAM_RESPONSES = os.environ.get("STREAM_RESPONSES", "true").lower() == "true"
+# API Gateway caps a WebSocket frame at 128KB; keep each frame well below that to leave room for the JSON envelope
+MAX_FRAME_BYTES = int(os.environ.get("MAX_FRAME_BYTES", 32 * 1024))
+# Partial text is buffered until this many characters are available, so we don't post once per token
+STREAM_FLUSH_CHARS = int(os.environ.get("STREAM_FLUSH_CHARS", 200))
+
+# Citation Format (Optional)
+# "compact" sends each unique reference once and cites it by index; "full" repeats it under every citation
+CITATION_FORMAT = os.environ.get("CITATION_FORMAT", "compact").lower()
+# Reference texts are cut to this many characters before they are sent (0 = whole)
+CITATION_SNIPPET_CHARS = int(os.environ.get("CITATION_SNIPPET_CHARS", 300))
+
+# Answer Cache (Optional)
+# The in-process LRU survives across warm invocations; the DynamoDB table is shared by all instances.
+# Both tiers expire answers after ANSWER_CACHE_TTL_SECONDS
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", 256))
+ANSWER_CACHE_TTL_SECONDS = int(os.environ.get("ANSWER_CACHE_TTL_SECONDS", 60 * 60 * 24))
+ANSWER_CACHE_TABLE = os.environ.get("ANSWER_CACHE_TABLE")
+
+# Multi-turn Sessions
+# Bedrock Knowledge Base session ids are remembered per WebSocket connection across warm invocations
+KB_SESSION_CACHE_SIZE = int(os.environ.get("KB_SESSION_CACHE_SIZE", 1024))
+
+# Throttling Retries
+# Throttled Bedrock calls are retried with jittered backoff until this much of the Lambda's remaining time is left
+RETRY_SAFETY_MARGIN_SECONDS = float(os.environ.get("RETRY_SAFETY_MARGIN_SECONDS", 5))
+BEDROCK_LATENCY_BUDGET_SECONDS = float(os.environ.get("BEDROCK_LATENCY_BUDGET_SECONDS", 20))
+# Floor for the budget, so a short Lambda timeout (default 3s) does not shed every Bedrock call
+MIN_LATENCY_BUDGET_SECONDS = float(os.environ.get("MIN_LATENCY_BUDGET_SECONDS", 1))
+
+# Logging & Metrics (Optional)
+# Fraction of invocations that log the full incoming event (0 = never; set to 1 while debugging)
+LOG_EVENT_SAMPLE_RATE = float(os.environ.get("LOG_EVENT_SAMPLE_RATE", 0))
+# Fraction of invocations that emit a per-stage timing line; failed invocations always emit one
+METRICS_SAMPLE_RATE = float(os.environ.get("METRICS_SAMPLE_RATE", 0.1))
+
+# Warm Start (Optional)
+# Work done during init is paid once per container, before the first request, instead of inside it
+PREWARM_CONNECTIONS = os.environ.get("PREWARM_CONNECTIONS", "true").lower() == "true"
+PREWARM_TIMEOUT_SECONDS = float(os.environ.get("PREWARM_TIMEOUT_SECONDS", 2))
+# WebSocket endpoint ("<api-id>.execute-api.<region>.amazonaws.com/<stage>") whose client is created during init
+WEBSOCKET_API_ENDPOINT = os.environ.get("WEBSOCKET_API_ENDPOINT")
+
 # --- Resource Initialization ---
 
 # Bedrock Client
 try:
-    bedrock_client = boto3.client('bedrock-agent-runtime')
+    # Retries are owned by bedrock_scheduler below, so botocore must not retry throttles on its own
+    bedrock_client = boto3.client('bedrock-agent-runtime', config=Config(retries={'total_max_attempts': 1, 'mode': 'standard'}))
 except Exception as e:
     print(f"ERROR: Failed to initialize Boto3 Bedrock Agent Runtime client: {e}")
     bedrock_client = None
 
-# DynamoDB Client and Table Resource (only if table name is set)
+# DynamoDB Resource, created on first use and shared by the chat history and answer cache tables
 dynamodb = None
+
+def get_dynamodb():
+    global dynamodb
+    if dynamodb is None:
+        dynamodb = boto3.resource('dynamodb')
+    return dynamodb
+
+# DynamoDB Table Resource (only if table name is set), created on first use like the API Gateway clients,
+# so creating the DynamoDB resource stays out of the cold start
 chat_history_table = None
-if CHAT_HISTORY_TABLE:
+
+def get_chat_history_table():
+    """Returns the chat history Table, creating it on first use. None if not configured or creation failed."""
+    global chat_history_table
+    if chat_history_table is None and CHAT_HISTORY_TABLE:
+        try:
+            chat_history_table = get_dynamodb().Table(CHAT_HISTORY_TABLE)
+            print(f"DynamoDB resource initialized for table: {CHAT_HISTORY_TABLE}")
+        except Exception as e:
+            print(f"ERROR: Failed to initialize DynamoDB resource/table '{CHAT_HISTORY_TABLE}': {e}")
+    return chat_history_table
+
+# Answer Cache (shared tier only if a table name is set)
+shared_answer_store = None
+if ANSWER_CACHE_TABLE:
     try:
-        dynamodb = boto3.resource('dynamodb')
-        chat_history_table = dynamodb.Table(CHAT_HISTORY_TABLE)
-        print(f"DynamoDB resource initialized for table: {CHAT_HISTORY_TABLE}")
+        shared_answer_store = DynamoDBAnswerStore(get_dynamodb().Table(ANSWER_CACHE_TABLE),
+                                                  ttl_seconds=ANSWER_CACHE_TTL_SECONDS)
+        print(f"Shared answer cache using DynamoDB table: {ANSWER_CACHE_TABLE}")
     except Exception as e:
-        print(f"ERROR: Failed to initialize DynamoDB resource/table '{CHAT_HISTORY_TABLE}': {e}")
-        chat_history_table = None # Ensure it's None if init fails
+        print(f"ERROR: Failed to initialize answer cache table '{ANSWER_CACHE_TABLE}': {e}")
+answer_cache = AnswerCache(LRUCache(ANSWER_CACHE_SIZE, ttl_seconds=ANSWER_CACHE_TTL_SECONDS), shared_answer_store)
+
+# connection_id -> Bedrock sessionId. Clients also get the sessionId in the 'done' frame and can send it back,
+# which keeps the conversation going when the next message lands on a different container.
+kb_sessions = LRUCache(KB_SESSION_CACHE_SIZE)
+
+# Rate Limiter & Retry Scheduler (same implementation as the backend). A container serves one request at a time,
+# but the bucket persists across warm invocations, so it still slows down a container that keeps getting throttled.
+bedrock_scheduler = BedrockScheduler(
+    AdaptiveTokenBucket(rate=float(os.environ.get("BEDROCK_RATE_LIMIT", 5)), burst=int(os.environ.get("BEDROCK_RATE_BURST", 5))),
+    max_attempts=int(os.environ.get("BEDROCK_MAX_ATTEMPTS", 4)),
+    budget_seconds=BEDROCK_LATENCY_BUDGET_SECONDS
+)
+
+
+# --- Helper Functions for Storing Messages ---
+# Optional: Set a TTL (Time To Live) attribute - example: expire after 7 days
+# Adjust the duration (in seconds) as needed (e.g., 30 days: 60*60*24*30)
+MESSAGE_TTL_SECONDS = 60*60*24*7
+
+def build_message_item(chat_id, sender, message, timestamp_ms=None):
+    """Builds the DynamoDB item for one chat message."""
+    if timestamp_ms is None:
+        timestamp_ms = int(time.time() * 1000) # Use milliseconds since epoch for timestamp (Sort Key)
+    return {
+        'chatId': chat_id,           # Partition Key
+        'timestamp': timestamp_ms,     # Sort Key
+        'sender': sender,            # "user" or "bot"
+        'message': message,          # The message text
+        'ttl': int(time.time()) + MESSAGE_TTL_SECONDS # Optional: TTL attribute
+    }
 
 
-# --- Helper Function for Storing Messages ---
 def store_message(table_ref, chat_id, sender, message, request_id="N/A"):
-    """Stores a message in the specified DynamoDB table."""
+    """Stores a message in the specified DynamoDB table (None: the chat history table)."""
+    if table_ref is None:
+        table_ref = get_chat_history_table()
     if not table_ref:
         # This happens if CHAT_HISTORY_TABLE env var is missing or DynamoDB init failed
         print(f"WARN RequestId: {request_id}: Chat history table not configured or initialized. Skipping message storage.")
         return
 
-    timestamp_ms = int(time.time() * 1000) # Use milliseconds since epoch for timestamp (Sort Key)
-    # Optional: Set a TTL (Time To Live) attribute - example: expire after 7 days
-    # Adjust the duration (in seconds) as needed (e.g., 30 days: 60*60*24*30)
-    ttl_timestamp = int(time.time()) + (60*60*24*7)
-
     print(f"INFO RequestId: {request_id}: Attempting to store message for chatId '{chat_id}', sender '{sender}'")
     try:
-        table_ref.put_item(
-           Item={
-                'chatId': chat_id,           # Partition Key
-                'timestamp': timestamp_ms,     # Sort Key
-                'sender': sender,            # "user" or "bot"
-                'message': message,          # The message text
-                'ttl': ttl_timestamp         # Optional: TTL attribute
-            }
-        )
+        table_ref.put_item(Item=build_message_item(chat_id, sender, message))
         # Consider logging success without logging the full message unless debugging
         # print(f"DEBUG RequestId: {request_id}: Stored message with timestamp {timestamp_ms}")
     except Exception as e:
@@ -95,28 +195,396 @@ def store_message(table_ref, chat_id, sender, message, request_id="N/A"):
         # Usually, failure to store history shouldn't stop the main flow
 
 
-# --- Main Lambda Handler ---
-def lambda_handler(event, context):
-    request_id = context.aws_request_id if context else 'N/A'
-    print(f"START RequestId: {request_id}")
-    print(f"Received Event: {json.dumps(event)}")
+class HistoryWriter:
+    """Buffers chat messages during an invocation and writes them in one BatchWriteItem call.
 
-    if bedrock_client is None:
-         print(f"CRITICAL RequestId: {request_id}: Bedrock client was not initialized.")
-         return {'statusCode': 500, 'body': json.dumps('Server configuration error: Bedrock client not initialized.')}
+    Messages are added as the turn progresses and flushed after the response has been sent to the
+    client, so DynamoDB latency stays off the user's critical path. Unprocessed items are retried with
+    backoff; items still unprocessed after max_retries are dropped (and counted).
+    """
+    BATCH_SIZE = 25 # BatchWriteItem limit
 
-    # Extract Connection ID and Message
+    def __init__(self, table_ref=None, max_retries=3, base_delay=0.05, sleep=time.sleep):
+        self._table = table_ref
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.sleep = sleep
+        self.pending = []
+        self.counters = {"written": 0, "retried": 0, "dropped": 0, "batches": 0}
+        # Last timestamp given to each recent chat, including messages already flushed
+        self._last_timestamps = LRUCache(1024)
+        self._lock = threading.Lock() # Lambda runs one request at a time, but local harnesses may not
+
+    @property
+    def table(self):
+        """The table to write to: the one given, else the chat history table (created on first use)."""
+        return self._table if self._table is not None else get_chat_history_table()
+
+    @table.setter
+    def table(self, table_ref):
+        self._table = table_ref
+
+    def add(self, chat_id, sender, message):
+        """Queues a message; it is written on the next flush()."""
+        timestamp_ms = int(time.time() * 1000)
+        with self._lock:
+            # Items must have distinct keys (a repeated key overwrites the earlier message), and the sort
+            # order must match the conversation order
+            last_ms = self._last_timestamps.get(chat_id)
+            if last_ms is not None and last_ms >= timestamp_ms:
+                timestamp_ms = last_ms + 1
+            self._last_timestamps.put(chat_id, timestamp_ms)
+            self.pending.append(build_message_item(chat_id, sender, message, timestamp_ms))
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def flush(self, request_id="N/A"):
+        """Writes every queued message. Never raises: history failures must not fail the turn."""
+        with self._lock:
+            items, self.pending = self.pending, []
+        if not items:
+            return
+        table = self.table
+        if not table:
+            print(f"WARN RequestId: {request_id}: Chat history table not configured or initialized. Skipping message storage.")
+            return
+
+        requests = [{'PutRequest': {'Item': item}} for item in items]
+        for start in range(0, len(requests), self.BATCH_SIZE):
+            self._write_batch(table, requests[start:start + self.BATCH_SIZE], request_id)
+        print(f"INFO RequestId: {request_id}: History flush done for {len(items)} messages. Totals: {json.dumps(self.counters)}")
+
+    def _write_batch(self, table, batch, request_id):
+        attempt = 0
+        while batch:
+            self._count("batches")
+            try:
+                # The resource's client accepts plain Python values, like Table.put_item
+                response = table.meta.client.batch_write_item(RequestItems={table.name: batch})
+                unprocessed = response.get('UnprocessedItems', {}).get(table.name, [])
+            except Exception as e:
+                print(f"ERROR RequestId: {request_id}: BatchWriteItem to {table.name} failed: {e}")
+                unprocessed = batch
+            self._count("written", len(batch) - len(unprocessed))
+            if not unprocessed:
+                return
+            attempt += 1
+            if attempt > self.max_retries:
+                print(f"ERROR RequestId: {request_id}: Dropping {len(unprocessed)} chat history items after {self.max_retries} retries.")
+                self._count("dropped", len(unprocessed))
+                return
+            self._count("retried", len(unprocessed))
+            self.sleep(self.base_delay * (2 ** (attempt - 1)))
+            batch = unprocessed
+
+
+history_writer = HistoryWriter()
+
+
+# --- API Gateway Management Clients ---
+# One client per WebSocket endpoint (domain name + stage), kept across warm invocations. Creating a client
+# costs several milliseconds and a fresh client also opens a fresh TLS connection on its first post.
+API_GATEWAY_CLIENT_CACHE_SIZE = 16
+api_gateway_clients = LRUCache(API_GATEWAY_CLIENT_CACHE_SIZE)
+
+
+def new_api_gateway_client(endpoint_url):
+    return boto3.client('apigatewaymanagementapi', endpoint_url=endpoint_url)
+
+
+def get_api_gateway_client(domain_name, stage):
+    """Returns the cached API Gateway Management client for a WebSocket endpoint, creating it on first use."""
+    endpoint_url = f"https://{domain_name}/{stage}"
+    client = api_gateway_clients.get(endpoint_url)
+    if client is None:
+        client = new_api_gateway_client(endpoint_url)
+        api_gateway_clients.put(endpoint_url, client)
+    return client
+
+
+# --- Connection Pre-warming ---
+# Opens the TLS connections the first request will need while the container initializes. The calls are
+# cheap reads whose outcome is ignored: even a rejected request leaves a pooled, reusable connection.
+# Bedrock Agent Runtime has no free read-only operation, so its client is created but not exercised.
+def prewarm_connections(timeout_seconds=PREWARM_TIMEOUT_SECONDS):
+    calls = []
+    table = get_chat_history_table()
+    if table is not None:
+        calls.append(("dynamodb", lambda: table.meta.client.describe_table(TableName=CHAT_HISTORY_TABLE)))
+    if WEBSOCKET_API_ENDPOINT:
+        domain_name, _, stage = WEBSOCKET_API_ENDPOINT.partition("/")
+        client = get_api_gateway_client(domain_name, stage)
+        calls.append(("apigateway", lambda: client.get_connection(ConnectionId="prewarm")))
+    else:
+        # Still loads and caches the service model, which is most of the cost of the first client
+        new_api_gateway_client("https://prewarm.invalid/prewarm")
+
+    def run(name, call):
+        try:
+            call()
+        except Exception as e:
+            print(f"INFO Pre-warm call to {name} finished with {type(e).__name__}")
+
+    threads = [threading.Thread(target=run, args=call, daemon=True) for call in calls]
+    for thread in threads:
+        thread.start()
+    deadline = time.monotonic() + timeout_seconds
+    for thread in threads:
+        thread.join(max(deadline - time.monotonic(), 0))
+
+
+_prewarm_started = time.perf_counter()
+if PREWARM_CONNECTIONS:
+    prewarm_connections()
+_init_done = time.perf_counter()
+
+# Cold-start cost of this container, printed once and kept for the first invocation's metrics line
+STARTUP_TIMINGS = {
+    "imports_ms": round((_imports_done - _module_started) * 1000, 2),
+    "init_ms": round((_prewarm_started - _imports_done) * 1000, 2),
+    "prewarm_ms": round((_init_done - _prewarm_started) * 1000, 2),
+}
+print(json.dumps({"metric": "sendMessageInit", **STARTUP_TIMINGS}))
+cold_start = True
+
+
+# --- Helpers for Sending Frames to the WebSocket Client ---
+# Every message sent to the client is a JSON frame with a "type" and a per-request "seq" number:
+#   {"type": "delta", "seq": 0, "text": "..."}            partial answer text, in order
+#   {"type": "references", "seq": 4, "offset": 0, "references": [...]}   unique references (compact format)
+#   {"type": "citations", "seq": 5, "citations": [...]}    trailing citation frame(s)
+#   {"type": "error", "seq": 6, "error": "..."}            the request failed
+#   {"type": "done", "seq": 7, "frames": 8, "bytes": 2048} last frame of the response; bytes counts the frames before it
+# Clients concatenate "delta" frames in "seq" order to rebuild the answer. With CITATION_FORMAT=compact
+# (the default) citations are {"refs": [0, 2]}: indexes into the references, which "references" frames
+# deliver in order starting at "offset". With CITATION_FORMAT=full each citation carries its references.
+FRAME_ENVELOPE_BYTES = 128 # Headroom for the {"type": ..., "seq": ...} part of a frame
+
+def split_text_for_frames(text, max_bytes):
+    """Splits text into pieces whose JSON-encoded size stays within max_bytes."""
+    pieces = []
+    while text:
+        if len(json.dumps(text)) <= max_bytes:
+            pieces.append(text)
+            break
+        # Binary search the longest prefix that fits (escaping makes encoded size != len(text))
+        low, high = 1, len(text)
+        while low < high:
+            mid = (low + high + 1) // 2
+            if len(json.dumps(text[:mid])) <= max_bytes:
+                low = mid
+            else:
+                high = mid - 1
+        pieces.append(text[:low])
+        text = text[low:]
+    return pieces
+
+
+def format_citations(citations):
+    """Reduces Bedrock citations to the {references: [{text, location}]} shape the clients use."""
+    formatted = []
+    for citation in citations:
+        references = []
+        for ref in citation.get('retrievedReferences', []):
+            location_uri = None
+            location = ref.get('location')
+            if location and location.get('type') == 'S3':
+                location_uri = location.get('s3Location', {}).get('uri')
+            references.append({"text": ref.get('content', {}).get('text'), "location": location_uri})
+        if references:
+            formatted.append({"references": references})
+    return formatted
+
+
+class FrameSender:
+    """Posts ordered, sequence-numbered frames to a single WebSocket connection."""
+
+    def __init__(self, api_gateway_client, connection_id, request_id, max_frame_bytes=MAX_FRAME_BYTES, timer=None):
+        self.client = api_gateway_client
+        self.connection_id = connection_id
+        self.request_id = request_id
+        self.max_frame_bytes = max_frame_bytes
+        self.timer = timer # Optional StageTimer; time spent in post_to_connection is added to it
+        self.seq = 0
+        self.bytes_sent = 0
+        self.gone = False # Set once the client disconnects; later frames are dropped
+
+    def send(self, frame_type, **fields):
+        """Posts one frame. Returns False if it could not be delivered."""
+        if self.gone:
+            return False
+        frame = {"type": frame_type, "seq": self.seq, **fields}
+        self.seq += 1
+        data = json.dumps(frame, separators=(",", ":"))
+        started = time.perf_counter()
+        try:
+            self.client.post_to_connection(ConnectionId=self.connection_id, Data=data)
+            self.bytes_sent += len(data.encode("utf-8"))
+            if self.timer:
+                self.timer.add("post_to_connection", time.perf_counter() - started)
+                self.timer.mark("first_frame")
+            return True
+        except self.client.exceptions.GoneException:
+            print(f"WARN RequestId: {self.request_id}: Connection {self.connection_id} is gone. Cannot send message.")
+            self.gone = True
+        except self.client.exceptions.PayloadTooLargeException:
+            # Should not happen since frames are sized below the limit, but never let one frame kill the response
+            print(f"ERROR RequestId: {self.request_id}: Frame {frame['seq']} exceeded the WebSocket message limit. ConnectionId: {self.connection_id}")
+        except Exception as e:
+            print(f"ERROR RequestId: {self.request_id}: Failed to send frame {frame['seq']} to connection {self.connection_id}: {e}")
+            print(traceback.format_exc())
+        return False
+
+    def send_text(self, text):
+        """Sends text as one or more 'delta' frames that each fit the frame size limit."""
+        for piece in split_text_for_frames(text, self.max_frame_bytes - FRAME_ENVELOPE_BYTES):
+            self.send("delta", text=piece)
+
+    def send_citations(self, citations, citation_format=CITATION_FORMAT, snippet_chars=CITATION_SNIPPET_CHARS):
+        """Sends full-format citations in citation_format, with reference texts cut to snippet_chars."""
+        if citation_format == "full":
+            self.send_full_citations([{"references": [{**ref, "text": truncate_snippet(ref["text"], snippet_chars)}
+                                                      for ref in citation["references"]]} for citation in citations])
+            return
+        compact = compact_citations(citations, snippet_chars)
+        budget = self.max_frame_bytes - FRAME_ENVELOPE_BYTES
+        batch, offset = [], 0
+        for reference in compact["references"]:
+            if len(json.dumps(reference)) > budget:
+                reference = {**reference, "text": truncate_snippet(reference["text"], budget // 2)}
+            if batch and len(json.dumps(batch + [reference])) > budget:
+                self.send("references", offset=offset, references=batch)
+                offset += len(batch)
+                batch = []
+            batch.append(reference)
+        if batch:
+            self.send("references", offset=offset, references=batch)
+        self.send("citations", citations=compact["citations"])
+
+    def send_full_citations(self, citations):
+        """Sends citations in as few 'citations' frames as fit the frame size limit."""
+        budget = self.max_frame_bytes - FRAME_ENVELOPE_BYTES
+        batch = []
+        for citation in citations:
+            if len(json.dumps(citation)) > budget:
+                citation = self._truncate_citation(citation, budget)
+            if batch and len(json.dumps(batch + [citation])) > budget:
+                self.send("citations", citations=batch)
+                batch = []
+            batch.append(citation)
+        if batch:
+            self.send("citations", citations=batch)
+
+    @staticmethod
+    def _truncate_citation(citation, budget):
+        """Shortens the reference texts of a citation that is too large for a frame on its own."""
+        references = citation["references"]
+        per_reference = max(budget // (2 * len(references)), 1)
+        return {"references": [
+            {"text": (ref["text"] or "")[:per_reference], "location": ref["location"]} for ref in references
+        ]}
+
+    def finish(self, **fields):
+        """Sends the closing 'done' frame."""
+        self.send("done", frames=self.seq + 1, bytes=self.bytes_sent, **fields)
+
+
+# --- Bedrock Interaction ---
+def build_kb_request(user_query, session_id=None):
+    """Builds the RetrieveAndGenerate request shared by the blocking and streaming calls."""
+    kb_request = {
+        'input': {'text': user_query},
+        'retrieveAndGenerateConfiguration': {
+            'type': 'KNOWLEDGE_BASE',
+            'knowledgeBaseConfiguration': {
+                'knowledgeBaseId': KNOWLEDGE_BASE_ID,
+                'modelArn': MODEL_ARN
+            }
+        }
+    }
+    if session_id:
+        # Bedrock keeps the conversation state server-side, so we never resend (or re-read) the history
+        kb_request['sessionId'] = session_id
+    return kb_request
+
+
+def call_kb(operation, user_query, session_id, request_id, budget_seconds=None):
+    """Calls a RetrieveAndGenerate operation, starting a new session if Bedrock rejects the old one."""
     try:
-        connection_id = event['requestContext']['connectionId']
-        domain_name = event["requestContext"]["domainName"]
-        stage = event["requestContext"]["stage"]
-        user_message_body = event.get('body', '')
-    except KeyError as e:
-        print(f"ERROR RequestId: {request_id}: Missing required key in event.requestContext: {e}")
-        return {'statusCode': 400, 'body': json.dumps(f'Bad request: Missing {e} in request context.')}
+        return bedrock_scheduler.call(lambda: operation(**build_kb_request(user_query, session_id)),
+                                      budget_seconds=budget_seconds)
+    except Exception as e:
+        if not session_id or getattr(e, 'response', {}).get('Error', {}).get('Code') != 'ValidationException':
+            raise
+        print(f"WARN RequestId: {request_id}: Session {session_id} rejected ({e}); starting a new session.")
+        return bedrock_scheduler.call(lambda: operation(**build_kb_request(user_query)), budget_seconds=budget_seconds)
 
-    # Parse User Message (Treat as query)
+
+def stream_kb_response(user_query, sender, request_id, budget_seconds=None, session_id=None):
+    """Streams a Knowledge Base answer to the client as it is generated. Returns (full_text, citations, session_id)."""
+    # Only opening the stream is retried; once text has been sent a failure is reported, not replayed
+    response = call_kb(bedrock_client.retrieve_and_generate_stream, user_query, session_id, request_id, budget_seconds)
+    parts = []
+    pending = [] # Text received but not yet sent
+    pending_chars = 0
+    citations = []
+    for event in response['stream']:
+        if 'output' in event:
+            text = event['output'].get('text', '')
+            parts.append(text)
+            pending.append(text)
+            pending_chars += len(text)
+            if pending_chars >= STREAM_FLUSH_CHARS:
+                sender.send_text("".join(pending))
+                pending, pending_chars = [], 0
+        elif 'citation' in event:
+            citation = event['citation']
+            # Older SDKs nest the citation one level deeper
+            refs = citation.get('retrievedReferences') or citation.get('citation', {}).get('retrievedReferences', [])
+            citations.append({'retrievedReferences': refs})
+        if sender.gone:
+            print(f"INFO RequestId: {request_id}: Client disconnected, stopping generation early.")
+            break
+    if pending:
+        sender.send_text("".join(pending))
+    return "".join(parts), citations, response.get('sessionId')
+
+
+def describe_bedrock_error(error, request_id):
+    """Logs a Bedrock failure and returns the message shown to (and stored for) the user."""
+    if isinstance(error, LoadShedError):
+        print(f"WARN RequestId: {request_id}: Bedrock call shed, no capacity within the latency budget: {error}")
+        return "Server busy. Please try again later."
+    error_code = None
+    if hasattr(error, 'response'):
+        error_code = error.response.get('Error', {}).get('Code')
+    if error_code == 'ValidationException':
+        print(f"ERROR RequestId: {request_id}: Bedrock Validation Exception during RetrieveAndGenerate: {error}")
+        return f"Error processing request: Invalid input or configuration for Knowledge Base. Check Model ARN compatibility. Details: {error}"
+    if error_code == 'AccessDeniedException':
+        print(f"ERROR RequestId: {request_id}: Bedrock Access Denied during RetrieveAndGenerate: {error}")
+        return "Server error: Insufficient permissions to access Bedrock Knowledge Base resources."
+    if error_code == 'ResourceNotFoundException':
+        print(f"ERROR RequestId: {request_id}: Bedrock Resource Not Found during RetrieveAndGenerate: {error}")
+        return "Server error: Could not find the specified Knowledge Base or Model."
+    if error_code == 'ThrottlingException':
+        print(f"ERROR RequestId: {request_id}: Bedrock Throttling Exception during RetrieveAndGenerate: {error}")
+        return "Server busy. Please try again later."
+    if error_code == 'InternalServerException':
+        print(f"ERROR RequestId: {request_id}: Bedrock Internal Server Exception during RetrieveAndGenerate: {error}")
+        return "An internal server error occurred within Bedrock. Please try again later."
+    print(f"ERROR RequestId: {request_id}: Unexpected error during Bedrock RetrieveAndGenerate or processing: {error}")
+    print(traceback.format_exc())
+    return "Sorry, an unexpected server error occurred while querying the knowledge base."
+
+
+def parse_user_message(user_message_body, request_id):
+    """Extracts (query, bypass_cache, session_id) from a JSON or plain-text WebSocket message body."""
     user_query = ''
+    bypass_cache = False
+    client_session_id = None
     # (Using the same robust parsing logic)
     if user_message_body:
         parsed_json = None
@@ -126,6 +594,8 @@ def lambda_handler(event, context):
             if isinstance(parsed_json, dict):
                 is_json_object = True
                 user_query = parsed_json.get('message', parsed_json.get('query'))
+                bypass_cache = bool(parsed_json.get('bypassCache')) # WebSocket frames have no headers, so this is a body flag
+                client_session_id = parsed_json.get('sessionId')
         except json.JSONDecodeError:
             print(f"INFO RequestId: {request_id}: Body was not JSON, treating as plain text query.")
             pass
@@ -133,13 +603,82 @@ def lambda_handler(event, context):
             user_query = user_message_body
             if is_json_object: print(f"INFO RequestId: {request_id}: Parsed JSON object but found no 'message' or 'query' key, using raw body string as query.")
             elif parsed_json is not None: print(f"INFO RequestId: {request_id}: Parsed JSON was not an object (type: {type(parsed_json)}), using raw body string as query.")
+    return user_query, bypass_cache, client_session_id
+
+
+# --- Main Lambda Handler ---
+# Each invocation is timed per stage (parse, cache_lookup, bedrock, post_to_connection, history_flush) and a sampled
+# fraction emits one JSON line such as:
+#   {"metric": "sendMessage", "total_ms": 912.4, "stages_ms": {"parse": 0.05, "bedrock": 880.1, ...}, "cacheStatus": "MISS", ...}
+# While streaming, post_to_connection time is also part of the bedrock stage since the two are interleaved.
+# The first invocation of a container always emits, with "coldStart": true and the STARTUP_TIMINGS.
+def latency_budget(context):
+    """Returns the Bedrock latency budget for this invocation, leaving time to report the outcome.
+
+    The safety margin is capped at a quarter of the remaining time so a short Lambda timeout still
+    leaves a usable budget; the result never drops below MIN_LATENCY_BUDGET_SECONDS.
+    """
+    if not context:
+        return BEDROCK_LATENCY_BUDGET_SECONDS
+    remaining = context.get_remaining_time_in_millis() / 1000
+    margin = min(RETRY_SAFETY_MARGIN_SECONDS, remaining / 4)
+    return max(MIN_LATENCY_BUDGET_SECONDS, min(BEDROCK_LATENCY_BUDGET_SECONDS, remaining - margin))
+
+
+def lambda_handler(event, context):
+    global cold_start
+    request_id = context.aws_request_id if context else 'N/A'
+    timer = StageTimer("sendMessage")
+    timer.fields["requestId"] = request_id
+    timer.fields["coldStart"] = cold_start
+    if cold_start:
+        timer.fields["startup_ms"] = STARTUP_TIMINGS
+        cold_start = False
+    try:
+        return process_message(event, context, timer)
+    except Exception:
+        timer.fields["error"] = True
+        raise
+    finally:
+        # Chat history is buffered during the turn; always persist it before the invocation ends
+        with timer.stage("history_flush"):
+            history_writer.flush(request_id)
+        timer.emit(METRICS_SAMPLE_RATE, force=timer.fields.get("error", False) or timer.fields["coldStart"])
+
+
+def process_message(event, context, timer=None):
+    request_id = context.aws_request_id if context else 'N/A'
+    timer = timer or StageTimer("sendMessage")
+    print(f"START RequestId: {request_id}")
+    if random.random() < LOG_EVENT_SAMPLE_RATE:
+        # Serializing the whole event is costly for large messages, so it is sampled
+        print(f"Received Event: {json.dumps(event)}")
+
+    if bedrock_client is None:
+         print(f"CRITICAL RequestId: {request_id}: Bedrock client was not initialized.")
+         return {'statusCode': 500, 'body': json.dumps('Server configuration error: Bedrock client not initialized.')}
+
+    # Extract Connection ID and Message
+    try:
+        connection_id = event['requestContext']['connectionId']
+        domain_name = event["requestContext"]["domainName"]
+        stage = event["requestContext"]["stage"]
+        user_message_body = event.get('body', '')
+    except KeyError as e:
+        print(f"ERROR RequestId: {request_id}: Missing required key in event.requestContext: {e}")
+        timer.fields["error"] = True
+        return {'statusCode': 400, 'body': json.dumps(f'Bad request: Missing {e} in request context.')}
+    print(f"INFO RequestId: {request_id}: Message from connection {connection_id} ({len(user_message_body or '')} chars)")
+
+    # Parse User Message (Treat as query)
+    with timer.stage("parse"):
+        user_query, bypass_cache, client_session_id = parse_user_message(user_message_body, request_id)
 
     if not user_query:
          print(f"WARN RequestId: {request_id}: Extracted query is empty after parsing.")
          # (Handle empty query as before)
          try:
-            endpoint_url = f"https://{domain_name}/{stage}"
-            api_gateway_client_for_error = boto3.client('apigatewaymanagementapi', endpoint_url=endpoint_url)
+            api_gateway_client_for_error = get_api_gateway_client(domain_name, stage)
             api_gateway_client_for_error.post_to_connection(ConnectionId=connection_id, Data=json.dumps({"error": "Received empty or unusable query."}))
          except Exception as post_error:
              print(f"ERROR RequestId: {request_id}: Failed to send empty query error to client {connection_id}: {post_error}")
@@ -148,93 +687,91 @@ def lambda_handler(event, context):
     print(f"INFO RequestId: {request_id}: Received query for processing: '{user_query}'") # Log the final query string
 
     # --- Store User Message ---
-    # Use connection_id as the chatId for this simple example
-    store_message(chat_history_table, connection_id, "user", user_query, request_id)
+    # Use connection_id as the chatId for this simple example (written together with the reply after it is sent)
+    history_writer.add(connection_id, "user", user_query)
     # --- End Store User Message ---
 
     print(f"INFO RequestId: {request_id}: Querying Knowledge Base ID: {KNOWLEDGE_BASE_ID}")
     print(f"INFO RequestId: {request_id}: Using Model ARN for generation: {MODEL_ARN}")
 
-    # Initialize API Gateway Management Client
+    # API Gateway Management Client (reused across warm invocations)
     try:
-        endpoint_url = f"https://{domain_name}/{stage}"
-        api_gateway_client = boto3.client('apigatewaymanagementapi', endpoint_url=endpoint_url)
+        api_gateway_client = get_api_gateway_client(domain_name, stage)
     except Exception as e:
         print(f"ERROR RequestId: {request_id}: Failed to initialize API Gateway Management client: {e}")
         return {'statusCode': 500, 'body': json.dumps('Server configuration error: Cannot connect to API Gateway.')}
 
-    # Call Bedrock RetrieveAndGenerate and Send Response
+    # Call Bedrock RetrieveAndGenerate (or serve a cached answer) and Send Response
+    sender = FrameSender(api_gateway_client, connection_id, request_id, timer=timer)
     ai_response_text = ""
-    citations = []
-    try:
-        print(f"INFO RequestId: {request_id}: Querying Knowledge Base {KNOWLEDGE_BASE_ID} with model {MODEL_ARN}")
-        response = bedrock_client.retrieve_and_generate(
-            input={'text': user_query},
-            retrieveAndGenerateConfiguration={
-                'type': 'KNOWLEDGE_BASE',
-                'knowledgeBaseConfiguration': {
-                    'knowledgeBaseId': KNOWLEDGE_BASE_ID,
-                    'modelArn': MODEL_ARN
-                }
-            }
-        )
-        print(f"INFO RequestId: {request_id}: Bedrock RAG Response received.")
-        ai_response_text = response.get('output', {}).get('text', 'Sorry, I could not retrieve an answer from the knowledge base.')
-        citations = response.get('citations', [])
-        if citations: print(f"INFO RequestId: {request_id}: Retrieved {len(citations)} citations.")
+    formatted_citations = []
+    failed = False
+    session_id = client_session_id or kb_sessions.get(connection_id)
+    cache_key = make_cache_key(user_query, KNOWLEDGE_BASE_ID, MODEL_ARN)
+    if session_id:
+        # Follow-up turns depend on the session's earlier context, so a shared cached answer would be wrong
+        cached, cache_status = None, "SESSION"
+    elif bypass_cache:
+        answer_cache.record_bypass()
+        cached, cache_status = None, "BYPASS"
+    else:
+        with timer.stage("cache_lookup"):
+            cached, cache_status = answer_cache.get(cache_key)
+    print(f"INFO RequestId: {request_id}: Answer cache {cache_status}")
+    timer.fields["cacheStatus"] = cache_status
 
-        # --- Store Bot Response (Success Case) ---
-        store_message(chat_history_table, connection_id, "bot", ai_response_text, request_id)
-        # --- End Store Bot Response ---
+    # Leave enough time to report the outcome to the client before the Lambda times out
+    budget_seconds = latency_budget(context)
+
+    try:
+        if cached is not None:
+            ai_response_text = cached['reply']
+            formatted_citations = cached['citations']
+            sender.send_text(ai_response_text)
+        else:
+            print(f"INFO RequestId: {request_id}: Querying Knowledge Base {KNOWLEDGE_BASE_ID} with model {MODEL_ARN} (streaming={STREAM_RESPONSES})")
+            if STREAM_RESPONSES:
+                with timer.stage("bedrock"):
+                    ai_response_text, citations, session_id = stream_kb_response(user_query, sender, request_id,
+                                                                                 budget_seconds, session_id)
+                if not ai_response_text:
+                    ai_response_text = 'Sorry, I could not retrieve an answer from the knowledge base.'
+                    sender.send_text(ai_response_text)
+            else:
+                with timer.stage("bedrock"):
+                    response = call_kb(bedrock_client.retrieve_and_generate, user_query, session_id, request_id, budget_seconds)
+                session_id = response.get('sessionId')
+                ai_response_text = response.get('output', {}).get('text', 'Sorry, I could not retrieve an answer from the knowledge base.')
+                citations = response.get('citations', [])
+                sender.send_text(ai_response_text)
+            print(f"INFO RequestId: {request_id}: Bedrock RAG Response received.")
+            if citations: print(f"INFO RequestId: {request_id}: Retrieved {len(citations)} citations.")
+            formatted_citations = format_citations(citations)
+            if session_id:
+                kb_sessions.put(connection_id, session_id)
+            if not sender.gone and cache_status != "SESSION": # Truncated or context-dependent answers must not be cached
+                answer_cache.put(cache_key, {"reply": ai_response_text, "citations": formatted_citations})
 
     # Exception Handling for Bedrock Call
-    except bedrock_client.exceptions.ValidationException as e:
-         print(f"ERROR RequestId: {request_id}: Bedrock Validation Exception during RetrieveAndGenerate: {e}")
-         ai_response_text = f"Error processing request: Invalid input or configuration for Knowledge Base. Check Model ARN compatibility. Details: {e}"
-         store_message(chat_history_table, connection_id, "bot", ai_response_text, request_id) # Store error message
-    except bedrock_client.exceptions.AccessDeniedException as e:
-         print(f"ERROR RequestId: {request_id}: Bedrock Access Denied during RetrieveAndGenerate: {e}")
-         ai_response_text = "Server error: Insufficient permissions to access Bedrock Knowledge Base resources."
-         store_message(chat_history_table, connection_id, "bot", ai_response_text, request_id) # Store error message
-    except bedrock_client.exceptions.ResourceNotFoundException as e:
-         print(f"ERROR RequestId: {request_id}: Bedrock Resource Not Found during RetrieveAndGenerate: {e}")
-         ai_response_text = "Server error: Could not find the specified Knowledge Base or Model."
-         store_message(chat_history_table, connection_id, "bot", ai_response_text, request_id) # Store error message
-    except bedrock_client.exceptions.ThrottlingException as e:
-         print(f"ERROR RequestId: {request_id}: Bedrock Throttling Exception during RetrieveAndGenerate: {e}")
-         ai_response_text = "Server busy. Please try again later."
-         store_message(chat_history_table, connection_id, "bot", ai_response_text, request_id) # Store error message
-    except bedrock_client.exceptions.InternalServerException as e:
-         print(f"ERROR RequestId: {request_id}: Bedrock Internal Server Exception during RetrieveAndGenerate: {e}")
-         ai_response_text = "An internal server error occurred within Bedrock. Please try again later."
-         store_message(chat_history_table, connection_id, "bot", ai_response_text, request_id) # Store error message
     except Exception as e:
-        print(f"ERROR RequestId: {request_id}: Unexpected error during Bedrock RetrieveAndGenerate or processing: {e}")
-        print(traceback.format_exc())
-        ai_response_text = "Sorry, an unexpected server error occurred while querying the knowledge base."
-        store_message(chat_history_table, connection_id, "bot", ai_response_text, request_id) # Store error message
+        ai_response_text = describe_bedrock_error(e, request_id)
+        failed = True
+        timer.fields["error"] = True
 
-    # Send response back to the WebSocket client
-    try:
-        response_payload = {"response": ai_response_text}
-        # Optional: Add processed citations here if needed
-        print(f"INFO RequestId: {request_id}: Sending payload to connection {connection_id}")
-        api_gateway_client.post_to_connection(
-            ConnectionId=connection_id,
-            Data=json.dumps(response_payload)
-        )
-        print(f"INFO RequestId: {request_id}: Successfully sent response to connection {connection_id}")
-    except api_gateway_client.exceptions.GoneException:
-        print(f"WARN RequestId: {request_id}: Connection {connection_id} is gone. Cannot send message.")
-    except api_gateway_client.exceptions.PayloadTooLargeException:
-        print(f"ERROR RequestId: {request_id}: Response payload too large for WebSocket message limit (128KB). ConnectionId: {connection_id}")
-        try:
-             api_gateway_client.post_to_connection(ConnectionId=connection_id, Data=json.dumps({"error": "Response is too large to send."}))
-        except Exception: pass
-    except Exception as e:
-        print(f"ERROR RequestId: {request_id}: Failed to send message to connection {connection_id}: {e}")
-        print(traceback.format_exc())
+    # --- Store Bot Response (assembled final message, or the error shown to the user) ---
+    history_writer.add(connection_id, "bot", ai_response_text)
+    # --- End Store Bot Response ---
+
+    # Send the trailing frames back to the WebSocket client
+    if failed:
+        sender.send("error", error=ai_response_text)
+    elif formatted_citations:
+        sender.send_citations(formatted_citations)
+    sender.finish(sessionId=session_id)
+    print(f"INFO RequestId: {request_id}: Sent {sender.seq} frames to connection {connection_id}")
+    timer.fields["frames"] = sender.seq
+    timer.fields["bytes"] = sender.bytes_sent
 
     # Return Success
     print(f"END RequestId: {request_id}")
-    return {'statusCode': 200, 'body': json.dumps('Message processed using Knowledge Base.')}
\ No newline at end of file
+    return {'statusCode': 200, 'body': json.dumps('Message processed using Knowledge Base.')}
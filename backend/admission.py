@@ -0,0 +1,221 @@
+import asyncio
+import math
+import threading
+import time
+from collections import OrderedDict, deque
+
+# Priority-aware admission control for the API.
+# Expensive requests are sorted into endpoint classes (chat, kb, stream, ...). A request must hold a slot
+# of its class before it runs, and each class has its own concurrency limit and bounded wait queue, so a
+# burst in one class can't take every worker from the others. On top of that, a total limit keeps
+# server threads free for the requests that never come through here (health checks, metrics, stats).
+#   - Freed slots go to the waiting request of the highest-priority class first.
+#   - Within a class, waiting requests are served round-robin per client, and each client can only
+#     queue a few, so one busy client can't fill the queue for everyone else.
+#   - A request is shed at once (503 + Retry-After) when its class queue is full or its expected wait
+#     (queue position x the class's recent service time / class concurrency) exceeds the class deadline.
+#     Shedding early keeps tail latency bounded and avoids timeouts piling up behind slow Bedrock calls.
+# Used by backend/app.py (blocking acquire) and backend/asgi.py (acquire_async).
+
+
+class Overloaded(Exception):
+    """Raised when a request is not admitted. retry_after is the suggested wait in seconds."""
+
+    def __init__(self, message, retry_after=1, reason="queue_full"):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.reason = reason
+
+
+class AdmissionClass:
+    """Limits for one endpoint class. Lower priority numbers are served first."""
+
+    def __init__(self, name, priority=0, max_concurrent=16, max_queue=32, queue_deadline_seconds=5.0,
+                 expected_service_seconds=1.0):
+        self.name = name
+        self.priority = priority
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.queue_deadline_seconds = queue_deadline_seconds
+        self.expected_service_seconds = expected_service_seconds
+
+
+class _ClassState:
+    def __init__(self, config):
+        self.config = config
+        self.running = 0
+        self.queued = 0
+        self.clients = OrderedDict() # client -> deque of _Waiter, in round-robin order
+        self.service_seconds = config.expected_service_seconds # EWMA of observed service time
+        self.counters = {"admitted": 0, "queued": 0, "shed": 0, "timed_out": 0, "cancelled": 0}
+
+
+class _Waiter:
+    def __init__(self, client, wake):
+        self.client = client
+        self.wake = wake
+        self.admitted = False
+
+
+class Ticket:
+    """An admitted request's slot; pass it to AdmissionController.release when the request ends."""
+
+    def __init__(self, class_name, admitted_at, waited_seconds):
+        self.class_name = class_name
+        self.admitted_at = admitted_at
+        self.waited_seconds = waited_seconds
+
+
+class AdmissionController:
+    """Per-class bounded queues with priority dispatch and per-client fairness."""
+
+    def __init__(self, classes, max_concurrent=64, max_queued_per_client=4, smoothing=0.2, clock=time.monotonic):
+        self.max_concurrent = max_concurrent
+        self.max_queued_per_client = max_queued_per_client
+        self.smoothing = smoothing
+        self.clock = clock
+        self._classes = {config.name: _ClassState(config) for config in classes}
+        self._dispatch_order = sorted(self._classes.values(), key=lambda state: state.config.priority)
+        self.running = 0
+        self._lock = threading.Lock()
+
+    def __contains__(self, class_name):
+        return class_name in self._classes
+
+    def _expected_wait(self, state):
+        """Seconds until a request joining the back of state's queue would start (an estimate)."""
+        return (state.queued + 1) * state.service_seconds / max(state.config.max_concurrent, 1)
+
+    def _shed(self, state, reason, message):
+        state.counters["shed"] += 1
+        retry_after = max(1, math.ceil(min(self._expected_wait(state), 60)))
+        raise Overloaded(f"{state.config.name}: {message}", retry_after, reason)
+
+    def _enter(self, class_name, client, wake):
+        """Admits the request (returns None) or queues it (returns its _Waiter). Raises Overloaded. Caller holds the lock."""
+        state = self._classes[class_name]
+        if state.running < state.config.max_concurrent and not state.queued and self.running < self.max_concurrent:
+            state.running += 1
+            self.running += 1
+            state.counters["admitted"] += 1
+            return None
+        if state.queued >= state.config.max_queue:
+            self._shed(state, "queue_full", f"{state.queued} requests already queued")
+        if len(state.clients.get(client, ())) >= self.max_queued_per_client:
+            self._shed(state, "client_limit", f"client already has {self.max_queued_per_client} requests queued")
+        expected_wait = self._expected_wait(state)
+        if expected_wait > state.config.queue_deadline_seconds:
+            self._shed(state, "deadline", f"expected wait {expected_wait:.1f}s exceeds "
+                                          f"{state.config.queue_deadline_seconds}s")
+        waiter = _Waiter(client, wake)
+        state.clients.setdefault(client, deque()).append(waiter)
+        state.queued += 1
+        state.counters["queued"] += 1
+        return waiter
+
+    def _give_up(self, class_name, waiter, reason="timed_out"):
+        """Takes a waiter that stops waiting (reason: timed_out or cancelled) out of its queue.
+
+        Returns True if it was admitted just in time (it then holds a slot). Caller holds the lock.
+        """
+        if waiter.admitted:
+            return True
+        state = self._classes[class_name]
+        waiters = state.clients[waiter.client]
+        waiters.remove(waiter)
+        if not waiters:
+            del state.clients[waiter.client]
+        state.queued -= 1
+        state.counters[reason] += 1
+        return False
+
+    def _free(self, state):
+        """Frees one of state's slots and admits the next waiting request. Caller holds the lock."""
+        state.running -= 1
+        self.running -= 1
+        self._dispatch()
+
+    def _dispatch(self):
+        """Hands free slots to waiting requests: highest priority class first, round-robin over its clients."""
+        while self.running < self.max_concurrent:
+            state = next((state for state in self._dispatch_order
+                          if state.queued and state.running < state.config.max_concurrent), None)
+            if state is None:
+                return
+            client, waiters = next(iter(state.clients.items()))
+            waiter = waiters.popleft()
+            if waiters:
+                state.clients.move_to_end(client) # The client's next request waits for everyone else's turn
+            else:
+                del state.clients[client]
+            state.queued -= 1
+            state.running += 1
+            self.running += 1
+            state.counters["admitted"] += 1
+            waiter.admitted = True
+            waiter.wake()
+
+    def acquire(self, class_name, client):
+        """Blocks until the request is admitted. Returns a Ticket; raises Overloaded if it is shed."""
+        started = self.clock()
+        event = threading.Event()
+        with self._lock:
+            waiter = self._enter(class_name, client, event.set)
+        if waiter is not None:
+            deadline = self._classes[class_name].config.queue_deadline_seconds
+            if not event.wait(deadline):
+                with self._lock:
+                    if not self._give_up(class_name, waiter):
+                        raise Overloaded(f"{class_name}: not admitted within {deadline}s", 1, "timed_out")
+        now = self.clock()
+        return Ticket(class_name, now, now - started)
+
+    async def acquire_async(self, class_name, client):
+        """acquire for the event loop: waits on a future instead of blocking a thread."""
+        started = self.clock()
+        loop = asyncio.get_running_loop()
+        admitted = loop.create_future()
+
+        def wake():
+            # Called from whichever thread released a slot
+            loop.call_soon_threadsafe(lambda: admitted.done() or admitted.set_result(True))
+
+        with self._lock:
+            waiter = self._enter(class_name, client, wake)
+        if waiter is not None:
+            deadline = self._classes[class_name].config.queue_deadline_seconds
+            try:
+                await asyncio.wait_for(admitted, deadline)
+            except asyncio.TimeoutError:
+                with self._lock:
+                    if not self._give_up(class_name, waiter):
+                        raise Overloaded(f"{class_name}: not admitted within {deadline}s", 1, "timed_out")
+            except asyncio.CancelledError:
+                # The client disconnected (or the server is shutting down) while the request waited: leave the
+                # queue, and hand back the slot if it was granted before the cancellation got here
+                with self._lock:
+                    if self._give_up(class_name, waiter, "cancelled"):
+                        self._free(self._classes[class_name])
+                raise
+        now = self.clock()
+        return Ticket(class_name, now, now - started)
+
+    def release(self, ticket):
+        """Frees the ticket's slot, learns from its service time and admits the next waiting request."""
+        service_seconds = self.clock() - ticket.admitted_at
+        with self._lock:
+            state = self._classes[ticket.class_name]
+            state.service_seconds += self.smoothing * (service_seconds - state.service_seconds)
+            self._free(state)
+
+    def stats(self):
+        """Flat counters and current load, per class (e.g. 'chat_queued') and in total."""
+        with self._lock:
+            stats = {"running": self.running, "max_concurrent": self.max_concurrent}
+            for name, state in self._classes.items():
+                stats[f"{name}_running"] = state.running
+                stats[f"{name}_queue_length"] = state.queued
+                stats[f"{name}_service_seconds"] = round(state.service_seconds, 3)
+                for counter, value in state.counters.items():
+                    stats[f"{name}_{counter}"] = value
+        return stats
@@ -0,0 +1,192 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from collections import OrderedDict
+
+# Two-tier cache for Knowledge Base answers.
+#   Tier 1: in-process LRU (bounded by entry count, optional TTL, no network hop)
+#   Tier 2: shared store with TTL (DynamoDB in AWS, InMemoryAnswerStore locally/in tests)
+# Used by backend/app.py and Lambda/sendMessage.py.
+
+
+def normalize_prompt(prompt):
+    """Normalizes a prompt so trivially different phrasings share a cache entry."""
+    text = re.sub(r"\s+", " ", prompt.strip().lower())
+    return text.rstrip("?!. ")
+
+
+def make_cache_key(prompt, knowledge_base_id, model_arn, *options):
+    """Builds a stable key from the normalized prompt, the KB/model it was answered with and any request options."""
+    raw = json.dumps([normalize_prompt(prompt), knowledge_base_id, model_arn, *options])
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class LRUCache:
+    """Thread-safe, size-bounded least-recently-used cache.
+
+    With ttl_seconds, entries also expire that long after they were put (checked on read).
+    """
+
+    def __init__(self, max_entries=512, ttl_seconds=None, clock=time.time):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._entries = OrderedDict() # key -> (expires_at or None, value)
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def _live(self, key):
+        """Returns key's entry, dropping it if it expired. Caller holds the lock."""
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] is not None and entry[0] <= self.clock():
+            del self._entries[key]
+            return None
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, value):
+        with self._lock:
+            expires_at = self.clock() + self.ttl_seconds if self.ttl_seconds is not None else None
+            self._entries[key] = (expires_at, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def __contains__(self, key):
+        # Unlike get, leaves the LRU order alone
+        with self._lock:
+            return self._live(key) is not None
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class InMemoryAnswerStore:
+    """Local stand-in for the shared tier, with the same TTL semantics as the DynamoDB store."""
+
+    def __init__(self, ttl_seconds=86400, clock=time.time):
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._items = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires_at, value = item
+            if expires_at <= self.clock():
+                del self._items[key]
+                return None
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = (self.clock() + self.ttl_seconds, value)
+
+
+class DynamoDBAnswerStore:
+    """Shared tier backed by a DynamoDB table (partition key 'cacheKey', TTL attribute 'ttl')."""
+
+    def __init__(self, table, ttl_seconds=86400, clock=time.time):
+        self.table = table
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+
+    def get(self, key):
+        item = self.table.get_item(Key={"cacheKey": key}).get("Item")
+        if not item:
+            return None
+        # DynamoDB deletes expired items lazily (up to days later), so check the TTL ourselves
+        if int(item.get("ttl", 0)) <= self.clock():
+            return None
+        return json.loads(item["payload"])
+
+    def put(self, key, value):
+        self.table.put_item(Item={
+            "cacheKey": key,
+            # Stored as a JSON string so nested numbers don't come back as Decimal
+            "payload": json.dumps(value),
+            "ttl": int(self.clock() + self.ttl_seconds)
+        })
+
+
+class AnswerCache:
+    """Looks up answers in the local LRU, then the shared store, and tracks hit/miss counters."""
+
+    def __init__(self, local, shared=None, logger=None):
+        self.local = local
+        self.shared = shared
+        self.logger = logger
+        self._lock = threading.Lock()
+        self.counters = {"hits_local": 0, "hits_shared": 0, "misses": 0, "bypasses": 0, "shared_errors": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def get(self, key):
+        """Returns (value, status) where status is 'HIT-LOCAL', 'HIT-SHARED' or 'MISS'."""
+        value = self.local.get(key)
+        if value is not None:
+            self._count("hits_local")
+            return value, "HIT-LOCAL"
+        if self.shared is not None:
+            try:
+                value = self.shared.get(key)
+            except Exception as e:
+                # The shared tier is an optimization; never fail the request because of it
+                self._count("shared_errors")
+                if self.logger: self.logger.warning(f"Answer cache shared-tier read failed: {e}")
+                value = None
+            if value is not None:
+                self.local.put(key, value)
+                self._count("hits_shared")
+                return value, "HIT-SHARED"
+        self._count("misses")
+        return None, "MISS"
+
+    def contains(self, key):
+        """True if either tier holds key. Unlike get, doesn't count a hit or miss or touch the LRU order."""
+        if key in self.local:
+            return True
+        if self.shared is None:
+            return False
+        try:
+            return self.shared.get(key) is not None
+        except Exception as e:
+            self._count("shared_errors")
+            if self.logger: self.logger.warning(f"Answer cache shared-tier read failed: {e}")
+            return False
+
+    def put(self, key, value):
+        self.local.put(key, value)
+        if self.shared is not None:
+            try:
+                self.shared.put(key, value)
+            except Exception as e:
+                self._count("shared_errors")
+                if self.logger: self.logger.warning(f"Answer cache shared-tier write failed: {e}")
+
+    def record_bypass(self):
+        self._count("bypasses")
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats["evictions"] = self.local.evictions
+        stats["local_entries"] = len(self.local)
+        lookups = stats["hits_local"] + stats["hits_shared"] + stats["misses"]
+        stats["hit_rate"] = round((stats["hits_local"] + stats["hits_shared"]) / lookups, 4) if lookups else 0.0
+        return stats
@@ -1,11 +1,29 @@
 import os
+import hmac
 import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import boto3
 import botocore # Import botocore for specific exception handling
-from flask import Flask, request, jsonify
+from botocore.config import Config
+from flask import Flask, request, jsonify, Response, stream_with_context, g
 from flask_cors import CORS
 from dotenv import load_dotenv
 import logging # Use Flask's logger
+from answer_cache import AnswerCache, LRUCache, DynamoDBAnswerStore, make_cache_key
+from single_flight import SingleFlight
+from conversation import ConversationStore, estimate_tokens
+from chat_history import ChatHistoryReader, pair_turns
+from metrics import MetricsRegistry
+from model_adapters import adapter_for, prompt_cache_min_tokens
+from model_router import ModelRouter
+from retrieval import RetrievalCache, dedupe_passages, fit_passages, retrieval_cache_key
+from job_store import JobQueueFull, JobStore
+from prewarm import Prewarmer, PrewarmRunning, in_hours, mine_queries, rank_queries
+from response_format import CITATION_FORMATS, COMPRESSIBLE_MIMETYPES, choose_encoding, encode_body, format_kb_response
+from admission import AdmissionClass, AdmissionController, Overloaded
+from bedrock_scheduler import AdaptiveTokenBucket, BedrockScheduler, LoadShedError, RETRYABLE_ERROR_CODES, error_code_of
 
 # Load environment variables from .env file (if it exists)
 load_dotenv()
@@ -17,19 +35,35 @@ app.logger.setLevel(logging.INFO) # Set default log level
 
 # Enable CORS - REMEMBER to restrict origins in production!
 # Example for production: origins=["https://your-angular-app-domain.com"]
-CORS(app, resources={r"/api/*": {"origins": "*"}})
+# Response headers browser clients may read (beyond the CORS-safelisted ones)
+CORS_EXPOSE_HEADERS = ["X-Cache", "X-Payload-Bytes", "X-Retrieval-Cache", "Retry-After"]
+CORS(app, resources={r"/api/*": {"origins": "*"}}, expose_headers=CORS_EXPOSE_HEADERS)
 
 # --- AWS Bedrock Configuration ---
 # Ensure you have AWS credentials configured (via aws configure, environment vars, or IAM role)
 # and have requested access to the models/features in the Bedrock console.
 aws_region = os.getenv("AWS_REGION", "us-east-1") # Default to us-east-1 if not set
 
+# Upper bound on concurrent HTTP connections per Bedrock client. botocore defaults to 10, which silently
+# caps concurrency: extra threads queue for a connection. Keep it >= the number of request threads/executor workers.
+BEDROCK_MAX_POOL_CONNECTIONS = int(os.getenv("BEDROCK_MAX_POOL_CONNECTIONS", "50"))
+# Generations can run for tens of seconds, so the read timeout must comfortably exceed the slowest completion
+BEDROCK_READ_TIMEOUT = int(os.getenv("BEDROCK_READ_TIMEOUT", "120"))
+bedrock_client_config = Config(
+    max_pool_connections=BEDROCK_MAX_POOL_CONNECTIONS,
+    read_timeout=BEDROCK_READ_TIMEOUT,
+    connect_timeout=5,
+    # Throttling retries are owned by bedrock_scheduler (adaptive pacing + latency budget), not botocore
+    retries={'total_max_attempts': 1, 'mode': 'standard'}
+)
+
 # --- Boto3 Clients ---
 try:
     # Client for direct model invocation (InvokeModel)
     bedrock_runtime = boto3.client(
         service_name='bedrock-runtime',
-        region_name=aws_region
+        region_name=aws_region,
+        config=bedrock_client_config
         # Boto3 will automatically look for credentials in the standard locations
     )
     app.logger.info(f"Bedrock Runtime client initialized for region {aws_region}")
@@ -37,7 +71,8 @@ try:
     # Client for Knowledge Base interaction (RetrieveAndGenerate)
     bedrock_agent_runtime = boto3.client(
         service_name='bedrock-agent-runtime',
-        region_name=aws_region
+        region_name=aws_region,
+        config=bedrock_client_config
     )
     app.logger.info(f"Bedrock Agent Runtime client initialized for region {aws_region}")
 
@@ -61,87 +96,589 @@ KNOWLEDGE_BASE_ID = os.getenv("BEDROCK_KNOWLEDGE_BASE_ID")
 # Ensure this model is compatible with RetrieveAndGenerate and available in your region
 KB_MODEL_ARN = os.getenv("BEDROCK_KB_MODEL_ARN", f'arn:aws:bedrock:{aws_region}::foundation-model/anthropic.claude-3-sonnet-20240229-v1:0') # Example default
 
-if not KNOWLEDGE_BASE_ID:
+# --- Retrieval Mode ---
+# How /api/ask-kb answers questions:
+#   kb     (default) managed RetrieveAndGenerate: retrieval and generation in one opaque call
+#   split  Bedrock Retrieve, then generation on the routed direct model path, with retrieval results cached
+#   local  like split, but searching an in-process vector index built offline with ingest_documents.py (requires NumPy)
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "kb").lower()
+LOCAL_INDEX_DIR = os.getenv("LOCAL_INDEX_DIR", "vector_index")
+# Defaults and caps for the per-request 'number_of_results' and 'passage_chars' options (split/local modes)
+RETRIEVAL_NUMBER_OF_RESULTS = int(os.getenv("RETRIEVAL_NUMBER_OF_RESULTS", "5"))
+RETRIEVAL_MAX_RESULTS = int(os.getenv("RETRIEVAL_MAX_RESULTS", "25"))
+RETRIEVAL_PASSAGE_CHARS = int(os.getenv("RETRIEVAL_PASSAGE_CHARS", "6000")) # Passage text allowed into one prompt
+RETRIEVAL_MAX_PASSAGE_CHARS = int(os.getenv("RETRIEVAL_MAX_PASSAGE_CHARS", "20000"))
+# Passages sharing at least this fraction of their word 3-grams with a better-ranked one are dropped
+RETRIEVAL_DEDUP_THRESHOLD = float(os.getenv("RETRIEVAL_DEDUP_THRESHOLD", "0.8"))
+
+local_index = None
+if RETRIEVAL_MODE == "local":
+    try:
+        from local_index import LocalVectorIndex # Imported here so NumPy is only needed in this mode
+        local_index = LocalVectorIndex.load(LOCAL_INDEX_DIR, bedrock_runtime=bedrock_runtime)
+        app.logger.info(f"Local retrieval mode: loaded {len(local_index.passages)} passages from {LOCAL_INDEX_DIR}")
+    except Exception as e:
+        app.logger.error(f"Failed to load local vector index from '{LOCAL_INDEX_DIR}': {e}")
+
+# Where the split path searches; None means the managed RetrieveAndGenerate path is used
+retrieval_source = None
+if local_index is not None:
+    retrieval_source = local_index.source_id
+elif RETRIEVAL_MODE == "split" and KNOWLEDGE_BASE_ID:
+    retrieval_source = f"kb:{KNOWLEDGE_BASE_ID}"
+
+# Vector-search results per normalized query, bounded by approximate memory use
+retrieval_cache = RetrievalCache(
+    max_bytes=int(os.getenv("RETRIEVAL_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+    ttl_seconds=int(os.getenv("RETRIEVAL_CACHE_TTL_SECONDS", "600"))
+)
+# Runs /api/retrieve prefetches, e.g. for a follow-up question while the previous answer is still streaming
+retrieval_executor = ThreadPoolExecutor(max_workers=int(os.getenv("RETRIEVAL_PREFETCH_WORKERS", "4")),
+                                        thread_name_prefix="retrieval")
+
+if not KNOWLEDGE_BASE_ID and local_index is None:
     app.logger.warning("BEDROCK_KNOWLEDGE_BASE_ID environment variable not set. Knowledge Base API will not work.")
 if not KB_MODEL_ARN and KNOWLEDGE_BASE_ID:
      app.logger.warning("BEDROCK_KB_MODEL_ARN environment variable not set, using default. Knowledge Base API might fail if default is incorrect.")
 
+# --- Answer Cache Configuration ---
+# Tier 1 is an in-process LRU; tier 2 is an optional shared DynamoDB table (partition key 'cacheKey', TTL attribute 'ttl').
+# Both tiers expire answers after ANSWER_CACHE_TTL_SECONDS
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "512"))
+ANSWER_CACHE_TTL_SECONDS = int(os.getenv("ANSWER_CACHE_TTL_SECONDS", str(60 * 60 * 24)))
+ANSWER_CACHE_TABLE = os.getenv("ANSWER_CACHE_TABLE")
+
+shared_answer_store = None
+if ANSWER_CACHE_TABLE:
+    try:
+        shared_answer_store = DynamoDBAnswerStore(
+            boto3.resource('dynamodb', region_name=aws_region).Table(ANSWER_CACHE_TABLE),
+            ttl_seconds=ANSWER_CACHE_TTL_SECONDS
+        )
+        app.logger.info(f"Shared answer cache using DynamoDB table {ANSWER_CACHE_TABLE}")
+    except Exception as e:
+        app.logger.error(f"Failed to initialize shared answer cache table '{ANSWER_CACHE_TABLE}': {e}")
+answer_cache = AnswerCache(LRUCache(ANSWER_CACHE_SIZE, ttl_seconds=ANSWER_CACHE_TTL_SECONDS), shared_answer_store,
+                           logger=app.logger)
+
+# --- Request Coalescing ---
+# Identical requests arriving while one is already in flight share its upstream Bedrock call
+request_coalescer = SingleFlight()
+
+# --- Rate Limiting & Retry Scheduling ---
+# All Bedrock calls go through one adaptive token bucket; throttled calls are retried with jittered
+# backoff while they fit in the per-request latency budget, otherwise they are shed with a 503
+bedrock_scheduler = BedrockScheduler(
+    AdaptiveTokenBucket(
+        rate=float(os.getenv("BEDROCK_RATE_LIMIT", "10")), # Initial requests/second; adapts to throttling
+        burst=int(os.getenv("BEDROCK_RATE_BURST", "20")),
+        max_rate=float(os.getenv("BEDROCK_MAX_RATE_LIMIT", "100"))
+    ),
+    max_queue=int(os.getenv("BEDROCK_MAX_QUEUE", "100")),
+    max_attempts=int(os.getenv("BEDROCK_MAX_ATTEMPTS", "4")),
+    budget_seconds=float(os.getenv("BEDROCK_LATENCY_BUDGET_SECONDS", "20"))
+)
+SERVER_BUSY_MESSAGE = "Server busy. Please try again later."
+
+# --- Conversation Context (direct model path) ---
+# Recent turns are sent verbatim, older ones as a rolling summary, keeping prompts under the token budget
+conversations = ConversationStore(
+    max_sessions=int(os.getenv("CONVERSATION_MAX_SESSIONS", "1000")),
+    token_budget=int(os.getenv("CONTEXT_TOKEN_BUDGET", "2000")),
+    recent_turns=int(os.getenv("CONTEXT_RECENT_TURNS", "6"))
+)
+
+# --- System Prompt & Prompt Caching (direct model path) ---
+# Every direct model call starts with the same system prompt (persona, formatting rules, destination
+# guidelines). Its part of the request body is serialized once per model at startup. With
+# PROMPT_CACHE_ENABLED=true, a prompt cache point follows it for models on the allowlist in model_adapters.py
+# whose minimum cacheable length the system prompt reaches, so Bedrock reads the processed prefix from its
+# cache instead of re-processing it on every call. Other models never get the marker (they reject it), and
+# the shipped system prompt (~1,000 tokens) is below most minimums, so caching is off by default.
+# Set SYSTEM_PROMPT_FILE to an empty string to send no system prompt.
+SYSTEM_PROMPT_FILE = os.getenv("SYSTEM_PROMPT_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "system_prompt.md"))
+PROMPT_CACHE_ENABLED = os.getenv("PROMPT_CACHE_ENABLED", "false").lower() == "true"
+MODEL_MAX_TOKENS = int(os.getenv("MODEL_MAX_TOKENS", "1024"))
+MODEL_TEMPERATURE = float(os.getenv("MODEL_TEMPERATURE", "0.7"))
+
+SYSTEM_PROMPT = ""
+if SYSTEM_PROMPT_FILE:
+    try:
+        with open(SYSTEM_PROMPT_FILE, encoding="utf-8") as f:
+            SYSTEM_PROMPT = f.read().strip()
+        app.logger.info(f"Loaded system prompt from {SYSTEM_PROMPT_FILE} ({len(SYSTEM_PROMPT)} chars, caching={PROMPT_CACHE_ENABLED})")
+    except OSError as e:
+        app.logger.error(f"Failed to read system prompt file '{SYSTEM_PROMPT_FILE}': {e}")
+
+# --- Chat History (read API) ---
+# Reads the history table the sendMessage Lambda writes (chatId + timestamp) for GET /api/history/<chat_id>.
+# The endpoint returns any chat's messages to whoever knows its id, so it is for internal callers only:
+# requests must send "Authorization: Bearer <HISTORY_API_TOKEN>", and it is disabled while no token is set.
+# With HISTORY_SEED_SESSIONS=true, a /api/chat session this process has not seen yet is seeded from the
+# stored chat with the same id. Only Lambda chat ids (WebSocket connection ids) are ever stored, so enable
+# it only for clients that continue a Lambda chat through /api/chat; otherwise every new session would
+# cost a DynamoDB Query that finds nothing.
+CHAT_HISTORY_TABLE = os.getenv("CHAT_HISTORY_TABLE")
+HISTORY_API_TOKEN = os.getenv("HISTORY_API_TOKEN")
+HISTORY_MAX_PAGE_SIZE = int(os.getenv("HISTORY_MAX_PAGE_SIZE", "100"))
+HISTORY_SEED_SESSIONS = os.getenv("HISTORY_SEED_SESSIONS", "false").lower() == "true"
+HISTORY_CONTEXT_MESSAGES = int(os.getenv("HISTORY_CONTEXT_MESSAGES", "12")) # Messages used to seed model context
+
+history_reader = None
+if CHAT_HISTORY_TABLE:
+    try:
+        history_reader = ChatHistoryReader(
+            boto3.resource('dynamodb', region_name=aws_region).Table(CHAT_HISTORY_TABLE),
+            recent_window=int(os.getenv("HISTORY_RECENT_WINDOW", "50")), # Latest messages cached per active chat
+            max_chats=int(os.getenv("HISTORY_CACHE_CHATS", "1000")),
+            ttl_seconds=int(os.getenv("HISTORY_CACHE_TTL_SECONDS", "30"))
+        )
+        app.logger.info(f"Chat history reads from DynamoDB table {CHAT_HISTORY_TABLE}")
+    except Exception as e:
+        app.logger.error(f"Failed to initialize chat history table '{CHAT_HISTORY_TABLE}': {e}")
+
+# --- Cache Prewarming ---
+# Answers the questions asked most often lately (mined from the user messages in the chat history table,
+# ranked by recency-weighted frequency) ahead of time, so the first asker gets an answer cache hit.
+# Runs are paced and capped to stay within a Bedrock call budget, and only start inside the off-peak
+# window (UTC hours, e.g. "1-6") unless forced. Without a shared answer cache table (ANSWER_CACHE_TABLE)
+# a run only warms the process that executes it; PREWARM_SCHEDULE=true runs it in every process.
+PREWARM_LOOKBACK_HOURS = float(os.getenv("PREWARM_LOOKBACK_HOURS", str(14 * 24)))
+PREWARM_HALF_LIFE_HOURS = float(os.getenv("PREWARM_HALF_LIFE_HOURS", "72"))
+PREWARM_MIN_COUNT = int(os.getenv("PREWARM_MIN_COUNT", "2")) # Asked at least this often to be a candidate
+PREWARM_MAX_CANDIDATES = int(os.getenv("PREWARM_MAX_CANDIDATES", "1000"))
+PREWARM_MAX_SCANNED = int(os.getenv("PREWARM_MAX_SCANNED", "50000")) # History items read per run
+PREWARM_TOP_K = int(os.getenv("PREWARM_TOP_K", "100"))
+PREWARM_OFF_PEAK_HOURS = os.getenv("PREWARM_OFF_PEAK_HOURS", "1-6")
+PREWARM_SCHEDULE = os.getenv("PREWARM_SCHEDULE", "false").lower() == "true"
+PREWARM_CHECK_INTERVAL_SECONDS = int(os.getenv("PREWARM_CHECK_INTERVAL_SECONDS", "900"))
+
+# --- Model Routing (direct model path) ---
+# Comma-separated model ids ordered from fastest to most capable, for example:
+#   MODEL_TIERS=anthropic.claude-3-haiku-20240307-v1:0,amazon.titan-text-lite-v1,anthropic.claude-3-sonnet-20240229-v1:0
+# Each prompt goes to the tier matching its complexity, failing over to the others when a model is
+# throttled, failing or too slow for the request's latency budget. Defaults to DIRECT_MODEL_ID alone (no routing).
+MODEL_TIERS = [model_id.strip() for model_id in os.getenv("MODEL_TIERS", DIRECT_MODEL_ID).split(",") if model_id.strip()]
+model_router = ModelRouter(MODEL_TIERS, max_error_rate=float(os.getenv("MODEL_MAX_ERROR_RATE", "0.5")))
+
+# model id -> PromptPrefix, prepared for every routed model up front (others are added on first use)
+prompt_prefixes = {}
+
+
+def wants_prompt_cache(model_id):
+    """True if model_id's requests get a prompt cache point after the system prompt."""
+    if not PROMPT_CACHE_ENABLED or not SYSTEM_PROMPT:
+        return False
+    min_tokens = prompt_cache_min_tokens(model_id)
+    if min_tokens is None:
+        return False
+    if estimate_tokens(SYSTEM_PROMPT) < min_tokens:
+        # Bedrock wouldn't cache a prefix this short anyway
+        app.logger.info(f"System prompt is below {model_id}'s {min_tokens}-token prompt cache minimum; not caching")
+        return False
+    return True
+
+
+def prompt_prefix_for(model_id):
+    """Returns the model's preserialized request prefix, or None if the model family is not supported."""
+    prefix = prompt_prefixes.get(model_id)
+    if prefix is None:
+        adapter = adapter_for(model_id)
+        if adapter is None:
+            return None
+        prefix = prompt_prefixes[model_id] = adapter.prepare_prefix(SYSTEM_PROMPT, MODEL_MAX_TOKENS, MODEL_TEMPERATURE,
+                                                                    cache=wants_prompt_cache(model_id))
+    return prefix
+
+for tier_model_id in MODEL_TIERS:
+    prompt_prefix_for(tier_model_id)
+
+# --- Batch Evaluation (/api/batch) ---
+# Prompts of all batches share one bounded worker pool; each batch may also ask for less concurrency.
+# A batch holds a single "batch" admission slot while it fans out up to BATCH_MAX_CONCURRENCY prompts
+# onto this pool, so admission does not count those calls: at most BATCH_WORKERS batch prompts run at
+# once across all batches (the defaults, 2 batch slots x 8 prompts, just fill the 16 workers). They
+# still go through the Bedrock scheduler's rate limit like every other call.
+BATCH_MAX_PROMPTS = int(os.getenv("BATCH_MAX_PROMPTS", "500"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "8"))
+batch_executor = ThreadPoolExecutor(max_workers=int(os.getenv("BATCH_WORKERS", "16")), thread_name_prefix="batch")
+
+# --- Admission Control ---
+# Requests to the expensive endpoints wait for a slot of their endpoint class (see admission.py) or are shed
+# with 503 + Retry-After once their class's queue is full or its expected wait passes the class deadline.
+# Health checks, metrics and stats endpoints never wait here. With a threaded server, queued requests hold
+# a thread too, so give the server more threads than ADMISSION_MAX_CONCURRENT plus the queues; the rest are
+# what keeps /api/health answering during a burst instead of the pod being restarted. The defaults below suit
+# the threaded server; the async server (asgi.py) can hold far more waiting requests, see its notes.
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+# Header identifying the client for per-client fairness (its last, proxy-added entry); the peer address if unset
+ADMISSION_CLIENT_HEADER = os.getenv("ADMISSION_CLIENT_HEADER", "X-Forwarded-For")
+ADMISSION_ENDPOINT_CLASSES = {
+    '/api/chat': "chat",
+    '/api/ask-kb': "kb",
+    '/api/chat/stream': "stream",
+    '/api/ask-kb/stream': "stream",
+    '/api/retrieve': "retrieve",
+    '/api/batch': "batch",
+}
+
+
+def admission_class(name, priority, max_concurrent, max_queue, queue_deadline_seconds, expected_service_seconds):
+    """Builds an AdmissionClass whose limits can be overridden with ADMISSION_<NAME>_* env vars."""
+    prefix = f"ADMISSION_{name.upper()}_"
+    return AdmissionClass(
+        name, priority,
+        max_concurrent=int(os.getenv(prefix + "CONCURRENCY", str(max_concurrent))),
+        max_queue=int(os.getenv(prefix + "QUEUE", str(max_queue))),
+        queue_deadline_seconds=float(os.getenv(prefix + "DEADLINE_SECONDS", str(queue_deadline_seconds))),
+        expected_service_seconds=expected_service_seconds
+    )
+
+admission = AdmissionController(
+    [
+        # Interactive answers first; long-lived streams and prefetches next; bulk batches last
+        admission_class("chat", 0, 32, 64, 5.0, 3.0),
+        admission_class("kb", 0, 32, 64, 5.0, 3.0),
+        admission_class("stream", 1, 32, 32, 3.0, 10.0),
+        admission_class("retrieve", 1, 16, 32, 2.0, 0.5),
+        # One slot per batch, not per prompt; BATCH_WORKERS bounds the prompts they run (see above)
+        admission_class("batch", 2, 2, 4, 2.0, 60.0),
+    ],
+    max_concurrent=int(os.getenv("ADMISSION_MAX_CONCURRENT", "64")),
+    max_queued_per_client=int(os.getenv("ADMISSION_MAX_QUEUED_PER_CLIENT", "4"))
+)
+
+# --- Async Jobs (/api/jobs) ---
+# /api/chat and /api/ask-kb requests sent with "async": true (or "Prefer: respond-async") get 202 and a job id
+# at once; a bounded worker pool runs the call and clients poll /api/jobs/<id> (optionally long-polling with
+# ?wait=<seconds>), so long generations are not cut off by proxy or API Gateway timeouts. A long-poll holds a
+# server thread (Flask) or connection (ASGI) while it waits, so at most JOB_MAX_LONG_POLLS wait at a time;
+# polls beyond that get the job's current state at once, with Retry-After. Finished results are kept for
+# JOB_RESULT_TTL_SECONDS, and at most JOB_MAX_RESULTS of them; past that the oldest are dropped early.
+JOB_MAX_PENDING = int(os.getenv("JOB_MAX_PENDING", "256"))
+JOB_RESULT_TTL_SECONDS = int(os.getenv("JOB_RESULT_TTL_SECONDS", "900"))
+JOB_MAX_WAIT_SECONDS = float(os.getenv("JOB_MAX_WAIT_SECONDS", "25")) # Keep below the gateway's idle timeout
+JOB_MAX_LONG_POLLS = int(os.getenv("JOB_MAX_LONG_POLLS", "32"))
+JOB_MAX_RESULTS = int(os.getenv("JOB_MAX_RESULTS", "4096"))
+job_store = JobStore(ThreadPoolExecutor(max_workers=int(os.getenv("JOB_WORKERS", "8")), thread_name_prefix="job"),
+                     max_pending=JOB_MAX_PENDING, ttl_seconds=JOB_RESULT_TTL_SECONDS, max_long_polls=JOB_MAX_LONG_POLLS,
+                     max_results=JOB_MAX_RESULTS)
+
+# --- Response Format ---
+# Knowledge Base answers list each unique reference once and cite it by index ("compact"), unless the
+# request asks for "citation_format": "full". Reference texts are cut to CITATION_SNIPPET_CHARS (0 = whole).
+CITATION_FORMAT = os.getenv("CITATION_FORMAT", "compact").lower()
+CITATION_SNIPPET_CHARS = int(os.getenv("CITATION_SNIPPET_CHARS", "300"))
+CITATION_MAX_SNIPPET_CHARS = int(os.getenv("CITATION_MAX_SNIPPET_CHARS", "5000"))
+# Buffered responses of at least COMPRESSION_MIN_BYTES are sent gzip/brotli-compressed to clients that accept it
+RESPONSE_COMPRESSION = os.getenv("RESPONSE_COMPRESSION", "true").lower() == "true"
+COMPRESSION_MIN_BYTES = int(os.getenv("COMPRESSION_MIN_BYTES", "1024"))
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "6"))
+
+# --- Metrics (exposed in Prometheus format at /api/metrics) ---
+metrics = MetricsRegistry()
+REQUEST_LATENCY = metrics.histogram("api_request_duration_seconds", "End-to-end API request latency.",
+                                    ("endpoint", "method", "status"))
+STAGE_LATENCY = metrics.histogram("api_stage_duration_seconds", "Time spent in each stage of an API request.",
+                                  ("endpoint", "stage"))
+BEDROCK_LATENCY = metrics.histogram("bedrock_call_duration_seconds", "Bedrock call latency, including retries.",
+                                    ("operation", "model"))
+BEDROCK_ERRORS = metrics.counter("bedrock_errors_total", "Failed Bedrock calls by error code.", ("operation", "code"))
+BEDROCK_TOKENS = metrics.counter("bedrock_tokens_total", "Tokens sent to / generated by Bedrock models (direction: input, output, cache_read, cache_write).",
+                                 ("model", "direction"))
+RESPONSE_SIZE = metrics.histogram("api_response_size_bytes", "Response body size as sent, after any compression.",
+                                  ("endpoint", "encoding"),
+                                  buckets=(256, 1024, 4096, 16384, 65536, 131072, 262144, 1048576))
+REQUESTS_SHED = metrics.counter("api_requests_shed_total", "Requests rejected by admission control.",
+                                ("endpoint_class", "reason"))
+COMPONENT_STATS = metrics.gauge("component_stat", "Counters and state of the cache, coalescer and scheduler.",
+                                ("component", "stat"))
+
+
+def collect_component_stats():
+    components = [("answer_cache", answer_cache.stats()), ("coalescer", request_coalescer.stats()),
+                  ("scheduler", bedrock_scheduler.stats()), ("retrieval_cache", retrieval_cache.stats()),
+                  ("jobs", job_store.stats()), ("admission", admission.stats())]
+    if history_reader:
+        components.append(("history", history_reader.stats()))
+    for component, stats in components:
+        for stat, value in stats.items():
+            COMPONENT_STATS.set(value, component=component, stat=stat)
+
+metrics.add_collector(collect_component_stats)
+
+
+def record_token_usage(model_id, usage):
+    """Adds a call's token counts (those the model reported) to the token counters.
+
+    Prompt cache reads and writes are counted separately from (and in addition to) uncached input tokens.
+    """
+    for key, direction in (("input_tokens", "input"), ("output_tokens", "output"),
+                           ("cache_read_tokens", "cache_read"), ("cache_write_tokens", "cache_write")):
+        if usage.get(key):
+            BEDROCK_TOKENS.inc(usage[key], model=model_id, direction=direction)
+
 
 # --- Bedrock Interaction Functions ---
 
-def invoke_bedrock_model(prompt):
-    """Sends a prompt directly to the configured Bedrock model (InvokeModel API)."""
-    if not bedrock_runtime:
-        app.logger.error("Bedrock Runtime client not initialized.")
-        return "Error: Bedrock Runtime client not available."
+def build_model_payload(model_id, prompt, conversation=None):
+    """Builds the JSON request body (bytes) for a direct model invocation, or None if the model is unsupported.
+
+    The body starts with the model's preserialized system prompt prefix; if a ConversationContext is
+    given, its summary and recent turns are sent ahead of the prompt, within the context token budget.
+    """
+    # The payload structure depends HEAVILY on the model provider; see model_adapters.py
+    prefix = prompt_prefix_for(model_id)
+    if prefix is None:
+        return None
+    summary, turns = conversation.snapshot(prompt) if conversation else ("", [])
+    return adapter_for(model_id).encode_body(prefix, prompt, summary, turns)
+
+
+# Error kinds reported by invoke_model_once. Only UPSTREAM_ERROR (throttling, 5xx, timeouts) says anything about the
+# model's health; shed requests, unsupported models and rejected requests are not counted against it by model_router.
+UPSTREAM_ERROR = "upstream"
+UPSTREAM_TIMEOUT_ERRORS = (botocore.exceptions.ReadTimeoutError, botocore.exceptions.ConnectTimeoutError)
+
 
-    app.logger.info(f"Invoking direct model {DIRECT_MODEL_ID} for prompt: '{prompt[:50]}...'")
+def model_error_kind(error):
+    """Classifies an exception raised by a Bedrock model call (see UPSTREAM_ERROR)."""
+    if isinstance(error, LoadShedError):
+        return "shed"
+    if isinstance(error, UPSTREAM_TIMEOUT_ERRORS):
+        return UPSTREAM_ERROR
+    if isinstance(error, botocore.exceptions.ClientError):
+        error_code = error.response.get("Error", {}).get("Code") or ""
+        status = error.response.get("ResponseMetadata", {}).get("HTTPStatusCode") or 0
+        if error_code in RETRYABLE_ERROR_CODES or error_code == "ModelTimeoutException" or status >= 500:
+            return UPSTREAM_ERROR
+        if "AccessDenied" in error_code:
+            return "access_denied"
+        return "client"
+    return "unexpected"
+
+
+def invoke_model_once(model_id, prompt, conversation=None, budget_seconds=None, max_attempts=None, usage=None):
+    """Sends a prompt to one Bedrock model (InvokeModel API). Returns (reply, error_kind); failures are reported as
+    reply text, and error_kind is None on success.
+
+    If a usage dict is given, it is filled with the call's token usage.
+    """
+    app.logger.info(f"Invoking direct model {model_id} for prompt: '{prompt[:50]}...'")
     try:
-        # The payload structure depends HEAVILY on the model provider
-        if "anthropic" in DIRECT_MODEL_ID:
-            payload = {
-                "anthropic_version": "bedrock-2023-05-31", # Required for Claude 3
-                "max_tokens": 1024,
-                "temperature": 0.7, # Example temperature
-                "messages": [{"role": "user", "content": [{"type": "text", "text": prompt}]}]
-            }
-            body = json.dumps(payload)
-            response = bedrock_runtime.invoke_model(
+        body = build_model_payload(model_id, prompt, conversation)
+        if body is None:
+            app.logger.warning(f"Unsupported model configured for direct invocation: {model_id}")
+            return f"Error: Unsupported model configured ({model_id}).", "unsupported"
+
+        with BEDROCK_LATENCY.time(operation="InvokeModel", model=model_id):
+            response = bedrock_scheduler.call(lambda: bedrock_runtime.invoke_model(
                 body=body,
-                modelId=DIRECT_MODEL_ID,
+                modelId=model_id,
                 contentType='application/json',
                 accept='application/json'
-            )
+            ), budget_seconds=budget_seconds, max_attempts=max_attempts)
             response_body = json.loads(response.get('body').read())
-            # Extract text - structure varies between Anthropic models too
-            ai_response = "".join([content.get('text', '') for content in response_body.get('content', [])])
-
-        elif "amazon.titan" in DIRECT_MODEL_ID:
-             payload = {
-                 "inputText": prompt,
-                 "textGenerationConfig": {
-                     "maxTokenCount": 1024,
-                     "temperature": 0.7,
-                     "stopSequences": [],
-                     "topP": 0.9
-                 }
-              }
-             body = json.dumps(payload)
-             response = bedrock_runtime.invoke_model(
-                 body=body,
-                 modelId=DIRECT_MODEL_ID,
-                 contentType='application/json',
-                 accept='application/json'
-             )
-             response_body = json.loads(response.get('body').read())
-             # Titan Text response structure
-             ai_response = response_body.get('results')[0].get('outputText')
-
-        # Add more elif blocks here for other models (Cohere, AI21, Mistral, etc.)
-        # consulting the AWS Bedrock documentation for their specific payload structures.
-
-        else:
-            app.logger.warning(f"Unsupported model configured for direct invocation: {DIRECT_MODEL_ID}")
-            return f"Error: Unsupported model configured ({DIRECT_MODEL_ID})."
 
+        ai_response, response_usage = adapter_for(model_id).parse_response(response_body)
+        response_usage = {k: v for k, v in response_usage.items() if v is not None}
+        record_token_usage(model_id, response_usage)
+        if usage is not None:
+            usage.update(response_usage, model=model_id)
         app.logger.info(f"Direct invocation successful. Response: '{ai_response[:50]}...'")
-        return ai_response
+        return ai_response, None
 
     except botocore.exceptions.ClientError as error:
         error_details = error.response.get("Error", {})
         error_code = error_details.get("Code")
         error_message = error_details.get("Message")
         app.logger.error(f"Boto3 ClientError invoking Bedrock (InvokeModel): {error_code} - {error_message}")
+        BEDROCK_ERRORS.inc(operation="InvokeModel", code=error_code)
+        error_kind = model_error_kind(error)
         if "AccessDeniedException" in str(error):
-             return f"Access Denied to model {DIRECT_MODEL_ID}. Please check permissions."
+             return f"Access Denied to model {model_id}. Please check permissions.", error_kind
+        elif error_code in RETRYABLE_ERROR_CODES:
+             return SERVER_BUSY_MESSAGE, error_kind # Still throttled after every retry the latency budget allowed
         else:
-             return f"Sorry, there was an AWS error: {error_code}"
+             return f"Sorry, there was an AWS error: {error_code}", error_kind
+    except LoadShedError as e:
+        app.logger.warning(f"Direct Bedrock invocation shed by scheduler: {e}")
+        BEDROCK_ERRORS.inc(operation="InvokeModel", code="LoadShed")
+        return SERVER_BUSY_MESSAGE, model_error_kind(e)
     except Exception as e:
         app.logger.error(f"Unexpected error during direct Bedrock invocation: {e}")
-        return f"Sorry, I encountered an unexpected error: {e}"
+        BEDROCK_ERRORS.inc(operation="InvokeModel", code="Unexpected")
+        return f"Sorry, I encountered an unexpected error: {e}", model_error_kind(e)
+
+
+def invoke_bedrock_model(prompt, conversation=None, budget_seconds=None, usage=None, candidates=None):
+    """Sends a prompt directly to a Bedrock model chosen by model_router (InvokeModel API).
+
+    Models are tried in the router's order until one answers. Every model but the last gets a single
+    attempt, so a throttled or failing model is skipped instead of retried. budget_seconds bounds the
+    whole sequence (default: the scheduler's latency budget). A usage dict, if given, receives the
+    answering model's id and token usage (including prompt cache reads and writes). candidates, if given,
+    is the model order already chosen by model_router.candidates.
+    """
+    if not bedrock_runtime:
+        app.logger.error("Bedrock Runtime client not initialized.")
+        return "Error: Bedrock Runtime client not available."
+
+    budget = budget_seconds if budget_seconds is not None else bedrock_scheduler.budget_seconds
+    deadline = time.perf_counter() + budget
+    if candidates is None:
+        candidates = model_router.candidates(prompt, conversation.tokens() if conversation else 0, budget_seconds)
+    ai_response = SERVER_BUSY_MESSAGE
+    for attempt, model_id in enumerate(candidates):
+        remaining = deadline - time.perf_counter()
+        if remaining <= 0:
+            app.logger.warning(f"Latency budget of {budget}s exhausted before trying {model_id}")
+            break
+        last = attempt == len(candidates) - 1
+        started = time.perf_counter()
+        ai_response, error_kind = invoke_model_once(model_id, prompt, conversation, remaining,
+                                                    max_attempts=None if last else 1, usage=usage)
+        if error_kind in (None, UPSTREAM_ERROR):
+            model_router.record(model_id, time.perf_counter() - started, error_kind is None)
+        if error_kind is None:
+            return ai_response
+        if not last:
+            app.logger.warning(f"Model {model_id} failed ({ai_response}); failing over to {candidates[attempt + 1]}")
+    return ai_response
+
+
+def open_model_stream(prompt, conversation=None, model_id=None):
+    """Opens an InvokeModelWithResponseStream call, failing over between routed models while opening.
+
+    Returns (model_id, response), or (None, None) if no candidate model is supported. Raises the last
+    model's error if every candidate failed.
+    """
+    context_tokens = conversation.tokens() if conversation else 0
+    candidates = [model_id] if model_id else model_router.candidates(prompt, context_tokens)
+    candidates = [candidate for candidate in candidates if adapter_for(candidate)]
+    for attempt, candidate in enumerate(candidates):
+        body = build_model_payload(candidate, prompt, conversation)
+        last = attempt == len(candidates) - 1
+        started = time.perf_counter()
+        try:
+            # Only opening the stream is scheduled; once tokens flow, a mid-stream failure cannot be retried
+            response = bedrock_scheduler.call(lambda: bedrock_runtime.invoke_model_with_response_stream(
+                body=body,
+                modelId=candidate,
+                contentType='application/json',
+                accept='application/json'
+            ), max_attempts=None if last else 1)
+            return candidate, response
+        except Exception as error:
+            if model_error_kind(error) == UPSTREAM_ERROR:
+                model_router.record(candidate, time.perf_counter() - started, False)
+            if last:
+                raise
+            app.logger.warning(f"Could not open stream on {candidate} ({error}); failing over to {candidates[attempt + 1]}")
+    return None, None
+
 
-def retrieve_and_generate_from_kb(prompt, knowledge_base_id, model_arn):
-    """Retrieves from the Knowledge Base and generates a response (RetrieveAndGenerate API)."""
+def parse_stream_chunk(model_id, chunk):
+    """Extracts (text_delta, usage_update) from one decoded InvokeModelWithResponseStream chunk."""
+    adapter = adapter_for(model_id)
+    text, usage = adapter.parse_stream_chunk(chunk) if adapter else ("", {})
+
+    # Bedrock appends its own invocation metrics to the final chunk for every provider
+    metrics = chunk.get('amazon-bedrock-invocationMetrics')
+    if metrics:
+        usage['input_tokens'] = metrics.get('inputTokenCount', usage.get('input_tokens'))
+        usage['output_tokens'] = metrics.get('outputTokenCount', usage.get('output_tokens'))
+        usage['cache_read_tokens'] = metrics.get('cacheReadInputTokenCount', usage.get('cache_read_tokens'))
+        usage['cache_write_tokens'] = metrics.get('cacheWriteInputTokenCount', usage.get('cache_write_tokens'))
+        usage['bedrock_latency_ms'] = metrics.get('invocationLatency')
+        usage['bedrock_first_byte_latency_ms'] = metrics.get('firstByteLatency')
+    return text, {k: v for k, v in usage.items() if v is not None}
+
+
+def format_sse(event, data):
+    """Formats one Server-Sent Event frame."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def stream_bedrock_model(prompt, model_id=None, conversation=None, turn_prompt=None):
+    """Streams a direct model response as SSE frames (InvokeModelWithResponseStream API).
+
+    Yields one 'delta' event per text fragment as it arrives, then a single 'done' event
+    carrying token usage and timing, or an 'error' event if the call fails. A completed
+    reply is appended to the conversation, if one is given, as an answer to turn_prompt
+    (default: prompt).
+    """
+    started = time.perf_counter()
+    if not bedrock_runtime:
+        app.logger.error("Bedrock Runtime client not initialized.")
+        yield format_sse("error", {"error": "Error: Bedrock Runtime client not available."})
+        return
+
+    first_token_at = None
+    usage = {}
+    parts = []
+    try:
+        requested_model = model_id
+        model_id, response = open_model_stream(prompt, conversation, model_id)
+        if response is None:
+            app.logger.warning(f"Unsupported model configured for streaming invocation: {requested_model or MODEL_TIERS}")
+            yield format_sse("error", {"error": f"Error: Unsupported model configured ({requested_model or ', '.join(MODEL_TIERS)})."})
+            return
+        app.logger.info(f"Streaming direct model {model_id} for prompt: '{prompt[:50]}...'")
+        for event in response.get('body'):
+            chunk = event.get('chunk')
+            if not chunk:
+                continue
+            text, usage_update = parse_stream_chunk(model_id, json.loads(chunk.get('bytes')))
+            usage.update(usage_update)
+            if text:
+                if first_token_at is None:
+                    first_token_at = time.perf_counter()
+                parts.append(text)
+                yield format_sse("delta", {"text": text})
+
+    except botocore.exceptions.ClientError as error:
+        error_code = error.response.get("Error", {}).get("Code")
+        app.logger.error(f"Boto3 ClientError streaming from Bedrock (InvokeModelWithResponseStream): {error}")
+        BEDROCK_ERRORS.inc(operation="InvokeModelWithResponseStream", code=error_code)
+        if error_code in RETRYABLE_ERROR_CODES:
+            yield format_sse("error", {"error": SERVER_BUSY_MESSAGE})
+        else:
+            yield format_sse("error", {"error": f"Sorry, there was an AWS error: {error_code}"})
+        return
+    except LoadShedError as e:
+        app.logger.warning(f"Streaming Bedrock invocation shed by scheduler: {e}")
+        BEDROCK_ERRORS.inc(operation="InvokeModelWithResponseStream", code="LoadShed")
+        yield format_sse("error", {"error": SERVER_BUSY_MESSAGE})
+        return
+    except Exception as e:
+        app.logger.error(f"Unexpected error during streaming Bedrock invocation: {e}")
+        BEDROCK_ERRORS.inc(operation="InvokeModelWithResponseStream", code="Unexpected")
+        yield format_sse("error", {"error": f"Sorry, I encountered an unexpected error: {e}"})
+        return
+
+    finished = time.perf_counter()
+    timing = {
+        "time_to_first_token_ms": round((first_token_at - started) * 1000, 1) if first_token_at else None,
+        "total_ms": round((finished - started) * 1000, 1)
+    }
+    app.logger.info(f"Streaming invocation finished. Timing: {timing}")
+    BEDROCK_LATENCY.observe(finished - started, operation="InvokeModelWithResponseStream", model=model_id)
+    model_router.record(model_id, finished - started, True)
+    if first_token_at:
+        STAGE_LATENCY.observe(first_token_at - started, endpoint="/api/chat/stream", stage="first_token")
+    record_token_usage(model_id, usage)
+    done = {"model": model_id, "usage": usage, "timing": timing}
+    if conversation:
+        conversation.add_turn(turn_prompt or prompt, "".join(parts))
+        done["session_id"] = conversation.session_id
+    yield format_sse("done", done)
+
+def retrieve_and_generate_from_kb(prompt, knowledge_base_id, model_arn, session_id=None):
+    """Retrieves from the Knowledge Base and generates a response (RetrieveAndGenerate API).
+
+    Passing the session_id from a previous response continues that multi-turn session.
+    """
     if not bedrock_agent_runtime:
         app.logger.error("Bedrock Agent Runtime client not initialized.")
         return {"error": "Bedrock Agent Runtime client not available."}
@@ -151,28 +688,39 @@ def retrieve_and_generate_from_kb(prompt, knowledge_base_id, model_arn):
          return {"error": "Knowledge Base ID or Model ARN not configured correctly."}
 
     app.logger.info(f"Querying Knowledge Base {knowledge_base_id} with model {model_arn} for prompt: '{prompt[:50]}...'")
-    try:
-        response = bedrock_agent_runtime.retrieve_and_generate(
-            input={
-                'text': prompt
-            },
-            retrieveAndGenerateConfiguration={
-                'type': 'KNOWLEDGE_BASE',
-                'knowledgeBaseConfiguration': {
-                    'knowledgeBaseId': knowledge_base_id,
-                    'modelArn': model_arn,
-                    # --- Optional: Add configurations ---
-                    # 'retrievalConfiguration': {
-                    #     'vectorSearchConfiguration': { 'numberOfResults': 4 }
-                    # },
-                    # 'generationConfiguration': {
-                    #      'inferenceConfig': { 'textInferenceConfig': { 'temperature': 0.0, 'maxTokens': 500 }}
-                    # }
-                }
+    request_args = {
+        'input': {
+            'text': prompt
+        },
+        'retrieveAndGenerateConfiguration': {
+            'type': 'KNOWLEDGE_BASE',
+            'knowledgeBaseConfiguration': {
+                'knowledgeBaseId': knowledge_base_id,
+                'modelArn': model_arn,
+                # --- Optional: Add configurations ---
+                # 'retrievalConfiguration': {
+                #     'vectorSearchConfiguration': { 'numberOfResults': 4 }
+                # },
+                # 'generationConfiguration': {
+                #      'inferenceConfig': { 'textInferenceConfig': { 'temperature': 0.0, 'maxTokens': 500 }}
+                # }
             }
-            # Optional: Manage session state
-            # 'sessionId': 'your-session-id'
-        )
+        }
+    }
+    if session_id:
+        # Bedrock keeps the conversation state server-side, so follow-ups don't resend history
+        request_args['sessionId'] = session_id
+    try:
+        with BEDROCK_LATENCY.time(operation="RetrieveAndGenerate", model=model_arn):
+            try:
+                response = bedrock_scheduler.call(lambda: bedrock_agent_runtime.retrieve_and_generate(**request_args))
+            except botocore.exceptions.ClientError as error:
+                # Sessions expire server-side; start a new one rather than failing the turn
+                if not session_id or error.response.get("Error", {}).get("Code") != "ValidationException":
+                    raise
+                app.logger.warning(f"Knowledge Base session {session_id} rejected ({error}); starting a new session.")
+                del request_args['sessionId']
+                response = bedrock_scheduler.call(lambda: bedrock_agent_runtime.retrieve_and_generate(**request_args))
 
         # --- Parse the Response ---
         generated_text = response['output']['text']
@@ -210,20 +758,633 @@ def retrieve_and_generate_from_kb(prompt, knowledge_base_id, model_arn):
         app.logger.info(f"Knowledge Base query successful. Response: '{generated_text[:50]}...'")
         return response_data # Return the structured dictionary
 
-    except botocore.exceptions.ClientError as error:
+    except Exception as error:
+        return describe_kb_error(error, "RetrieveAndGenerate", knowledge_base_id, model_arn)
+
+
+def describe_kb_error(error, operation, knowledge_base_id, model_arn=None):
+    """Logs and counts a failed Knowledge Base call and returns the {"error": ...} response for it."""
+    if isinstance(error, botocore.exceptions.ClientError):
         error_details = error.response.get("Error", {})
         error_code = error_details.get("Code")
         error_message = error_details.get("Message")
-        app.logger.error(f"Boto3 ClientError during RetrieveAndGenerate: {error_code} - {error_message}")
+        app.logger.error(f"Boto3 ClientError during {operation}: {error_code} - {error_message}")
+        BEDROCK_ERRORS.inc(operation=operation, code=error_code)
         if "AccessDeniedException" in str(error):
-             return {"error": f"Access Denied. Check permissions for RetrieveAndGenerate and access to KB '{knowledge_base_id}'."}
+             return {"error": f"Access Denied. Check permissions for {operation} and access to KB '{knowledge_base_id}'."}
         elif "ResourceNotFoundException" in str(error):
              return {"error": f"Resource not found. Check KB ID '{knowledge_base_id}' or Model ARN '{model_arn}'."}
+        elif error_code in RETRYABLE_ERROR_CODES:
+             return {"error": SERVER_BUSY_MESSAGE}
         else:
              return {"error": f"AWS Client Error: {error_code}"}
+    if isinstance(error, LoadShedError):
+        app.logger.warning(f"Knowledge Base query shed by scheduler: {error}")
+        BEDROCK_ERRORS.inc(operation=operation, code="LoadShed")
+        return {"error": SERVER_BUSY_MESSAGE}
+    app.logger.error(f"Unexpected error during Knowledge Base query: {error}")
+    BEDROCK_ERRORS.inc(operation=operation, code="Unexpected")
+    return {"error": f"An internal server error occurred: {str(error)}"}
+
+
+# --- Split Retrieve-then-Generate (RETRIEVAL_MODE=split or local) ---
+
+def retrieve_from_kb(prompt, number_of_results):
+    """Vector search on the Knowledge Base (Retrieve API). Returns [{"text", "location", "score"}], best first."""
+    with BEDROCK_LATENCY.time(operation="Retrieve", model=KNOWLEDGE_BASE_ID):
+        response = bedrock_scheduler.call(lambda: bedrock_agent_runtime.retrieve(
+            knowledgeBaseId=KNOWLEDGE_BASE_ID,
+            retrievalQuery={'text': prompt},
+            retrievalConfiguration={'vectorSearchConfiguration': {'numberOfResults': number_of_results}}
+        ))
+    passages = []
+    for result in response.get('retrievalResults', []):
+        location = result.get('location') or {}
+        passages.append({
+            "text": result.get('content', {}).get('text', ''),
+            "location": location.get('s3Location', {}).get('uri') if location.get('type') == 'S3' else None,
+            "score": result.get('score')
+        })
+    return passages
+
+
+def retrieve_passages(prompt, number_of_results):
+    """Runs a vector search through the retrieval cache. Returns (passages, status: HIT, MISS or COALESCED).
+
+    Concurrent searches for the same normalized query share one upstream call, so a prefetch that is
+    still running is joined rather than repeated.
+    """
+    key = retrieval_cache_key(prompt, retrieval_source, number_of_results)
+    passages = retrieval_cache.get(key)
+    if passages is not None:
+        return passages, "HIT"
+
+    def search():
+        if local_index is not None:
+            found = local_index.query([prompt], number_of_results)[0]
+        else:
+            found = retrieve_from_kb(prompt, number_of_results)
+        retrieval_cache.put(key, found)
+        return found
+
+    with STAGE_LATENCY.time(endpoint="/api/ask-kb", stage="retrieve"):
+        passages, shared = request_coalescer.do(("retrieve", key), search)
+    return passages, "COALESCED" if shared else "MISS"
+
+
+def resolve_retrieval_options(number_of_results=None, passage_chars=None):
+    """Applies the defaults and caps to per-request retrieval options. Returns (number_of_results, passage_chars)."""
+    number_of_results = min(max(number_of_results or RETRIEVAL_NUMBER_OF_RESULTS, 1), RETRIEVAL_MAX_RESULTS)
+    passage_chars = min(max(passage_chars or RETRIEVAL_PASSAGE_CHARS, 200), RETRIEVAL_MAX_PASSAGE_CHARS)
+    return number_of_results, passage_chars
+
+
+def select_passages(passages, passage_chars):
+    """Drops near-duplicate passages, then keeps the best ones that fit the prompt budget."""
+    return fit_passages(dedupe_passages(passages, RETRIEVAL_DEDUP_THRESHOLD), passage_chars)
+
+
+def build_grounded_prompt(prompt, passages):
+    """Puts retrieved passages ahead of the question, for generating a grounded answer on the direct model path."""
+    sources = "\n\n".join(f"[{number}] {passage['text']}" for number, passage in enumerate(passages, 1))
+    return ("Answer the traveler's question using only the numbered sources below. "
+            "If they do not contain the answer, say so.\n\n"
+            f"Sources:\n{sources}\n\nQuestion: {prompt}")
+
+
+def format_passage_citations(passages):
+    """Formats retrieved passages in the citation shape retrieve_and_generate_from_kb returns."""
+    if not passages:
+        return []
+    return [{"references": [{"text": passage["text"], "location": passage["location"]} for passage in passages]}]
+
+
+def retrieve_then_generate(prompt, session_id=None, number_of_results=None, passage_chars=None):
+    """Answers in two steps: a cached vector search, then generation on the routed direct model path.
+
+    Follow-ups in a session are generated with that session's conversation context, while retrieval
+    uses just the new question, so its results stay cacheable across sessions.
+    """
+    number_of_results, passage_chars = resolve_retrieval_options(number_of_results, passage_chars)
+    try:
+        passages, retrieval_status = retrieve_passages(prompt, number_of_results)
+    except Exception as error:
+        return describe_kb_error(error, "Retrieve", KNOWLEDGE_BASE_ID if local_index is None else retrieval_source)
+
+    selected = select_passages(passages, passage_chars)
+    app.logger.info(f"Retrieval {retrieval_status}: using {len(selected)} of {len(passages)} passages "
+                    f"for prompt: '{prompt[:50]}...'")
+    conversation = conversations.get_or_create(session_id)
+    ai_reply = invoke_bedrock_model(build_grounded_prompt(prompt, selected), conversation if session_id else None)
+    if is_error_reply(ai_reply):
+        return {"error": ai_reply}
+    conversation.add_turn(prompt, ai_reply) # The question alone, so the sources don't pile up in the history
+    return {"reply": ai_reply, "citations": format_passage_citations(selected), "session_id": conversation.session_id}
+
+
+def stream_kb_answer(prompt, session_id=None, number_of_results=None, passage_chars=None):
+    """Streams a split-mode answer as SSE: a 'citations' event once retrieval is done, then the model's events."""
+    number_of_results, passage_chars = resolve_retrieval_options(number_of_results, passage_chars)
+    try:
+        passages, retrieval_status = retrieve_passages(prompt, number_of_results)
+    except Exception as error:
+        yield format_sse("error", describe_kb_error(error, "Retrieve", KNOWLEDGE_BASE_ID if local_index is None else retrieval_source))
+        return
+    selected = select_passages(passages, passage_chars)
+    citations = format_kb_response({"citations": format_passage_citations(selected)}, CITATION_FORMAT, CITATION_SNIPPET_CHARS)
+    yield format_sse("citations", {**citations, "retrieval_cache": retrieval_status})
+    conversation = conversations.get_or_create(session_id)
+    yield from stream_bedrock_model(build_grounded_prompt(prompt, selected), conversation=conversation, turn_prompt=prompt)
+
+
+def knowledge_base_target():
+    """(knowledge_base_id, model_arn) that /api/ask-kb answers from; the retrieval source in split/local mode."""
+    if retrieval_source:
+        return retrieval_source, "model-router"
+    return KNOWLEDGE_BASE_ID, KB_MODEL_ARN
+
+
+def generate_kb_answer(prompt, key, knowledge_base_id, model_arn, session_id=None, retrieval_options=None):
+    """Generates a Knowledge Base answer and, unless it belongs to a session, stores it in the answer cache under key."""
+    if retrieval_source and knowledge_base_id == retrieval_source:
+        kb_response = retrieve_then_generate(prompt, session_id, *(retrieval_options or ()))
+    else:
+        kb_response = retrieve_and_generate_from_kb(prompt, knowledge_base_id, model_arn, session_id)
+    if 'error' not in kb_response and not session_id:
+        # The session belongs to the caller that generated the answer, so don't share it
+        answer_cache.put(key, {k: v for k, v in kb_response.items() if k != 'session_id'})
+    return kb_response
+
+
+def cached_retrieve_and_generate(prompt, knowledge_base_id, model_arn, bypass_cache=False, session_id=None,
+                                 retrieval_options=None):
+    """Serves a Knowledge Base answer from the answer cache when possible. Returns (response, cache_status).
+
+    Follow-up turns in an existing session depend on that session's context, so they skip the cache.
+    retrieval_options is (number_of_results, passage_chars) for the split path; answers differ by them.
+    """
+    key = make_cache_key(prompt, knowledge_base_id, model_arn, *(retrieval_options or ()))
+    if session_id:
+        cache_status = "SESSION"
+    elif bypass_cache:
+        answer_cache.record_bypass()
+        cache_status = "BYPASS"
+    else:
+        with STAGE_LATENCY.time(endpoint="/api/ask-kb", stage="cache_lookup"):
+            cached, cache_status = answer_cache.get(key)
+        if cached is not None:
+            app.logger.info(f"Answer cache {cache_status} for prompt: '{prompt[:50]}...'")
+            return dict(cached), cache_status
+
+    with STAGE_LATENCY.time(endpoint="/api/ask-kb", stage="bedrock"):
+        kb_response, shared = request_coalescer.do(("kb", key, session_id), lambda: generate_kb_answer(
+            prompt, key, knowledge_base_id, model_arn, session_id, retrieval_options))
+    kb_response = dict(kb_response)
+    if shared:
+        app.logger.info(f"Coalesced Knowledge Base request onto an in-flight call for prompt: '{prompt[:50]}...'")
+        if not session_id:
+            kb_response.pop('session_id', None) # Don't hand one caller's new session to another
+    return kb_response, cache_status
+
+
+def default_kb_answer_key(prompt):
+    """(cache key, knowledge_base_id, model_arn, retrieval_options) of a default /api/ask-kb request for prompt."""
+    knowledge_base_id, model_arn = knowledge_base_target()
+    retrieval_options = resolve_retrieval_options() if retrieval_source else None
+    return make_cache_key(prompt, knowledge_base_id, model_arn, *(retrieval_options or ())), knowledge_base_id, \
+        model_arn, retrieval_options
+
+
+def prewarm_answer(prompt):
+    """Generates and caches the answer a default /api/ask-kb request for prompt would get. Returns True on success."""
+    key, knowledge_base_id, model_arn, retrieval_options = default_kb_answer_key(prompt)
+    # Coalesced with user requests for the same question, so a user asking it mid-run doesn't pay twice
+    kb_response, _ = request_coalescer.do(("kb", key, None), lambda: generate_kb_answer(
+        prompt, key, knowledge_base_id, model_arn, retrieval_options=retrieval_options))
+    if 'error' in kb_response:
+        app.logger.warning(f"Prewarm failed for prompt '{prompt[:50]}...': {kb_response['error']}")
+        return False
+    return True
+
+
+prewarmer = Prewarmer(
+    is_cached=lambda prompt: answer_cache.contains(default_kb_answer_key(prompt)[0]),
+    warm=prewarm_answer,
+    rate_per_second=float(os.getenv("PREWARM_RATE_PER_SECOND", "0.5")),
+    max_calls=int(os.getenv("PREWARM_MAX_CALLS", "200")),
+    max_seconds=float(os.getenv("PREWARM_MAX_SECONDS", "1800")),
+    # Looks up every candidate (not just the top-k) for exact projected hit rates, at one cache read each
+    project_all=os.getenv("PREWARM_PROJECT_ALL", "false").lower() == "true"
+)
+
+
+def run_prewarm(top_k=PREWARM_TOP_K):
+    """Mines the chat history for popular questions and warms the answer cache with the top_k. Returns the report."""
+    now_ms = int(time.time() * 1000)
+    since_ms = now_ms - int(PREWARM_LOOKBACK_HOURS * 3600 * 1000)
+    with STAGE_LATENCY.time(endpoint="prewarm", stage="mine"):
+        entries, scanned = mine_queries(history_reader.table, since_ms, max_scanned=PREWARM_MAX_SCANNED)
+        ranked = rank_queries(entries, now_ms, PREWARM_HALF_LIFE_HOURS, PREWARM_MIN_COUNT)[:PREWARM_MAX_CANDIDATES]
+    with STAGE_LATENCY.time(endpoint="prewarm", stage="warm"):
+        report = prewarmer.run(ranked, top_k)
+    report["mined"] = {"items_scanned": scanned, "user_messages": len(entries), "since_ms": since_ms}
+    app.logger.info(f"Prewarm finished: {report['warmed']} warmed, {report['already_cached']} already cached, "
+                    f"{report['failed']} failed, {report['skipped']} skipped of {report['top_k']} "
+                    f"(projected hit rate {report['hit_rate']['weighted']['before']} -> "
+                    f"{report['hit_rate']['weighted']['after']}); stopped: {report['stopped']}")
+    return report
+
+
+def handle_prewarm(top_k=PREWARM_TOP_K):
+    """Runs a prewarm pass. Returns (payload, status_code, headers) like the handle_*_message functions."""
+    try:
+        return run_prewarm(top_k), 200, {}
+    except PrewarmRunning as e:
+        return {"error": str(e)}, 409, {}
     except Exception as e:
-        app.logger.error(f"Unexpected error during Knowledge Base query: {e}")
-        return {"error": f"An internal server error occurred: {str(e)}"}
+        app.logger.error(f"Prewarm run failed: {e}")
+        return {"error": f"Prewarm failed: {e}"}, 500, {}
+
+
+def prewarm_schedule_loop():
+    """Runs one prewarm pass per off-peak window (PREWARM_SCHEDULE=true)."""
+    last_run_day = None
+    while True:
+        now = time.gmtime()
+        if in_hours(PREWARM_OFF_PEAK_HOURS, now.tm_hour) and last_run_day != now.tm_yday:
+            last_run_day = now.tm_yday
+            handle_prewarm()
+        time.sleep(PREWARM_CHECK_INTERVAL_SECONDS)
+
+if PREWARM_SCHEDULE and history_reader:
+    threading.Thread(target=prewarm_schedule_loop, name="prewarm", daemon=True).start()
+
+
+def wants_cache_bypass(headers):
+    """True if the client asked to skip the answer cache (X-Cache-Bypass or Cache-Control: no-cache)."""
+    if headers.get('X-Cache-Bypass', '').lower() in ('1', 'true', 'yes'):
+        return True
+    return 'no-cache' in headers.get('Cache-Control', '').lower()
+
+
+# --- Request Handling (shared by the Flask app and the async app in asgi.py) ---
+# Each returns (payload, status_code, headers) so any serving layer can render it.
+
+def is_error_reply(ai_reply):
+    """invoke_bedrock_model reports failures as reply text; this tells them apart from real answers."""
+    return ai_reply == SERVER_BUSY_MESSAGE or (isinstance(ai_reply, str) and
+                                              (ai_reply.startswith("Error:") or ai_reply.startswith("Sorry,")))
+
+
+def seed_conversation(conversation):
+    """Rebuilds a session's context from its stored chat history (served from the recent-window cache)."""
+    try:
+        turns = pair_turns(history_reader.recent(conversation.session_id, HISTORY_CONTEXT_MESSAGES))
+    except Exception as e:
+        app.logger.warning(f"Could not load chat history for session {conversation.session_id}: {e}")
+        return
+    for user_turn, assistant_turn in turns:
+        conversation.add_turn(user_turn, assistant_turn)
+    if turns:
+        app.logger.info(f"Seeded session {conversation.session_id} with {len(turns)} turns from chat history")
+
+
+def handle_chat_message(user_message, session_id=None, latency_budget=None):
+    """Sends an already validated /api/chat message to a routed Bedrock model.
+
+    The reply continues the conversation identified by session_id (a new one is started if omitted).
+    latency_budget (seconds) steers routing toward models fast enough to answer within it.
+    """
+    app.logger.info(f"/api/chat received message: '{user_message[:50]}...'")
+    conversation = conversations.get_or_create(session_id)
+    if session_id and HISTORY_SEED_SESSIONS and history_reader and not conversation.turns and not conversation.summary:
+        seed_conversation(conversation)
+
+    # Send message directly to Bedrock model
+    # Concurrent requests with the exact same prompt, routed to the same models, share one InvokeModel call
+    # (only with no history, or within one session at the same summary and turns)
+    summary, turns = conversation.snapshot()
+    history_key = (conversation.session_id, summary, tuple(turns)) if summary or turns else None
+    candidates = model_router.candidates(user_message, conversation.tokens(), latency_budget)
+    usage = {} # Stays empty for a coalesced request: the call it joined was counted for its first caller
+    with STAGE_LATENCY.time(endpoint="/api/chat", stage="bedrock"):
+        ai_reply, shared = request_coalescer.do(("chat", history_key, latency_budget, tuple(candidates), user_message),
+                                                lambda: invoke_bedrock_model(user_message, conversation, latency_budget,
+                                                                             usage, candidates))
+    if shared:
+        app.logger.info("/api/chat request coalesced onto an in-flight call")
+
+    app.logger.info(f"/api/chat sending reply: '{str(ai_reply)[:50]}...'") # Log reply start
+
+    # Check if the reply indicates an error occurred internally
+    if ai_reply == SERVER_BUSY_MESSAGE:
+         return {"error": ai_reply}, 503, {"Retry-After": "1"} # Throttled or shed; the client should back off
+    if is_error_reply(ai_reply):
+         return {"error": ai_reply}, 500, {} # Return server error if function indicated failure
+
+    conversation.add_turn(user_message, ai_reply)
+    payload = {"reply": ai_reply, "session_id": conversation.session_id}
+    if usage:
+        payload["usage"] = usage
+    return payload, 200, {}
+
+
+def handle_kb_message(user_message, bypass_cache=False, session_id=None, retrieval_options=None,
+                      citation_options=None):
+    """Answers an already validated /api/ask-kb message from the configured Knowledge Base.
+
+    retrieval_options (number_of_results, passage_chars) only apply in split/local retrieval mode;
+    citation_options is (citation_format, snippet_chars), see parse_citation_options.
+    """
+    app.logger.info(f"/api/ask-kb received message: '{user_message[:50]}...'")
+
+    # Query the Knowledge Base (served from the answer cache on repeat questions)
+    knowledge_base_id, model_arn = knowledge_base_target()
+    retrieval_options = resolve_retrieval_options(*(retrieval_options or ())) if retrieval_source else None
+    kb_response, cache_status = cached_retrieve_and_generate(user_message, knowledge_base_id, model_arn,
+                                                             bypass_cache=bypass_cache, session_id=session_id,
+                                                             retrieval_options=retrieval_options)
+
+    app.logger.info(f"/api/ask-kb sending response: {str(kb_response)[:100]}...") # Log response start
+
+    # retrieve_and_generate_from_kb returns a dict. Check if it contains an 'error' key.
+    if isinstance(kb_response, dict) and 'error' in kb_response:
+        # Determine appropriate status code based on error if needed, default to 500
+        status_code = 500
+        if "Access Denied" in kb_response['error']:
+             status_code = 403
+        elif "Resource not found" in kb_response['error']:
+             status_code = 404
+        elif "not configured" in kb_response['error']:
+            status_code = 501
+        elif kb_response['error'] == SERVER_BUSY_MESSAGE:
+            return kb_response, 503, {"X-Cache": cache_status, "Retry-After": "1"}
+        return kb_response, status_code, {"X-Cache": cache_status}
+
+    # If no error key, assume success and return the whole structured response
+    return format_kb_response(kb_response, *(citation_options or (CITATION_FORMAT, CITATION_SNIPPET_CHARS))), 200, \
+        {"X-Cache": cache_status}
+
+
+def wants_async(data, headers):
+    """True if the client asked for job mode: "async": true in the body or a "Prefer: respond-async" header."""
+    return data.get('async') is True or "respond-async" in headers.get("Prefer", "").lower()
+
+
+def submit_job(kind, handler, *args, **kwargs):
+    """Queues handler(*args, **kwargs), a handle_*_message function, as a job. Returns the 202 (or 503) reply."""
+    def run():
+        payload, status_code, _ = handler(*args, **kwargs)
+        return payload, status_code
+    try:
+        job_id = job_store.submit(kind, run)
+    except JobQueueFull as e:
+        app.logger.warning(f"Rejected {kind} job: {e}")
+        return {"error": SERVER_BUSY_MESSAGE}, 503, {"Retry-After": "5"}
+    app.logger.info(f"Queued {kind} job {job_id}")
+    location = f"/api/jobs/{job_id}"
+    return {"job_id": job_id, "status": "queued", "poll": location}, 202, {"Location": location}
+
+
+def parse_job_wait(value):
+    """Reads the ?wait= long-poll duration in seconds, capped at JOB_MAX_WAIT_SECONDS."""
+    try:
+        return min(max(float(value), 0.0), JOB_MAX_WAIT_SECONDS)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def describe_job(job):
+    """Returns the (payload, status_code, headers) reply for a job lookup; job is None if unknown or expired."""
+    if job is None:
+        return {"error": "Job not found. It may have expired."}, 404, {}
+    if job["status"] in ("queued", "running"):
+        return job, 200, {"Retry-After": "1"}
+    return job, 200, {}
+
+
+def parse_citation_options(data):
+    """Reads the optional 'citation_format' and 'snippet_chars' request fields. Returns (citation_format, snippet_chars)."""
+    citation_format = data.get('citation_format')
+    if citation_format not in CITATION_FORMATS:
+        citation_format = CITATION_FORMAT
+    try:
+        snippet_chars = min(max(int(data.get('snippet_chars')), 0), CITATION_MAX_SNIPPET_CHARS)
+    except (TypeError, ValueError):
+        snippet_chars = CITATION_SNIPPET_CHARS
+    return citation_format, snippet_chars
+
+
+def parse_retrieval_options(data):
+    """Reads the optional 'number_of_results' and 'passage_chars' request fields (None where absent or invalid)."""
+    options = []
+    for field in ('number_of_results', 'passage_chars'):
+        try:
+            options.append(int(data.get(field)))
+        except (TypeError, ValueError):
+            options.append(None)
+    return tuple(options)
+
+
+def parse_latency_budget(data):
+    """Reads the optional 'latency_budget_ms' request field as seconds (None if absent or not a positive number)."""
+    try:
+        budget_ms = float(data.get('latency_budget_ms'))
+    except (TypeError, ValueError):
+        return None
+    return budget_ms / 1000 if budget_ms > 0 else None
+
+
+def parse_batch_request(data):
+    """Validates a /api/batch body. Returns ((prompts, mode, concurrency, bypass_cache), None) or (None, error)."""
+    prompts = data.get('prompts') if isinstance(data, dict) else None
+    if not isinstance(prompts, list) or not prompts:
+        return None, "Missing 'prompts' (a non-empty list) in request body"
+    if len(prompts) > BATCH_MAX_PROMPTS:
+        return None, f"Too many prompts: {len(prompts)} (limit {BATCH_MAX_PROMPTS})"
+    if not all(isinstance(prompt, str) and prompt.strip() for prompt in prompts):
+        return None, "Every prompt must be a non-empty string"
+    mode = data.get('mode', 'direct')
+    if mode not in ('direct', 'kb'):
+        return None, "'mode' must be 'direct' or 'kb'"
+    if mode == 'kb' and not knowledge_base_target()[0]:
+        return None, "Knowledge Base ID is not configured on the server."
+    try:
+        concurrency = int(data.get('concurrency', BATCH_MAX_CONCURRENCY))
+    except (TypeError, ValueError):
+        return None, "'concurrency' must be an integer"
+    concurrency = max(1, min(concurrency, BATCH_MAX_CONCURRENCY))
+    return (prompts, mode, concurrency, bool(data.get('bypass_cache'))), None
+
+
+def run_batch_item(index, prompt, mode, bypass_cache):
+    """Answers one batch prompt and returns its result record (never raises)."""
+    started = time.perf_counter()
+    result = {"index": index, "prompt": prompt}
+    try:
+        if mode == 'kb':
+            # Same target and default retrieval options as /api/ask-kb, so both share answer cache entries
+            _, knowledge_base_id, model_arn, retrieval_options = default_kb_answer_key(prompt)
+            kb_response, cache_status = cached_retrieve_and_generate(prompt, knowledge_base_id, model_arn,
+                                                                     bypass_cache=bypass_cache,
+                                                                     retrieval_options=retrieval_options)
+            result["cache"] = cache_status
+            if 'error' in kb_response:
+                result["error"] = kb_response['error']
+            else:
+                formatted = format_kb_response(kb_response, CITATION_FORMAT, CITATION_SNIPPET_CHARS)
+                result["reply"] = formatted['reply']
+                result["citations"] = formatted['citations']
+                if 'references' in formatted:
+                    result["references"] = formatted['references']
+        else:
+            ai_reply = invoke_bedrock_model(prompt) # Each prompt is independent: no conversation context
+            if is_error_reply(ai_reply):
+                result["error"] = ai_reply
+            else:
+                result["reply"] = ai_reply
+    except Exception as e:
+        app.logger.error(f"Batch item {index} failed unexpectedly: {e}")
+        result["error"] = f"Unexpected error: {e}"
+    result["ok"] = "error" not in result
+    result["latency_ms"] = round((time.perf_counter() - started) * 1000, 1)
+    return result
+
+
+def run_batch(prompts, mode, concurrency, bypass_cache=False):
+    """Runs prompts on the batch pool with at most `concurrency` in flight, yielding NDJSON lines as they finish.
+
+    Results come back in completion order (each carries its "index"); a final {"summary": ...} line follows.
+    If the client disconnects, prompts that have not started yet are cancelled.
+    """
+    started = time.perf_counter()
+    items = iter(enumerate(prompts))
+    in_flight = set()
+    succeeded = failed = 0
+
+    def submit_next():
+        item = next(items, None)
+        if item is not None:
+            in_flight.add(batch_executor.submit(run_batch_item, *item, mode, bypass_cache))
+
+    try:
+        for _ in range(concurrency):
+            submit_next()
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                in_flight.discard(future)
+                submit_next()
+                result = future.result()
+                if result["ok"]:
+                    succeeded += 1
+                else:
+                    failed += 1
+                yield json.dumps(result) + "\n"
+    finally:
+        for future in in_flight:
+            future.cancel()
+
+    summary = {"total": len(prompts), "succeeded": succeeded, "failed": failed, "mode": mode,
+               "concurrency": concurrency, "duration_ms": round((time.perf_counter() - started) * 1000, 1)}
+    app.logger.info(f"/api/batch finished: {summary}")
+    yield json.dumps({"summary": summary}) + "\n"
+
+
+# --- Request Metrics ---
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+
+def has_bearer_token(headers, token):
+    """True if the Authorization header carries token as a bearer token (constant-time comparison)."""
+    scheme, _, value = headers.get("Authorization", "").partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(value.strip().encode("utf-8"), token.encode("utf-8"))
+
+
+def admission_client_id(headers, peer):
+    """Identifies the caller for per-client fairness (see ADMISSION_CLIENT_HEADER)."""
+    value = headers.get(ADMISSION_CLIENT_HEADER, "") if ADMISSION_CLIENT_HEADER else ""
+    # The last X-Forwarded-For entry is the one our own proxy added; earlier ones are client-supplied
+    return value.split(",")[-1].strip() or peer or "unknown"
+
+
+def shed_reply(error):
+    """The (payload, status_code, headers) reply for a request admission control turned away."""
+    return {"error": SERVER_BUSY_MESSAGE}, 503, {"Retry-After": str(error.retry_after)}
+
+
+@app.before_request
+def admit_request():
+    """Holds a request to an expensive endpoint until its class has a free slot, or sheds it with 503."""
+    if not ADMISSION_ENABLED or request.url_rule is None or request.method == 'OPTIONS':
+        return None
+    class_name = ADMISSION_ENDPOINT_CLASSES.get(request.url_rule.rule)
+    if class_name is None:
+        return None
+    try:
+        g.admission_ticket = admission.acquire(class_name, admission_client_id(request.headers, request.remote_addr))
+    except Overloaded as e:
+        app.logger.warning(f"Shed {request.url_rule.rule} request: {e}")
+        REQUESTS_SHED.inc(endpoint_class=class_name, reason=e.reason)
+        payload, status_code, headers = shed_reply(e)
+        return jsonify(payload), status_code, headers
+    STAGE_LATENCY.observe(g.admission_ticket.waited_seconds, endpoint=request.url_rule.rule, stage="admission")
+    return None
+
+
+@app.after_request
+def hold_admission_while_streaming(response):
+    """A streamed response keeps its admission slot until the stream ends (or the client goes away)."""
+    ticket = g.pop('admission_ticket', None) if response.is_streamed else None
+    if ticket is not None:
+        response.call_on_close(lambda: admission.release(ticket))
+    return response
+
+
+@app.teardown_request
+def release_admission(error=None):
+    # Buffered responses (and requests that failed with an exception) free their slot here
+    ticket = g.pop('admission_ticket', None)
+    if ticket is not None:
+        admission.release(ticket)
+
+
+@app.after_request
+def record_request_metrics(response):
+    """Observes every request's latency, labelled by route (not raw path) to keep label cardinality bounded."""
+    started = getattr(g, 'request_started', None)
+    if started is not None:
+        endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+        REQUEST_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint, method=request.method,
+                                status=response.status_code)
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    """Compresses large buffered responses for clients that accept it, and reports every payload's size.
+
+    X-Payload-Bytes is the body size before compression; Content-Length is what went over the wire.
+    Streamed responses (SSE, NDJSON batches) are left alone: their size is unknown until they end.
+    """
+    if response.is_streamed or response.direct_passthrough:
+        return response
+    body = response.get_data()
+    response.headers["X-Payload-Bytes"] = str(len(body))
+    encoding = None
+    if (RESPONSE_COMPRESSION and len(body) >= COMPRESSION_MIN_BYTES and response.mimetype in COMPRESSIBLE_MIMETYPES
+            and "Content-Encoding" not in response.headers):
+        encoding = choose_encoding(request.headers.get("Accept-Encoding"))
+        response.headers.add("Vary", "Accept-Encoding")
+    if encoding:
+        response.set_data(encode_body(body, encoding, COMPRESSION_LEVEL))
+        response.headers["Content-Encoding"] = encoding
+    endpoint = request.url_rule.rule if request.url_rule else "unmatched"
+    RESPONSE_SIZE.observe(response.content_length or 0, endpoint=endpoint, encoding=encoding or "identity")
+    return response
 
 
 # --- API Endpoints ---
@@ -234,68 +1395,270 @@ def chat_endpoint():
     if not request.is_json:
         return jsonify({"error": "Request must be JSON"}), 415
 
-    data = request.get_json()
-    user_message = data.get('message')
+    with STAGE_LATENCY.time(endpoint="/api/chat", stage="parse"):
+        data = request.get_json()
+        user_message = data.get('message')
 
     if not user_message:
         return jsonify({"error": "Missing 'message' in request body"}), 400
 
-    app.logger.info(f"/api/chat received message: '{user_message[:50]}...'")
-
-    # Send message directly to Bedrock model
-    ai_reply = invoke_bedrock_model(user_message)
-
-    app.logger.info(f"/api/chat sending reply: '{str(ai_reply)[:50]}...'") # Log reply start
-
-    # Check if the reply indicates an error occurred internally
-    if isinstance(ai_reply, str) and ai_reply.startswith("Error:") or ai_reply.startswith("Sorry,"):
-         return jsonify({"error": ai_reply}), 500 # Return server error if function indicated failure
+    if wants_async(data, request.headers):
+        payload, status_code, headers = submit_job("chat", handle_chat_message, user_message, data.get('session_id'),
+                                                   parse_latency_budget(data))
+        return jsonify(payload), status_code, headers
 
-    return jsonify({"reply": ai_reply})
+    payload, status_code, headers = handle_chat_message(user_message, data.get('session_id'), parse_latency_budget(data))
+    with STAGE_LATENCY.time(endpoint="/api/chat", stage="serialize"):
+        return jsonify(payload), status_code, headers
 
 
 @app.route('/api/ask-kb', methods=['POST'])
 def ask_kb_endpoint():
     """Receives a message, queries the configured Knowledge Base."""
-    if not KNOWLEDGE_BASE_ID: # Check if KB is configured before proceeding
+    if not knowledge_base_target()[0]: # Check if KB (or the local index) is configured before proceeding
          return jsonify({"error": "Knowledge Base ID is not configured on the server."}), 501 # 501 Not Implemented
 
     if not request.is_json:
         return jsonify({"error": "Request must be JSON"}), 415
 
+    with STAGE_LATENCY.time(endpoint="/api/ask-kb", stage="parse"):
+        data = request.get_json()
+        user_message = data.get('message')
+
+    if not user_message:
+        return jsonify({"error": "Missing 'message' in request body"}), 400
+
+    if wants_async(data, request.headers):
+        payload, status_code, headers = submit_job("kb", handle_kb_message, user_message,
+                                                   bypass_cache=wants_cache_bypass(request.headers),
+                                                   session_id=data.get('session_id'),
+                                                   retrieval_options=parse_retrieval_options(data),
+                                                   citation_options=parse_citation_options(data))
+        return jsonify(payload), status_code, headers
+
+    payload, status_code, headers = handle_kb_message(user_message, bypass_cache=wants_cache_bypass(request.headers),
+                                                      session_id=data.get('session_id'),
+                                                      retrieval_options=parse_retrieval_options(data),
+                                                      citation_options=parse_citation_options(data))
+    with STAGE_LATENCY.time(endpoint="/api/ask-kb", stage="serialize"):
+        return jsonify(payload), status_code, headers
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_endpoint(job_id):
+    """Returns a job's status, and its result once finished. ?wait=<seconds> long-polls until it finishes."""
+    payload, status_code, headers = describe_job(job_store.get(job_id, parse_job_wait(request.args.get('wait'))))
+    return jsonify(payload), status_code, headers
+
+
+@app.route('/api/history/<chat_id>', methods=['GET'])
+def history_endpoint(chat_id):
+    """Returns one page of a chat's stored messages, newest first unless ?order=asc.
+
+    ?limit= sets the page size; pass the returned next_cursor as ?cursor= for the following page.
+    Internal only: requires the HISTORY_API_TOKEN bearer token.
+    """
+    if not history_reader:
+        return jsonify({"error": "Chat history table is not configured on the server."}), 501
+    if not HISTORY_API_TOKEN:
+        return jsonify({"error": "Chat history API is disabled (HISTORY_API_TOKEN is not set)."}), 403
+    if not has_bearer_token(request.headers, HISTORY_API_TOKEN):
+        return jsonify({"error": "Missing or invalid bearer token."}), 401, {"WWW-Authenticate": "Bearer"}
+
+    try:
+        limit = min(max(int(request.args.get('limit', 50)), 1), HISTORY_MAX_PAGE_SIZE)
+    except ValueError:
+        return jsonify({"error": "'limit' must be an integer"}), 400
+    try:
+        messages, next_cursor, cache_status = history_reader.page(chat_id, limit, request.args.get('cursor'),
+                                                                  newest_first=request.args.get('order') != 'asc')
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    except botocore.exceptions.ClientError as error:
+        app.logger.error(f"History query for chat {chat_id} failed: {error}")
+        return jsonify({"error": f"AWS Client Error: {error.response.get('Error', {}).get('Code')}"}), 500
+    return jsonify({"chat_id": chat_id, "messages": messages, "next_cursor": next_cursor}), 200, \
+        {"X-Cache": cache_status}
+
+
+@app.route('/api/ask-kb/stream', methods=['POST'])
+def ask_kb_stream_endpoint():
+    """Streams a Knowledge Base answer as Server-Sent Events (split/local retrieval mode)."""
+    if not retrieval_source:
+        return jsonify({"error": "Streaming Knowledge Base answers requires RETRIEVAL_MODE=split or local."}), 501
+
+    if not request.is_json:
+        return jsonify({"error": "Request must be JSON"}), 415
+
     data = request.get_json()
     user_message = data.get('message')
 
     if not user_message:
         return jsonify({"error": "Missing 'message' in request body"}), 400
 
-    app.logger.info(f"/api/ask-kb received message: '{user_message[:50]}...'")
+    app.logger.info(f"/api/ask-kb/stream received message: '{user_message[:50]}...'")
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    return Response(stream_with_context(stream_kb_answer(user_message, data.get('session_id'),
+                                                         *parse_retrieval_options(data))),
+                    mimetype='text/event-stream', headers=headers)
 
-    # Query the Knowledge Base
-    kb_response = retrieve_and_generate_from_kb(user_message, KNOWLEDGE_BASE_ID, KB_MODEL_ARN)
 
-    app.logger.info(f"/api/ask-kb sending response: {str(kb_response)[:100]}...") # Log response start
+def log_prefetch_failure(future):
+    """Done-callback for prefetches: nobody waits on them, so log the error instead of dropping it."""
+    error = None if future.cancelled() else future.exception()
+    if error is not None:
+        app.logger.warning(f"Retrieval prefetch failed: {error}")
+        BEDROCK_ERRORS.inc(operation="RetrievePrefetch", code=error_code_of(error) or "Unexpected")
 
-    # retrieve_and_generate_from_kb returns a dict. Check if it contains an 'error' key.
-    if isinstance(kb_response, dict) and 'error' in kb_response:
-        # Determine appropriate status code based on error if needed, default to 500
-        status_code = 500
-        if "Access Denied" in kb_response['error']:
-             status_code = 403
-        elif "Resource not found" in kb_response['error']:
-             status_code = 404
-        elif "not configured" in kb_response['error']:
-            status_code = 501
-        return jsonify(kb_response), status_code
 
-    # If no error key, assume success and return the whole structured response
-    return jsonify(kb_response)
+@app.route('/api/retrieve', methods=['POST'])
+def retrieve_endpoint():
+    """Returns the passages a question would be answered from (split/local retrieval mode).
+
+    With "prefetch": true it returns 202 at once and only warms the retrieval cache, so a client can
+    start retrieval for a follow-up question while the previous answer is still streaming.
+    """
+    if not retrieval_source:
+        return jsonify({"error": "Retrieval requires RETRIEVAL_MODE=split or local."}), 501
+
+    if not request.is_json:
+        return jsonify({"error": "Request must be JSON"}), 415
+
+    data = request.get_json()
+    user_message = data.get('message')
+
+    if not user_message:
+        return jsonify({"error": "Missing 'message' in request body"}), 400
+
+    number_of_results, passage_chars = resolve_retrieval_options(*parse_retrieval_options(data))
+    if data.get('prefetch'):
+        future = retrieval_executor.submit(retrieve_passages, user_message, number_of_results)
+        future.add_done_callback(log_prefetch_failure)
+        return jsonify({"status": "prefetching"}), 202
+
+    try:
+        passages, retrieval_status = retrieve_passages(user_message, number_of_results)
+    except Exception as error:
+        return jsonify(describe_kb_error(error, "Retrieve", KNOWLEDGE_BASE_ID if local_index is None else retrieval_source)), 500
+    return jsonify({"passages": select_passages(passages, passage_chars), "retrieved": len(passages)}), 200, \
+        {"X-Retrieval-Cache": retrieval_status}
+
+
+@app.route('/api/retrieval/stats', methods=['GET'])
+def retrieval_stats_endpoint():
+    """Reports retrieval cache hit/miss/eviction counters and memory use."""
+    return jsonify(retrieval_cache.stats())
+
+
+@app.route('/api/batch', methods=['POST'])
+def batch_endpoint():
+    """Runs a list of prompts (direct model or Knowledge Base) concurrently, streaming results back as NDJSON."""
+    if not request.is_json:
+        return jsonify({"error": "Request must be JSON"}), 415
+
+    job, error = parse_batch_request(request.get_json())
+    if error:
+        return jsonify({"error": error}), 501 if "not configured" in error else 400
+
+    prompts, mode, concurrency, bypass_cache = job
+    app.logger.info(f"/api/batch received {len(prompts)} prompts (mode={mode}, concurrency={concurrency})")
+    return Response(stream_with_context(run_batch(prompts, mode, concurrency, bypass_cache)),
+                    mimetype='application/x-ndjson', headers={"X-Accel-Buffering": "no"})
+
+
+@app.route('/api/cache/stats', methods=['GET'])
+def cache_stats_endpoint():
+    """Reports answer cache hit/miss/eviction counters."""
+    return jsonify(answer_cache.stats())
+
+
+@app.route('/api/cache/prewarm', methods=['POST'])
+def cache_prewarm_endpoint():
+    """Starts a prewarm pass as a job (poll /api/jobs/<job_id> for its report).
+
+    Optional JSON body: "top_k" (default PREWARM_TOP_K) and "force": true to run outside the off-peak window.
+    """
+    if not history_reader:
+        return jsonify({"error": "Chat history table is not configured on the server."}), 501
+    if not knowledge_base_target()[0]:
+        return jsonify({"error": "Knowledge Base ID is not configured on the server."}), 501
+
+    data = request.get_json(silent=True) or {}
+    if not data.get('force') and not in_hours(PREWARM_OFF_PEAK_HOURS, time.gmtime().tm_hour):
+        return jsonify({"error": f"Outside the off-peak window ({PREWARM_OFF_PEAK_HOURS} UTC). Pass \"force\": true to run anyway."}), 409
+    try:
+        top_k = max(int(data.get('top_k', PREWARM_TOP_K)), 0)
+    except (TypeError, ValueError):
+        return jsonify({"error": "'top_k' must be an integer"}), 400
+    payload, status_code, headers = submit_job("prewarm", handle_prewarm, top_k)
+    return jsonify(payload), status_code, headers
+
+
+@app.route('/api/cache/prewarm', methods=['GET'])
+def cache_prewarm_report_endpoint():
+    """Returns the report of the last prewarm pass in this process."""
+    if prewarmer.last_report is None:
+        return jsonify({"error": "No prewarm pass has run yet."}), 404
+    return jsonify(prewarmer.last_report)
+
+
+@app.route('/api/coalescing/stats', methods=['GET'])
+def coalescing_stats_endpoint():
+    """Reports how many requests shared an in-flight upstream call."""
+    return jsonify(request_coalescer.stats())
+
+
+@app.route('/api/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Exposes latency histograms and counters in the Prometheus text format."""
+    return Response(metrics.render(), content_type=MetricsRegistry.CONTENT_TYPE)
+
+
+@app.route('/api/admission/stats', methods=['GET'])
+def admission_stats_endpoint():
+    """Reports admission control load and admitted/queued/shed counters per endpoint class."""
+    return jsonify(admission.stats())
+
+
+@app.route('/api/scheduler/stats', methods=['GET'])
+def scheduler_stats_endpoint():
+    """Reports Bedrock rate limiter state and throttle/retry/shed counters."""
+    return jsonify(bedrock_scheduler.stats())
+
+
+@app.route('/api/router/stats', methods=['GET'])
+def router_stats_endpoint():
+    """Reports the latency and error-rate estimates behind model routing."""
+    return jsonify(model_router.stats())
+
+
+@app.route('/api/chat/stream', methods=['POST'])
+def chat_stream_endpoint():
+    """Receives a message and streams the model reply back as Server-Sent Events."""
+    if not request.is_json:
+        return jsonify({"error": "Request must be JSON"}), 415
+
+    data = request.get_json()
+    user_message = data.get('message')
+
+    if not user_message:
+        return jsonify({"error": "Missing 'message' in request body"}), 400
+
+    app.logger.info(f"/api/chat/stream received message: '{user_message[:50]}...'")
+
+    headers = {
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no" # Stop nginx-style proxies from buffering the stream
+    }
+    conversation = conversations.get_or_create(data.get('session_id'))
+    return Response(stream_with_context(stream_bedrock_model(user_message, conversation=conversation)),
+                    mimetype='text/event-stream', headers=headers)
 
 
 # --- Health Check Endpoint ---
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    """Simple health check endpoint."""
+    """Simple health check endpoint. It never waits for admission control, so it answers even under overload."""
     # Could add checks for Boto3 client initialization here if needed
     return jsonify({"status": "ok", "message": "API is running"})
 
@@ -0,0 +1,266 @@
+import asyncio
+import functools
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.requests import Request
+from starlette.responses import JSONResponse, Response, StreamingResponse
+from starlette.routing import Route
+
+import app as backend # Reuses the Flask app's configuration, Boto3 clients, answer cache and request coalescing
+from admission import Overloaded
+from response_format import choose_encoding, encode_body
+
+# --- Async (ASGI) Serving Mode ---
+# Exposes the same /api/chat, /api/ask-kb, /api/batch, /api/jobs, /api/metrics and /api/health contracts
+# as app.py, but without tying a server worker to each request: the event loop holds open connections
+# and the blocking Boto3 calls run on a bounded executor sized to the Bedrock connection pool.
+#
+# Needs starlette and uvicorn (requirements-optional.txt). Run with, for example:
+#   BEDROCK_MAX_POOL_CONNECTIONS=512 uvicorn asgi:app --host 0.0.0.0 --port 5000 --workers 2
+#
+# Boto3 has no native async API, so the executor is the bridge; the executor threads only wait on
+# network I/O, which makes a few hundred of them per process cheap.
+#
+# Admission control is shared with the Flask app (backend.admission), but queued requests wait on the
+# event loop rather than in a thread, and /api/health is always answered directly on the loop.
+#
+# The admission defaults are sized for the threaded Flask server: ADMISSION_MAX_CONCURRENT=64 requests
+# in total, 32 per interactive class, and class queues of 32-64. Here a waiting request costs no thread,
+# so those limits shed load long before the executor or ASGI_MAX_PENDING_REQUESTS is full. To keep
+# thousands of upstream calls in flight, raise them together with the connection pool, for example
+#   ADMISSION_MAX_CONCURRENT=512 ADMISSION_CHAT_CONCURRENCY=256 ADMISSION_CHAT_QUEUE=1024
+#   ADMISSION_KB_CONCURRENCY=256 ADMISSION_KB_QUEUE=1024
+# (the queue deadlines still shed requests that could not start in time), or set ADMISSION_ENABLED=false
+# to rely on ASGI_MAX_PENDING_REQUESTS and the Bedrock scheduler's rate limit alone.
+
+# Concurrent upstream calls per process. Defaults to the connection pool size so no thread waits for a connection.
+ASGI_EXECUTOR_WORKERS = int(os.getenv("ASGI_EXECUTOR_WORKERS", str(backend.BEDROCK_MAX_POOL_CONNECTIONS)))
+# Requests waiting for (or holding) an executor slot. Past this, new requests get 503 instead of piling up.
+ASGI_MAX_PENDING_REQUESTS = int(os.getenv("ASGI_MAX_PENDING_REQUESTS", "4096"))
+
+# How often a long-polling /api/jobs request re-checks its job
+JOB_POLL_INTERVAL_SECONDS = float(os.getenv("JOB_POLL_INTERVAL_SECONDS", "0.1"))
+
+bedrock_executor = ThreadPoolExecutor(max_workers=ASGI_EXECUTOR_WORKERS, thread_name_prefix="bedrock")
+pending_requests = 0 # Only touched from the event loop thread, so no lock is needed
+
+
+async def run_blocking(fn, *args, **kwargs):
+    """Runs a blocking Bedrock call on the executor, enforcing the pending-request bound."""
+    global pending_requests
+    if pending_requests >= ASGI_MAX_PENDING_REQUESTS:
+        return {"error": backend.SERVER_BUSY_MESSAGE}, 503, {"Retry-After": "1"}
+    pending_requests += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(bedrock_executor, lambda: fn(*args, **kwargs))
+    finally:
+        pending_requests -= 1
+
+
+async def acquire_slot(request, route):
+    """Waits for an admission slot for route's endpoint class. Returns (ticket, None) or (None, 503 response)."""
+    class_name = backend.ADMISSION_ENDPOINT_CLASSES.get(route)
+    if not backend.ADMISSION_ENABLED or class_name is None:
+        return None, None
+    client = backend.admission_client_id(request.headers, request.client.host if request.client else None)
+    try:
+        ticket = await backend.admission.acquire_async(class_name, client)
+    except Overloaded as e:
+        backend.app.logger.warning(f"Shed {route} request: {e}")
+        backend.REQUESTS_SHED.inc(endpoint_class=class_name, reason=e.reason)
+        payload, status_code, headers = backend.shed_reply(e)
+        return None, JSONResponse(payload, status_code=status_code, headers=headers)
+    backend.STAGE_LATENCY.observe(ticket.waited_seconds, endpoint=route, stage="admission")
+    return ticket, None
+
+
+def release_slot(ticket):
+    if ticket is not None:
+        backend.admission.release(ticket)
+
+
+def admitted(route):
+    """Runs the endpoint only once admission control gives it a slot (released when it returns)."""
+    def decorator(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(request):
+            ticket, shed_response = await acquire_slot(request, route)
+            if shed_response:
+                return shed_response
+            try:
+                return await endpoint(request)
+            finally:
+                release_slot(ticket)
+        return wrapper
+    return decorator
+
+
+def released_after(iterator, ticket):
+    """Yields from iterator, releasing the admission ticket once the stream ends (or the client goes away)."""
+    try:
+        yield from iterator
+    finally:
+        release_slot(ticket)
+
+
+async def read_message(request):
+    """Mirrors the Flask validation: returns (body, None) or (None, error_response)."""
+    content_type = request.headers.get('content-type', '').split(';')[0].strip()
+    if content_type != 'application/json' and not content_type.endswith('+json'):
+        return None, JSONResponse({"error": "Request must be JSON"}, status_code=415)
+    try:
+        data = json.loads(await request.body())
+    except ValueError:
+        return None, JSONResponse({"error": "Request body is not valid JSON"}, status_code=400)
+    if not isinstance(data, dict) or not data.get('message'):
+        return None, JSONResponse({"error": "Missing 'message' in request body"}, status_code=400)
+    return data, None
+
+
+def sized_response(request, route, payload, status_code=200, headers=None):
+    """JSON response compressed and size-reported the same way as the Flask app's compress_response hook."""
+    body = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    headers = {**(headers or {}), "X-Payload-Bytes": str(len(body))}
+    encoding = None
+    if backend.RESPONSE_COMPRESSION and len(body) >= backend.COMPRESSION_MIN_BYTES:
+        encoding = choose_encoding(request.headers.get("accept-encoding"))
+        headers["Vary"] = "Accept-Encoding"
+    if encoding:
+        body = encode_body(body, encoding, backend.COMPRESSION_LEVEL)
+        headers["Content-Encoding"] = encoding
+    backend.RESPONSE_SIZE.observe(len(body), endpoint=route, encoding=encoding or "identity")
+    return Response(body, status_code=status_code, headers=headers, media_type='application/json')
+
+
+def timed(route):
+    """Records the endpoint's latency in the same histogram the Flask app uses, so /api/metrics looks the same."""
+    def decorator(endpoint):
+        @functools.wraps(endpoint)
+        async def wrapper(request):
+            started = time.perf_counter()
+            response = await endpoint(request)
+            backend.REQUEST_LATENCY.observe(time.perf_counter() - started, endpoint=route, method=request.method,
+                                            status=response.status_code)
+            return response
+        return wrapper
+    return decorator
+
+
+# --- API Endpoints ---
+
+@timed('/api/chat')
+@admitted('/api/chat')
+async def chat_endpoint(request: Request):
+    """Receives a message, sends it directly to the configured Bedrock model."""
+    data, error_response = await read_message(request)
+    if error_response:
+        return error_response
+    if backend.wants_async(data, request.headers):
+        payload, status_code, headers = backend.submit_job("chat", backend.handle_chat_message, data['message'],
+                                                           data.get('session_id'), backend.parse_latency_budget(data))
+        return JSONResponse(payload, status_code=status_code, headers=headers)
+    payload, status_code, headers = await run_blocking(backend.handle_chat_message, data['message'],
+                                                       data.get('session_id'), backend.parse_latency_budget(data))
+    return sized_response(request, '/api/chat', payload, status_code, headers)
+
+
+@timed('/api/ask-kb')
+@admitted('/api/ask-kb')
+async def ask_kb_endpoint(request: Request):
+    """Receives a message, queries the configured Knowledge Base."""
+    if not backend.knowledge_base_target()[0]:
+        return JSONResponse({"error": "Knowledge Base ID is not configured on the server."}, status_code=501)
+    data, error_response = await read_message(request)
+    if error_response:
+        return error_response
+    if backend.wants_async(data, request.headers):
+        payload, status_code, headers = backend.submit_job("kb", backend.handle_kb_message, data['message'],
+                                                           bypass_cache=backend.wants_cache_bypass(request.headers),
+                                                           session_id=data.get('session_id'),
+                                                           retrieval_options=backend.parse_retrieval_options(data),
+                                                           citation_options=backend.parse_citation_options(data))
+        return JSONResponse(payload, status_code=status_code, headers=headers)
+    payload, status_code, headers = await run_blocking(backend.handle_kb_message, data['message'],
+                                                       bypass_cache=backend.wants_cache_bypass(request.headers),
+                                                       session_id=data.get('session_id'),
+                                                       retrieval_options=backend.parse_retrieval_options(data),
+                                                       citation_options=backend.parse_citation_options(data))
+    return sized_response(request, '/api/ask-kb', payload, status_code, headers)
+
+
+async def job_endpoint(request: Request):
+    """Returns a job's status and result. ?wait=<seconds> long-polls on the event loop, holding no thread."""
+    job_id = request.path_params['job_id']
+    wait_seconds = backend.parse_job_wait(request.query_params.get('wait'))
+    job = backend.job_store.get(job_id)
+    # Only a bounded number of polls wait at a time; the rest get the current state at once
+    if job is not None and job["status"] in ("queued", "running") and wait_seconds and backend.job_store.begin_long_poll():
+        try:
+            deadline = time.monotonic() + wait_seconds
+            while job is not None and job["status"] in ("queued", "running") and time.monotonic() < deadline:
+                await asyncio.sleep(JOB_POLL_INTERVAL_SECONDS)
+                job = backend.job_store.get(job_id)
+        finally:
+            backend.job_store.end_long_poll()
+    payload, status_code, headers = backend.describe_job(job)
+    return sized_response(request, '/api/jobs/{job_id}', payload, status_code, headers)
+
+
+async def batch_endpoint(request: Request):
+    """Runs a list of prompts concurrently, streaming results back as NDJSON."""
+    content_type = request.headers.get('content-type', '').split(';')[0].strip()
+    if content_type != 'application/json' and not content_type.endswith('+json'):
+        return JSONResponse({"error": "Request must be JSON"}, status_code=415)
+    try:
+        data = json.loads(await request.body())
+    except ValueError:
+        return JSONResponse({"error": "Request body is not valid JSON"}, status_code=400)
+    job, error = backend.parse_batch_request(data)
+    if error:
+        return JSONResponse({"error": error}, status_code=501 if "not configured" in error else 400)
+    ticket, shed_response = await acquire_slot(request, '/api/batch')
+    if shed_response:
+        return shed_response
+    # run_batch blocks between results; Starlette iterates a sync generator on its threadpool
+    return StreamingResponse(released_after(backend.run_batch(*job), ticket), media_type='application/x-ndjson',
+                             headers={"X-Accel-Buffering": "no"})
+
+
+async def metrics_endpoint(request: Request):
+    """Exposes latency histograms and counters in the Prometheus text format."""
+    return Response(backend.metrics.render(), media_type=backend.MetricsRegistry.CONTENT_TYPE)
+
+
+async def health_check(request: Request):
+    """Simple health check endpoint, answered directly on the event loop (never waits for admission control)."""
+    return JSONResponse({"status": "ok", "message": "API is running"})
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    bedrock_executor.shutdown(wait=False)
+
+
+# Enable CORS - same policy as the Flask app; REMEMBER to restrict origins in production!
+app = Starlette(
+    routes=[
+        Route('/api/chat', chat_endpoint, methods=['POST']),
+        Route('/api/ask-kb', ask_kb_endpoint, methods=['POST']),
+        Route('/api/batch', batch_endpoint, methods=['POST']),
+        Route('/api/jobs/{job_id}', job_endpoint, methods=['GET']),
+        Route('/api/metrics', metrics_endpoint, methods=['GET']),
+        Route('/api/health', health_check, methods=['GET']),
+    ],
+    middleware=[Middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"],
+                           expose_headers=backend.CORS_EXPOSE_HEADERS)],
+    lifespan=lifespan
+)
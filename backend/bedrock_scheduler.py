@@ -0,0 +1,168 @@
+import random
+import threading
+import time
+
+# Client-side rate limiting and retry scheduling for Bedrock calls.
+# An adaptive token bucket paces requests (additive increase on success, multiplicative decrease on
+# throttling), throttled calls are retried with full-jitter exponential backoff inside a per-request
+# latency budget, and a bounded wait queue sheds requests fast once they cannot be served in time.
+# Used by backend/app.py and Lambda/sendMessage.py.
+
+# Error codes that mean "slow down and try again" rather than "this request is wrong"
+RETRYABLE_ERROR_CODES = {
+    'ThrottlingException',
+    'TooManyRequestsException',
+    'ServiceUnavailableException',
+    'ModelNotReadyException',
+}
+
+
+class LoadShedError(Exception):
+    """Raised when a request is rejected because it cannot be scheduled within its latency budget."""
+
+
+def error_code_of(error):
+    """Returns the AWS error code of a botocore ClientError (or None for other exceptions)."""
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        return response.get('Error', {}).get('Code')
+    return None
+
+
+class AdaptiveTokenBucket:
+    """Token bucket whose refill rate adapts to observed throttling (AIMD)."""
+
+    def __init__(self, rate=10.0, burst=20, min_rate=0.5, max_rate=100.0, increase_per_success=0.1,
+                 decrease_factor=0.5, decrease_cooldown=1.0, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase_per_success = increase_per_success
+        self.decrease_factor = decrease_factor
+        self.decrease_cooldown = decrease_cooldown
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(burst)
+        self._last_refill = clock()
+        self._last_decrease = None
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    def acquire(self, deadline):
+        """Takes one token, waiting if needed. Returns False if none is available before deadline."""
+        while True:
+            with self._lock:
+                self._refill()
+                # Refill arithmetic can leave tokens a rounding error short of 1, which would mean a ~0s wait
+                if self.tokens >= 1 - 1e-9:
+                    self.tokens = max(self.tokens - 1, 0.0)
+                    return True
+                wait = (1 - self.tokens) / self.rate
+            if self.clock() + wait > deadline:
+                return False
+            self.sleep(wait)
+
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase_per_success)
+
+    def on_throttle(self):
+        with self._lock:
+            now = self.clock()
+            # A burst of concurrent calls is throttled together; count it as one congestion signal, not N
+            if self._last_decrease is None or now - self._last_decrease >= self.decrease_cooldown:
+                self.rate = max(self.min_rate, self.rate * self.decrease_factor)
+                self._last_decrease = now
+            # Drain the burst allowance so the next calls are paced at the reduced rate
+            self.tokens = min(self.tokens, 0.0)
+
+
+class BedrockScheduler:
+    """Runs Bedrock calls through the token bucket with admission control and budgeted retries."""
+
+    def __init__(self, bucket, max_queue=100, max_attempts=4, base_delay=0.25, max_delay=4.0,
+                 budget_seconds=20.0, clock=time.monotonic, sleep=time.sleep):
+        self.bucket = bucket
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget_seconds = budget_seconds
+        self.clock = clock
+        self.sleep = sleep
+        self.waiting = 0
+        self._lock = threading.Lock()
+        self.counters = {"calls": 0, "successes": 0, "throttles": 0, "retries": 0, "shed": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _admit(self, deadline):
+        """Reserves a place in the wait queue, or sheds the request if it cannot be served in time."""
+        with self._lock:
+            # Everyone ahead of us needs a token too; if that already overruns the budget, fail now
+            expected_wait = self.waiting / max(self.bucket.rate, 1e-6)
+            if self.waiting >= self.max_queue or self.clock() + expected_wait > deadline:
+                self.counters["shed"] += 1
+                raise LoadShedError(f"Request shed: {self.waiting} waiting, expected wait {expected_wait:.1f}s")
+            self.waiting += 1
+
+    def _leave(self):
+        with self._lock:
+            self.waiting -= 1
+
+    def backoff_delay(self, attempt):
+        """Full-jitter exponential backoff for the given (1-based) retry attempt."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+
+    def call(self, fn, budget_seconds=None, max_attempts=None):
+        """Calls fn() under rate limiting, retrying throttles until the latency budget runs out.
+
+        Raises LoadShedError if the request could not be admitted or scheduled in time, and re-raises
+        the last throttling error if every retry inside the budget was throttled. max_attempts overrides
+        the scheduler default, e.g. 1 when the caller would rather fail over than retry.
+        """
+        self._count("calls")
+        deadline = self.clock() + (budget_seconds if budget_seconds is not None else self.budget_seconds)
+        max_attempts = max_attempts or self.max_attempts
+        attempt = 0
+        while True:
+            attempt += 1
+            self._admit(deadline)
+            try:
+                acquired = self.bucket.acquire(deadline)
+            finally:
+                self._leave()
+            if not acquired:
+                self._count("shed")
+                raise LoadShedError("Request shed: no capacity within the latency budget")
+
+            try:
+                result = fn()
+            except Exception as error:
+                if error_code_of(error) not in RETRYABLE_ERROR_CODES:
+                    raise
+                self._count("throttles")
+                self.bucket.on_throttle()
+                delay = self.backoff_delay(attempt)
+                if attempt >= max_attempts or self.clock() + delay > deadline:
+                    raise
+                self._count("retries")
+                self.sleep(delay)
+                continue
+            self.bucket.on_success()
+            self._count("successes")
+            return result
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["waiting"] = self.waiting
+        stats["rate_per_second"] = round(self.bucket.rate, 3)
+        return stats
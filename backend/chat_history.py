@@ -0,0 +1,142 @@
+import base64
+import json
+import threading
+import time
+
+from boto3.dynamodb.conditions import Key
+
+from answer_cache import LRUCache
+
+# Read path for the chat history the sendMessage Lambda writes (store_message / HistoryWriter).
+# Table schema: partition key 'chatId', sort key 'timestamp' (ms since epoch), plus 'sender' and 'message'.
+#   - Pages are read with key-condition Query calls (never Scan), projected to the fields clients need,
+#     newest first by default, and continued with an opaque cursor (the encoded LastEvaluatedKey).
+#   - The most recent messages of each active chat are kept in an LRU, so reloading a session or
+#     rebuilding model context is answered from memory instead of querying the table again.
+# Used by backend/app.py.
+
+HISTORY_FIELDS = ("timestamp", "sender", "message")
+
+
+def encode_cursor(last_key):
+    """Turns a LastEvaluatedKey into an opaque, URL-safe cursor."""
+    raw = json.dumps({"c": last_key["chatId"], "t": int(last_key["timestamp"])}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, chat_id):
+    """Returns the ExclusiveStartKey for a cursor, or raises ValueError if it is malformed or for another chat."""
+    try:
+        raw = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        start_key = {"chatId": raw["c"], "timestamp": int(raw["t"])}
+    except (ValueError, KeyError, TypeError):
+        raise ValueError("Malformed history cursor")
+    if start_key["chatId"] != chat_id:
+        raise ValueError("History cursor belongs to a different chat")
+    return start_key
+
+
+def to_message(item):
+    # The DynamoDB resource returns numbers as Decimal
+    return {"timestamp": int(item["timestamp"]), "sender": item.get("sender"), "message": item.get("message")}
+
+
+class _RecentWindow:
+    def __init__(self, messages, complete, loaded_at):
+        self.messages = messages # Newest first
+        self.complete = complete # True if the chat has no messages older than these
+        self.loaded_at = loaded_at
+
+
+class ChatHistoryReader:
+    """Paginated history queries with a per-chat cache of the most recent messages.
+
+    Messages are written by another process (the Lambda), so cached windows are refreshed after
+    ttl_seconds rather than updated on write.
+    """
+
+    def __init__(self, table, recent_window=50, max_chats=1000, ttl_seconds=30, clock=time.monotonic):
+        self.table = table
+        self.recent_window = recent_window
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self._windows = LRUCache(max_chats)
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "queries": 0, "items_read": 0}
+
+    def _query(self, chat_id, limit, start_key=None, newest_first=True):
+        """One Query call. Returns (messages, last_evaluated_key or None)."""
+        request = {
+            "KeyConditionExpression": Key("chatId").eq(chat_id),
+            "ProjectionExpression": ", ".join(f"#{field}" for field in HISTORY_FIELDS),
+            # 'timestamp' is a DynamoDB reserved word, so every projected name goes through a placeholder
+            "ExpressionAttributeNames": {f"#{field}": field for field in HISTORY_FIELDS},
+            "ScanIndexForward": not newest_first,
+            "Limit": limit,
+        }
+        if start_key:
+            request["ExclusiveStartKey"] = start_key
+        response = self.table.query(**request)
+        items = response.get("Items", [])
+        with self._lock:
+            self.counters["queries"] += 1
+            self.counters["items_read"] += len(items)
+        last_key = response.get("LastEvaluatedKey")
+        if last_key:
+            # Projection drops chatId from the items, but LastEvaluatedKey always carries the full key
+            last_key = {"chatId": last_key["chatId"], "timestamp": int(last_key["timestamp"])}
+        return [to_message(item) for item in items], last_key
+
+    def _window(self, chat_id):
+        """Returns (the cached recent window for chat_id, loading it if needed, cache status)."""
+        window = self._windows.get(chat_id)
+        if window is not None and self.clock() - window.loaded_at < self.ttl_seconds:
+            with self._lock:
+                self.counters["hits"] += 1
+            return window, "HIT"
+        with self._lock:
+            self.counters["misses"] += 1
+        messages, last_key = self._query(chat_id, self.recent_window)
+        window = _RecentWindow(messages, complete=last_key is None, loaded_at=self.clock())
+        self._windows.put(chat_id, window)
+        return window, "MISS"
+
+    def page(self, chat_id, limit=50, cursor=None, newest_first=True):
+        """Returns (messages, next_cursor, cache_status) for one page of a chat's history.
+
+        The first newest-first page is served from the recent window when it fits in it. Older
+        pages, and oldest-first reads, query the table from the cursor.
+        """
+        start_key = decode_cursor(cursor, chat_id) if cursor else None
+        if newest_first and start_key is None and limit <= self.recent_window:
+            window, status = self._window(chat_id)
+            messages = window.messages[:limit]
+            has_more = len(window.messages) > limit or not window.complete
+            next_cursor = encode_cursor({"chatId": chat_id, **messages[-1]}) if messages and has_more else None
+            return messages, next_cursor, status
+        messages, last_key = self._query(chat_id, limit, start_key, newest_first)
+        return messages, encode_cursor(last_key) if last_key else None, "BYPASS"
+
+    def recent(self, chat_id, count):
+        """Returns up to count of the chat's latest messages, oldest first (for building model context)."""
+        window, _ = self._window(chat_id)
+        return list(reversed(window.messages[:count]))
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+        stats["cached_chats"] = len(self._windows)
+        return stats
+
+
+def pair_turns(messages):
+    """Pairs consecutive user/bot messages (oldest first) into (user_message, assistant_message) turns."""
+    turns = []
+    pending_user = None
+    for message in messages:
+        if message["sender"] == "user":
+            pending_user = message["message"]
+        elif message["sender"] == "bot" and pending_user is not None:
+            turns.append((pending_user, message["message"]))
+            pending_user = None
+    return turns
@@ -0,0 +1,135 @@
+import re
+import threading
+import uuid
+
+from answer_cache import LRUCache
+
+# Rolling conversation context for the direct-invocation path.
+# The most recent turns are kept verbatim; older turns are folded into a running summary one at a
+# time as they fall out of the window, so each new turn costs O(1) work and the prompt stays under
+# a fixed token budget however long the conversation gets.
+
+
+def estimate_tokens(text):
+    """Cheap token estimate (~4 characters per token for English text)."""
+    return len(text) // 4 + 1
+
+
+def first_sentence(text, max_chars=200):
+    """Returns the first sentence of text, cut to max_chars."""
+    text = re.sub(r"\s+", " ", text).strip()
+    match = re.match(r"(.+?[.!?])(\s|$)", text)
+    sentence = match.group(1) if match else text
+    return sentence if len(sentence) <= max_chars else sentence[:max_chars - 3] + "..."
+
+
+def extractive_summary(summary, user_message, assistant_message):
+    """Folds one turn into the running summary without another model call."""
+    line = f"- User asked: {first_sentence(user_message)} Assistant: {first_sentence(assistant_message)}"
+    return f"{summary}\n{line}" if summary else line
+
+
+def truncate_to_tokens(text, max_tokens):
+    """Cuts text to roughly max_tokens (by the same estimate as estimate_tokens)."""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    return text[:max(max_tokens - 1, 0) * 4 - 4].rstrip() + " ..." if max_tokens > 2 else ""
+
+
+def summary_tokens(summary):
+    """Token estimate of a summary (0 when there is none yet)."""
+    return estimate_tokens(summary) if summary else 0
+
+
+def trim_summary(summary, max_tokens):
+    """Drops the oldest lines of a summary until it fits max_tokens."""
+    while summary and estimate_tokens(summary) > max_tokens:
+        _, _, summary = summary.partition("\n")
+    return summary
+
+
+def fit_turn(user_message, assistant_message, max_tokens):
+    """Shortens one turn to fit max_tokens, keeping up to half of the budget for the user message."""
+    user_message = truncate_to_tokens(user_message, max_tokens // 2)
+    return user_message, truncate_to_tokens(assistant_message, max_tokens - estimate_tokens(user_message))
+
+
+class ConversationContext:
+    """Recent turns verbatim plus an incrementally maintained summary of older ones."""
+
+    def __init__(self, session_id, token_budget=2000, recent_turns=6, summarize=extractive_summary):
+        self.session_id = session_id
+        self.token_budget = token_budget
+        self.recent_turns = recent_turns
+        self.summarize = summarize
+        self.summary = ""
+        self.turns = [] # [(user_message, assistant_message)], oldest first
+        self.lock = threading.Lock()
+        self._turn_tokens = 0
+
+    def tokens(self):
+        return summary_tokens(self.summary) + self._turn_tokens
+
+    def add_turn(self, user_message, assistant_message):
+        """Appends a completed turn and folds old turns into the summary until the window fits.
+
+        A newest turn that is larger than the whole budget on its own is shortened to fit.
+        """
+        with self.lock:
+            self.turns.append((user_message, assistant_message))
+            self._turn_tokens += estimate_tokens(user_message) + estimate_tokens(assistant_message)
+            while self.turns and (len(self.turns) > self.recent_turns or
+                                  (self.tokens() > self.token_budget and len(self.turns) > 1)):
+                old_user, old_assistant = self.turns.pop(0)
+                self._turn_tokens -= estimate_tokens(old_user) + estimate_tokens(old_assistant)
+                self.summary = self.summarize(self.summary, old_user, old_assistant)
+            # The summary gets at most a quarter of the budget; forget its oldest lines first
+            self.summary = trim_summary(self.summary, self.token_budget // 4)
+            if self.tokens() > self.token_budget and self.turns:
+                newest = fit_turn(*self.turns[-1], self.token_budget - summary_tokens(self.summary))
+                self.turns[-1] = newest
+                self._turn_tokens = estimate_tokens(newest[0]) + estimate_tokens(newest[1])
+
+    def snapshot(self, prompt=""):
+        """Returns (summary, turns) for building a prompt, consistent with concurrent add_turn calls.
+
+        The prompt counts against the token budget too: the oldest turns that no longer fit next to it
+        are folded into the returned summary (the stored context is left as is), and a newest turn that
+        still does not fit is shortened.
+        """
+        with self.lock:
+            summary, turns = self.summary, list(self.turns)
+            turn_tokens = self._turn_tokens
+        available = self.token_budget - (estimate_tokens(prompt) if prompt else 0)
+        if summary_tokens(summary) + turn_tokens <= available:
+            return summary, turns
+        if available <= 0:
+            return "", []
+        while len(turns) > 1 and summary_tokens(summary) + turn_tokens > available:
+            old_user, old_assistant = turns.pop(0)
+            turn_tokens -= estimate_tokens(old_user) + estimate_tokens(old_assistant)
+            summary = self.summarize(summary, old_user, old_assistant)
+        summary = trim_summary(summary, min(self.token_budget // 4, available // 2))
+        if turns and summary_tokens(summary) + turn_tokens > available:
+            turns[-1] = fit_turn(*turns[-1], available - summary_tokens(summary))
+        return summary, turns
+
+
+class ConversationStore:
+    """Bounded in-memory map of session id -> ConversationContext (least recently used sessions are dropped)."""
+
+    def __init__(self, max_sessions=1000, token_budget=2000, recent_turns=6):
+        self.sessions = LRUCache(max_sessions)
+        self.token_budget = token_budget
+        self.recent_turns = recent_turns
+        self._lock = threading.Lock()
+
+    def get_or_create(self, session_id=None):
+        """Returns the conversation for session_id, starting a new one (with a fresh id if needed)."""
+        session_id = session_id or str(uuid.uuid4())
+        with self._lock:
+            conversation = self.sessions.get(session_id)
+            if conversation is None:
+                conversation = ConversationContext(session_id, self.token_budget, self.recent_turns)
+                self.sessions.put(session_id, conversation)
+        return conversation
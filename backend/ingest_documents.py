@@ -0,0 +1,83 @@
+"""Builds the local vector index used by RETRIEVAL_MODE=local.
+
+Reads .txt, .md and .html documents under a directory, splits them into overlapping passages,
+embeds them and writes a memory-mappable index (see local_index.py). The default hashing embedder
+is deterministic and needs no network access; --embedder bedrock uses a Bedrock embedding model.
+
+Example:
+    python ingest_documents.py ../docs --index-dir vector_index --location-prefix s3://travel-docs/
+    python ingest_documents.py ../docs --index-dir vector_index --embedder bedrock --dimensions 1024
+"""
+import argparse
+import html
+import os
+import re
+import sys
+import time
+
+from local_index import BedrockEmbedder, HashingEmbedder, LocalVectorIndex, chunk_text
+
+DOCUMENT_EXTENSIONS = (".txt", ".md", ".html", ".htm")
+
+
+def read_document(path):
+    with open(path, encoding="utf-8", errors="replace") as f:
+        text = f.read()
+    if path.lower().endswith((".html", ".htm")):
+        text = re.sub(r"(?is)<(script|style).*?</\1>", " ", text)
+        text = re.sub(r"(?i)<br\s*/?>|</(p|div|h[1-6]|li|tr)>", "\n\n", text)
+        text = html.unescape(re.sub(r"<[^>]+>", " ", text))
+    return text
+
+
+def collect_passages(source_dir, location_prefix, max_chars, overlap_chars):
+    """Returns [{"text", "location"}] for every passage of every document under source_dir."""
+    passages = []
+    for root, _, files in os.walk(source_dir):
+        for name in sorted(files):
+            if not name.lower().endswith(DOCUMENT_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            relative = os.path.relpath(path, source_dir).replace(os.sep, "/")
+            location = f"{location_prefix}{relative}" if location_prefix else relative
+            for text in chunk_text(read_document(path), max_chars, overlap_chars):
+                passages.append({"text": text, "location": location})
+    return passages
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source_dir", help="Directory containing the travel documents")
+    parser.add_argument("--index-dir", default="vector_index", help="Where to write the index")
+    parser.add_argument("--embedder", choices=("hashing", "bedrock"), default="hashing")
+    parser.add_argument("--dimensions", type=int, default=512)
+    parser.add_argument("--embedding-model-id", default="amazon.titan-embed-text-v2:0", help="Used with --embedder bedrock")
+    parser.add_argument("--chunk-chars", type=int, default=1000, help="Maximum passage size")
+    parser.add_argument("--overlap-chars", type=int, default=150, help="Text shared by consecutive passages")
+    parser.add_argument("--location-prefix", default="",
+                        help="Prefix for citation locations, e.g. the S3 URI the documents are published under")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.embedder == "bedrock":
+        import boto3
+        embedder = BedrockEmbedder(boto3.client('bedrock-runtime', region_name=os.getenv("AWS_REGION", "us-east-1")),
+                                   args.embedding_model_id, args.dimensions)
+    else:
+        embedder = HashingEmbedder(args.dimensions)
+
+    passages = collect_passages(args.source_dir, args.location_prefix, args.chunk_chars, args.overlap_chars)
+    if not passages:
+        print(f"No {', '.join(DOCUMENT_EXTENSIONS)} documents found under {args.source_dir}")
+        return 1
+    started = time.perf_counter()
+    index = LocalVectorIndex.build(args.index_dir, passages, embedder)
+    print(f"Indexed {len(index.passages)} passages from {len({p['location'] for p in passages})} documents "
+          f"into {args.index_dir} in {time.perf_counter() - started:.1f}s ({args.embedder}, {args.dimensions} dimensions)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,156 @@
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# Asynchronous job mode for long generations.
+# A submitted request returns a job id at once; a bounded worker pool runs the Bedrock call and the
+# result is kept for a TTL, so clients poll (or long-poll) for it instead of holding a connection open
+# past proxy and API Gateway timeouts.
+#
+# Jobs live in the memory of the process that accepted them, so polls must reach the same process
+# (a single instance, or sticky routing on the job id).
+# Used by backend/app.py and backend/asgi.py.
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+
+class JobQueueFull(Exception):
+    """Raised by JobStore.submit when max_pending jobs are already queued or running."""
+
+
+class _Job:
+    def __init__(self, job_id, kind, created_at):
+        self.job_id = job_id
+        self.kind = kind
+        self.status = QUEUED
+        self.created_at = created_at
+        self.started_at = None
+        self.finished_at = None
+        self.payload = None
+        self.status_code = None
+        self.done = threading.Event()
+
+    def snapshot(self):
+        job = {"job_id": self.job_id, "kind": self.kind, "status": self.status}
+        if self.started_at is not None:
+            job["queued_ms"] = round((self.started_at - self.created_at) * 1000, 1)
+        if self.finished_at is not None:
+            job["run_ms"] = round((self.finished_at - self.started_at) * 1000, 1)
+            job["status_code"] = self.status_code
+            job["result"] = self.payload
+        return job
+
+
+class JobStore:
+    """Runs jobs on an executor and keeps their results until ttl_seconds after they finish.
+
+    At most max_results finished jobs are kept; beyond that the oldest results are evicted early.
+    Expiry is lazy: finished jobs are kept in completion order, which is also expiry order, so each
+    submit or get only drops the expired jobs at the front instead of scanning every job.
+
+    At most max_long_polls polls wait for a job at a time; further polls are answered at once with the
+    job's current state (a long-poll holds a server thread or connection for up to its whole wait).
+    """
+
+    def __init__(self, executor, max_pending=256, ttl_seconds=900, max_long_polls=32, max_results=4096,
+                 clock=time.monotonic):
+        self.executor = executor
+        self.max_pending = max_pending
+        self.ttl_seconds = ttl_seconds
+        self.max_results = max_results
+        self.max_long_polls = max_long_polls
+        self.clock = clock
+        self._jobs = {} # job_id -> _Job, queued, running or finished
+        self._finished = OrderedDict() # job_id -> finished_at, oldest first
+        self._pending = 0
+        self._long_polls = 0
+        self._lock = threading.Lock()
+        self.counters = {"submitted": 0, "rejected": 0, "completed": 0, "failed": 0, "expired": 0, "evicted": 0,
+                         "long_polls": 0, "long_polls_capped": 0}
+
+    def submit(self, kind, fn, *args, **kwargs):
+        """Queues fn(*args, **kwargs), which must return (payload, status_code). Returns the job id."""
+        with self._lock:
+            self._expire()
+            if self._pending >= self.max_pending:
+                self.counters["rejected"] += 1
+                raise JobQueueFull(f"{self._pending} jobs already pending")
+            job = _Job(uuid.uuid4().hex, kind, self.clock())
+            self._jobs[job.job_id] = job
+            self._pending += 1
+            self.counters["submitted"] += 1
+        self.executor.submit(self._run, job, fn, args, kwargs)
+        return job.job_id
+
+    def _run(self, job, fn, args, kwargs):
+        job.started_at = self.clock()
+        job.status = RUNNING
+        try:
+            payload, status_code = fn(*args, **kwargs)
+            status = DONE if status_code < 400 else FAILED
+        except Exception as e:
+            payload, status_code, status = {"error": f"An internal server error occurred: {str(e)}"}, 500, FAILED
+        with self._lock:
+            job.payload, job.status_code = payload, status_code
+            job.finished_at = self.clock()
+            job.status = status
+            self._pending -= 1
+            self.counters["completed" if status == DONE else "failed"] += 1
+            self._finished[job.job_id] = job.finished_at
+            while len(self._finished) > self.max_results:
+                job_id, _ = self._finished.popitem(last=False)
+                del self._jobs[job_id]
+                self.counters["evicted"] += 1
+        job.done.set()
+
+    def get(self, job_id, wait_seconds=0):
+        """Returns the job's state (with its result once finished), or None if unknown or expired.
+
+        With wait_seconds, blocks until the job finishes or the wait runs out (long polling).
+        """
+        with self._lock:
+            self._expire()
+            job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        if wait_seconds > 0 and not job.done.is_set() and self.begin_long_poll():
+            try:
+                job.done.wait(wait_seconds)
+            finally:
+                self.end_long_poll()
+        with self._lock:
+            return job.snapshot()
+
+    def begin_long_poll(self):
+        """Claims a long-poll slot. Returns False, counting the capped poll, if max_long_polls are already waiting."""
+        with self._lock:
+            if self._long_polls >= self.max_long_polls:
+                self.counters["long_polls_capped"] += 1
+                return False
+            self._long_polls += 1
+            self.counters["long_polls"] += 1
+            return True
+
+    def end_long_poll(self):
+        with self._lock:
+            self._long_polls -= 1
+
+    def _expire(self):
+        """Drops finished jobs whose results are older than the TTL. Caller holds the lock."""
+        cutoff = self.clock() - self.ttl_seconds
+        while self._finished:
+            job_id, finished_at = next(iter(self._finished.items()))
+            if finished_at > cutoff:
+                break
+            del self._finished[job_id]
+            del self._jobs[job_id]
+            self.counters["expired"] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["pending"] = self._pending
+            stats["long_polling"] = self._long_polls
+            stats["stored"] = len(self._jobs)
+        return stats
@@ -0,0 +1,210 @@
+import hashlib
+import json
+import os
+import re
+import time
+
+import numpy as np
+
+# Local, in-process vector retrieval for the /api/ask-kb path (RETRIEVAL_MODE=local).
+# Documents are chunked into passages and embedded offline (see ingest_documents.py). The embedding
+# matrix is stored as a .npy file and memory-mapped at query time, so the index costs no heap until
+# pages are touched and is shared by every worker process on the host through the page cache.
+#
+# Index directory layout:
+#   manifest.json     embedder spec, dimensions, passage count
+#   embeddings.npy    float32 [passages x dim], rows L2-normalized (cosine similarity = dot product)
+#   passages.jsonl    one {"text": ..., "location": ...} object per row of embeddings.npy
+
+MANIFEST_FILE = "manifest.json"
+EMBEDDINGS_FILE = "embeddings.npy"
+PASSAGES_FILE = "passages.jsonl"
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+
+class HashingEmbedder:
+    """Deterministic, offline embedder: signed feature hashing of word unigrams and bigrams.
+
+    It captures lexical overlap only, which is enough to run and test the local retrieval mode
+    without network access or model downloads. Use BedrockEmbedder for semantic retrieval.
+    """
+    name = "hashing"
+
+    def __init__(self, dimensions=512):
+        self.dimensions = dimensions
+
+    def _features(self, text):
+        words = TOKEN_PATTERN.findall(text.lower())
+        return words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature in self._features(text):
+                digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+                value = int.from_bytes(digest, "little")
+                vectors[row, value % self.dimensions] += 1.0 if value >> 63 else -1.0
+        return normalize_rows(vectors)
+
+    def spec(self):
+        return {"name": self.name, "dimensions": self.dimensions}
+
+
+class BedrockEmbedder:
+    """Embeds texts with a Bedrock embedding model (Titan Text Embeddings V2 request format)."""
+    name = "bedrock"
+
+    def __init__(self, bedrock_runtime, model_id="amazon.titan-embed-text-v2:0", dimensions=512):
+        self.bedrock_runtime = bedrock_runtime
+        self.model_id = model_id
+        self.dimensions = dimensions
+
+    def embed(self, texts):
+        vectors = np.zeros((len(texts), self.dimensions), dtype=np.float32)
+        for row, text in enumerate(texts):
+            response = self.bedrock_runtime.invoke_model(
+                modelId=self.model_id,
+                body=json.dumps({"inputText": text, "dimensions": self.dimensions, "normalize": True}),
+                contentType='application/json',
+                accept='application/json'
+            )
+            vectors[row] = json.loads(response['body'].read())['embedding']
+        return normalize_rows(vectors)
+
+    def spec(self):
+        return {"name": self.name, "model_id": self.model_id, "dimensions": self.dimensions}
+
+
+def make_embedder(spec, bedrock_runtime=None):
+    """Recreates the embedder an index was built with from its manifest spec."""
+    if spec["name"] == HashingEmbedder.name:
+        return HashingEmbedder(spec["dimensions"])
+    if spec["name"] == BedrockEmbedder.name:
+        if bedrock_runtime is None:
+            raise ValueError("A Bedrock Runtime client is required for an index built with Bedrock embeddings.")
+        return BedrockEmbedder(bedrock_runtime, spec["model_id"], spec["dimensions"])
+    raise ValueError(f"Unknown embedder: {spec['name']}")
+
+
+def normalize_rows(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def chunk_text(text, max_chars=1000, overlap_chars=150):
+    """Splits text into passages of up to max_chars, preferring paragraph and sentence boundaries.
+
+    Consecutive passages share up to overlap_chars of text so an answer spanning a boundary is
+    still retrievable from one passage.
+    """
+    text = re.sub(r"[ \t]+", " ", text).strip()
+    pieces = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        while len(paragraph) > max_chars:
+            cut = paragraph.rfind(". ", 0, max_chars)
+            cut = cut + 1 if cut > max_chars // 2 else max_chars
+            pieces.append(paragraph[:cut].strip())
+            paragraph = paragraph[cut:].strip()
+        if paragraph:
+            pieces.append(paragraph)
+
+    passages = []
+    current = ""
+    for piece in pieces:
+        if current and len(current) + len(piece) + 2 > max_chars:
+            passages.append(current)
+            tail = current[-overlap_chars:] if overlap_chars else ""
+            current = tail[tail.find(" ") + 1:] if " " in tail else tail
+        current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        passages.append(current)
+    return passages
+
+
+class LocalVectorIndex:
+    """Memory-mapped embedding matrix plus passages, searched with vectorized batch top-k."""
+
+    def __init__(self, directory, embedder, embeddings, passages, manifest):
+        self.directory = directory
+        self.embedder = embedder
+        self.embeddings = embeddings
+        self.passages = passages
+        self.manifest = manifest
+
+    @property
+    def source_id(self):
+        """Identifies this index build, e.g. in answer cache keys (rebuilding the index changes it)."""
+        return f"local:{os.path.abspath(self.directory)}@{self.manifest['built_at']}"
+
+    @classmethod
+    def build(cls, directory, passages, embedder, batch_size=64):
+        """Embeds passages ([{"text", "location"}]) and writes a new index to directory."""
+        os.makedirs(directory, exist_ok=True)
+        embeddings = np.lib.format.open_memmap(os.path.join(directory, EMBEDDINGS_FILE), mode="w+",
+                                               dtype=np.float32, shape=(len(passages), embedder.dimensions))
+        for start in range(0, len(passages), batch_size):
+            batch = passages[start:start + batch_size]
+            embeddings[start:start + len(batch)] = embedder.embed([passage["text"] for passage in batch])
+        embeddings.flush()
+        del embeddings
+        with open(os.path.join(directory, PASSAGES_FILE), "w", encoding="utf-8") as f:
+            for passage in passages:
+                f.write(json.dumps({"text": passage["text"], "location": passage.get("location")}) + "\n")
+        manifest = {"embedder": embedder.spec(), "dimensions": embedder.dimensions, "passages": len(passages),
+                    "built_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())}
+        with open(os.path.join(directory, MANIFEST_FILE), "w", encoding="utf-8") as f:
+            json.dump(manifest, f, indent=2)
+        return cls.load(directory, embedder)
+
+    @classmethod
+    def load(cls, directory, embedder=None, bedrock_runtime=None):
+        with open(os.path.join(directory, MANIFEST_FILE), encoding="utf-8") as f:
+            manifest = json.load(f)
+        embedder = embedder or make_embedder(manifest["embedder"], bedrock_runtime)
+        embeddings = np.load(os.path.join(directory, EMBEDDINGS_FILE), mmap_mode="r")
+        with open(os.path.join(directory, PASSAGES_FILE), encoding="utf-8") as f:
+            passages = [json.loads(line) for line in f if line.strip()]
+        if embeddings.shape != (len(passages), manifest["dimensions"]):
+            raise ValueError(f"Index at {directory} is inconsistent: embeddings {embeddings.shape}, "
+                             f"{len(passages)} passages, {manifest['dimensions']} dimensions")
+        return cls(directory, embedder, embeddings, passages, manifest)
+
+    def search(self, query_vectors, k=4, block_rows=65536):
+        """Top-k cosine search for a batch of query vectors. Returns (scores, indices), both [queries x k].
+
+        The index is scanned in blocks of block_rows so the score matrix stays small however large
+        the index is; each block contributes its own top-k candidates to a running top-k.
+        """
+        queries = np.asarray(query_vectors, dtype=np.float32)
+        k = min(k, len(self.passages))
+        best_scores = np.empty((len(queries), 0), dtype=np.float32)
+        best_indices = np.empty((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(self.passages), block_rows):
+            scores = queries @ self.embeddings[start:start + block_rows].T
+            indices = np.broadcast_to(np.arange(start, start + scores.shape[1]), scores.shape)
+            scores = np.concatenate([best_scores, scores], axis=1)
+            indices = np.concatenate([best_indices, indices], axis=1)
+            if scores.shape[1] > k:
+                # argpartition finds the k best in O(n) per query; only those k are sorted at the end
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, top, axis=1)
+                indices = np.take_along_axis(indices, top, axis=1)
+            best_scores, best_indices = scores, indices
+        order = np.argsort(-best_scores, axis=1, kind="stable")
+        return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_indices, order, axis=1)
+
+    def query(self, texts, k=4, min_score=None):
+        """Embeds and searches a batch of query texts. Returns, per query, [{"text", "location", "score"}]."""
+        if not self.passages:
+            return [[] for _ in texts]
+        scores, indices = self.search(self.embedder.embed(texts), k)
+        results = []
+        for row_scores, row_indices in zip(scores, indices):
+            results.append([
+                {**self.passages[index], "score": round(float(score), 4)}
+                for score, index in zip(row_scores, row_indices)
+                if min_score is None or score >= min_score
+            ])
+        return results
@@ -0,0 +1,230 @@
+import json
+
+# Request/response formats of the model families used for direct invocation.
+# Each adapter knows how one family's InvokeModel body is built and how its (streamed) responses are
+# read, so supporting a new model means registering an adapter instead of adding another elif.
+#
+# Every request starts with the same system prompt and inference settings. An adapter serializes that
+# part once (prepare_prefix) and only encodes the per-request rest on each call (encode_body). For models
+# on the prompt cache allowlist (register_prompt_cache_model) the end of the prefix can also be marked as
+# a cache point, so Bedrock reuses the processed prefix instead of re-reading it on every call. Other
+# models reject the marker, so it is never sent to them.
+# Usage dicts use the keys input_tokens, output_tokens, cache_read_tokens, cache_write_tokens and stop_reason.
+# Used by backend/app.py.
+
+
+class PromptPrefix:
+    """The fixed leading part of every request body for one model family, serialized once."""
+
+    def __init__(self, system_prompt="", max_tokens=1024, temperature=0.7, cache=False, data=None):
+        self.system_prompt = system_prompt
+        self.max_tokens = max_tokens
+        self.temperature = temperature
+        self.cache = cache
+        self.data = data # Preserialized JSON bytes, or None if the adapter builds each body whole
+
+
+class ModelAdapter:
+    """Builds InvokeModel request bodies and parses responses for one model family."""
+
+    def build_payload(self, prompt, summary="", turns=(), max_tokens=1024, temperature=0.7, system_prompt="",
+                      cache=False):
+        """Returns the request body (a dict) for prompt, preceded by an optional conversation summary and turns.
+
+        cache marks the system prompt as a prompt cache point (only for models that support it).
+        """
+        raise NotImplementedError
+
+    def prepare_prefix(self, system_prompt="", max_tokens=1024, temperature=0.7, cache=False):
+        """Returns the PromptPrefix that encode_body starts every request with."""
+        return PromptPrefix(system_prompt, max_tokens, temperature, cache)
+
+    def encode_body(self, prefix, prompt, summary="", turns=()):
+        """Returns the complete request body (bytes) for prompt after prefix."""
+        return json.dumps(self.build_payload(prompt, summary, turns, prefix.max_tokens, prefix.temperature,
+                                             prefix.system_prompt, prefix.cache)).encode("utf-8")
+
+    def parse_response(self, response_body):
+        """Returns (text, usage) from a decoded InvokeModel response body."""
+        raise NotImplementedError
+
+    def parse_stream_chunk(self, chunk):
+        """Returns (text_delta, usage_update) from one decoded InvokeModelWithResponseStream chunk."""
+        raise NotImplementedError
+
+
+class AnthropicMessagesAdapter(ModelAdapter):
+    """Claude 3+ models (Anthropic Messages API), optionally with a prompt cache point after the system prompt."""
+
+    @staticmethod
+    def _messages(prompt, turns):
+        messages = []
+        for user_turn, assistant_turn in turns:
+            messages.append({"role": "user", "content": [{"type": "text", "text": user_turn}]})
+            messages.append({"role": "assistant", "content": [{"type": "text", "text": assistant_turn}]})
+        messages.append({"role": "user", "content": [{"type": "text", "text": prompt}]})
+        return messages
+
+    @staticmethod
+    def _system_block(system_prompt, cache):
+        block = {"type": "text", "text": system_prompt}
+        if cache:
+            # Everything up to and including this block is cached
+            block["cache_control"] = {"type": "ephemeral"}
+        return block
+
+    @staticmethod
+    def _summary_text(summary):
+        return f"Summary of the earlier conversation:\n{summary}"
+
+    def build_payload(self, prompt, summary="", turns=(), max_tokens=1024, temperature=0.7, system_prompt="",
+                      cache=False):
+        payload = {
+            "anthropic_version": "bedrock-2023-05-31", # Required for Claude 3
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "messages": self._messages(prompt, turns)
+        }
+        if system_prompt:
+            payload["system"] = [self._system_block(system_prompt, cache)]
+            if summary:
+                payload["system"].append({"type": "text", "text": self._summary_text(summary)})
+        elif summary:
+            payload["system"] = self._summary_text(summary)
+        return payload
+
+    def prepare_prefix(self, system_prompt="", max_tokens=1024, temperature=0.7, cache=False):
+        head = json.dumps({"anthropic_version": "bedrock-2023-05-31", "max_tokens": max_tokens, "temperature": temperature})
+        data = head[:-1] # Left open: the system blocks and messages are appended per request
+        if system_prompt:
+            data += ', "system": [' + json.dumps(self._system_block(system_prompt, cache))
+        return PromptPrefix(system_prompt, max_tokens, temperature, cache, data.encode("utf-8"))
+
+    def encode_body(self, prefix, prompt, summary="", turns=()):
+        parts = [prefix.data]
+        if prefix.system_prompt:
+            # The summary changes every turn, so it goes after the cache point
+            if summary:
+                parts.append(b", " + json.dumps({"type": "text", "text": self._summary_text(summary)}).encode("utf-8"))
+            parts.append(b"]")
+        elif summary:
+            parts.append(b', "system": ' + json.dumps(self._summary_text(summary)).encode("utf-8"))
+        parts.append(b', "messages": ' + json.dumps(self._messages(prompt, turns)).encode("utf-8") + b"}")
+        return b"".join(parts)
+
+    @staticmethod
+    def _usage(usage):
+        return {
+            "input_tokens": usage.get('input_tokens'),
+            "output_tokens": usage.get('output_tokens'),
+            "cache_read_tokens": usage.get('cache_read_input_tokens'),
+            "cache_write_tokens": usage.get('cache_creation_input_tokens')
+        }
+
+    def parse_response(self, response_body):
+        # Extract text - structure varies between Anthropic models too
+        text = "".join([content.get('text', '') for content in response_body.get('content', [])])
+        usage = self._usage(response_body.get('usage', {}))
+        usage['stop_reason'] = response_body.get('stop_reason')
+        return text, usage
+
+    def parse_stream_chunk(self, chunk):
+        text = ""
+        usage = {}
+        chunk_type = chunk.get('type')
+        if chunk_type == 'message_start':
+            usage = self._usage(chunk.get('message', {}).get('usage', {}))
+            del usage['output_tokens'] # Only a placeholder until message_delta reports the real count
+        elif chunk_type == 'content_block_delta':
+            text = chunk.get('delta', {}).get('text', '')
+        elif chunk_type == 'message_delta':
+            usage['output_tokens'] = chunk.get('usage', {}).get('output_tokens')
+            usage['stop_reason'] = chunk.get('delta', {}).get('stop_reason')
+        return text, usage
+
+
+class TitanTextAdapter(ModelAdapter):
+    """Amazon Titan Text models (single prompt string)."""
+
+    def build_payload(self, prompt, summary="", turns=(), max_tokens=1024, temperature=0.7, system_prompt="",
+                      cache=False):
+        # Titan Text takes a single prompt string, so the context is written out as a transcript
+        # (it has no prompt caching, so the system prompt is simply sent in front of it every time)
+        transcript = [system_prompt] if system_prompt else []
+        if summary:
+            transcript.append(f"Summary of the earlier conversation:\n{summary}")
+        for user_turn, assistant_turn in turns:
+            transcript.append(f"User: {user_turn}\nBot: {assistant_turn}")
+        return {
+            "inputText": "\n".join(transcript + [f"User: {prompt}\nBot:"]) if transcript else prompt,
+            "textGenerationConfig": {
+                "maxTokenCount": max_tokens,
+                "temperature": temperature,
+                "stopSequences": [],
+                "topP": 0.9
+            }
+        }
+
+    def parse_response(self, response_body):
+        result = response_body.get('results')[0]
+        return result.get('outputText'), {"input_tokens": response_body.get('inputTextTokenCount'),
+                                          "output_tokens": result.get('tokenCount'),
+                                          "stop_reason": result.get('completionReason')}
+
+    def parse_stream_chunk(self, chunk):
+        usage = {}
+        if chunk.get('inputTextTokenCount') is not None:
+            usage['input_tokens'] = chunk.get('inputTextTokenCount')
+        if chunk.get('totalOutputTextTokenCount') is not None:
+            usage['output_tokens'] = chunk.get('totalOutputTextTokenCount')
+        if chunk.get('completionReason'):
+            usage['stop_reason'] = chunk.get('completionReason')
+        return chunk.get('outputText', ''), usage
+
+
+# (model id substring, adapter); the first match wins, so register more specific patterns first
+_ADAPTERS = []
+
+
+def register_adapter(model_id_pattern, adapter):
+    """Makes adapter handle every model whose id contains model_id_pattern (e.g. 'mistral')."""
+    _ADAPTERS.append((model_id_pattern, adapter))
+
+
+def adapter_for(model_id):
+    """Returns the adapter for model_id, or None if the model family is not supported."""
+    for pattern, adapter in _ADAPTERS:
+        if pattern in model_id:
+            return adapter
+    return None
+
+
+# (model id substring, minimum cacheable prefix in tokens) of models with Bedrock prompt caching
+_PROMPT_CACHE_MODELS = []
+
+
+def register_prompt_cache_model(model_id_pattern, min_tokens):
+    """Allows prompt cache points for every model whose id contains model_id_pattern."""
+    _PROMPT_CACHE_MODELS.append((model_id_pattern, min_tokens))
+
+
+def prompt_cache_min_tokens(model_id):
+    """Returns the smallest prefix (in tokens) model_id caches, or None if it doesn't support prompt caching."""
+    for pattern, min_tokens in _PROMPT_CACHE_MODELS:
+        if pattern in model_id:
+            return min_tokens
+    return None
+
+
+register_adapter("anthropic", AnthropicMessagesAdapter())
+register_adapter("amazon.titan", TitanTextAdapter())
+# Other providers (Cohere, AI21, Mistral, ...) can be added with register_adapter, consulting the
+# AWS Bedrock documentation for their payload structures.
+
+# Prompt caching on Bedrock is limited to these models (see the Bedrock user guide, "Prompt caching");
+# ids with a cross-region inference profile prefix (e.g. us.anthropic...) match too. Sending a cache
+# point to any other model (e.g. Claude 3 Sonnet or Haiku) fails the request with a ValidationException.
+register_prompt_cache_model("anthropic.claude-3-7-sonnet", 1024)
+register_prompt_cache_model("anthropic.claude-3-5-haiku", 2048)
+register_prompt_cache_model("anthropic.claude-sonnet-4", 1024)
+register_prompt_cache_model("anthropic.claude-opus-4", 1024)
@@ -0,0 +1,121 @@
+import re
+import threading
+import time
+
+from conversation import estimate_tokens
+
+# Latency-aware routing of direct model invocations.
+# Models are configured as tiers ordered from fastest to most capable. Each prompt is scored on cheap
+# features (length, planning vocabulary, number of questions, conversation size) and sent to the
+# matching tier; the other tiers follow as fallbacks. A moving latency and error-rate estimate per
+# model moves models that are throttled, failing or too slow for the request's latency budget to
+# the back of the list, so a struggling model stops receiving traffic until it recovers.
+
+# Words that suggest a multi-step planning request rather than a short factual question
+PLANNING_TERMS = re.compile(
+    r"\b(itinerar\w*|plan\w*|schedul\w*|days?|weeks?|compar\w*|budget\w*|route\w*|"
+    r"recommend\w*|optimi[sz]\w*|trade-?offs?|pros and cons)\b",
+    re.IGNORECASE
+)
+
+
+def prompt_complexity(prompt, context_tokens=0):
+    """Scores a prompt from 0.0 (short factual question) to 1.0 (long, multi-part planning request)."""
+    score = min(estimate_tokens(prompt) / 100, 1.0) * 0.25
+    score += min(len(PLANNING_TERMS.findall(prompt)) / 3, 1.0) * 0.55
+    score += min(max(prompt.count("?") - 1, 0) / 2, 1.0) * 0.1
+    score += min(context_tokens / 1500, 1.0) * 0.1
+    return round(min(score, 1.0), 3)
+
+
+class ModelHealth:
+    """Moving latency and error-rate estimates for one model."""
+
+    def __init__(self, alpha=0.2, error_half_life=60.0, base_cooldown=2.0, max_cooldown=60.0, clock=time.monotonic):
+        self.alpha = alpha
+        self.error_half_life = error_half_life
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self.clock = clock
+        self.latency = None # EWMA of successful call latency, in seconds
+        self.calls = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+        self._error_rate = 0.0
+        self._error_rate_at = clock()
+
+    def error_rate(self):
+        """EWMA of the failure rate, decaying toward 0 while the model gets no traffic."""
+        elapsed = self.clock() - self._error_rate_at
+        return self._error_rate * 0.5 ** (elapsed / self.error_half_life)
+
+    def record(self, latency, ok):
+        now = self.clock()
+        self._error_rate = self.error_rate() * (1 - self.alpha) + (0.0 if ok else self.alpha)
+        self._error_rate_at = now
+        self.calls += 1
+        if ok:
+            self.latency = latency if self.latency is None else self.latency * (1 - self.alpha) + latency * self.alpha
+            self.consecutive_failures = 0
+        else:
+            self.failures += 1
+            self.consecutive_failures += 1
+            # Back off from a failing model for longer each time it fails in a row
+            cooldown = min(self.max_cooldown, self.base_cooldown * 2 ** (self.consecutive_failures - 1))
+            self.cooldown_until = now + cooldown
+
+    def cooling_down(self):
+        return self.clock() < self.cooldown_until
+
+
+class ModelRouter:
+    """Orders the configured models for each request by prompt complexity, health and latency budget."""
+
+    def __init__(self, tiers, max_error_rate=0.5, clock=time.monotonic, **health_options):
+        if not tiers:
+            raise ValueError("ModelRouter needs at least one model tier")
+        self.tiers = list(tiers) # Model ids, fastest first
+        self.max_error_rate = max_error_rate
+        self.clock = clock
+        self.health = {model_id: ModelHealth(clock=clock, **health_options) for model_id in self.tiers}
+        self._lock = threading.Lock()
+
+    def preferred_tier(self, prompt, context_tokens=0):
+        """Index of the tier whose capability matches the prompt."""
+        complexity = prompt_complexity(prompt, context_tokens)
+        return min(int(complexity * len(self.tiers)), len(self.tiers) - 1)
+
+    def candidates(self, prompt, context_tokens=0, budget_seconds=None):
+        """Returns every model id in the order it should be tried for this prompt.
+
+        The preferred tier comes first, then more capable tiers, then faster ones. Models that are
+        cooling down after failures, have a high error rate, or whose latency estimate exceeds the
+        budget keep that relative order but move behind the models that are fine.
+        """
+        preferred = self.preferred_tier(prompt, context_tokens)
+        order = self.tiers[preferred:] + self.tiers[:preferred][::-1]
+        with self._lock:
+            def penalty(model_id):
+                health = self.health[model_id]
+                unhealthy = health.cooling_down() or health.error_rate() > self.max_error_rate
+                too_slow = budget_seconds is not None and health.latency is not None and health.latency > budget_seconds
+                return (unhealthy, too_slow)
+            return sorted(order, key=penalty) # Stable: ties keep the tier order
+
+    def record(self, model_id, latency, ok):
+        """Feeds the outcome of one call into the model's estimates (models outside the tiers are ignored)."""
+        with self._lock:
+            if model_id in self.health:
+                self.health[model_id].record(latency, ok)
+
+    def stats(self):
+        with self._lock:
+            return {model_id: {
+                "tier": self.tiers.index(model_id),
+                "latency_ms": round(health.latency * 1000, 1) if health.latency is not None else None,
+                "error_rate": round(health.error_rate(), 3),
+                "calls": health.calls,
+                "failures": health.failures,
+                "cooling_down": health.cooling_down()
+            } for model_id, health in self.health.items()}
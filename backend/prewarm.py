@@ -0,0 +1,186 @@
+import threading
+import time
+
+from boto3.dynamodb.conditions import Attr
+
+from answer_cache import normalize_prompt
+
+# Answer cache prewarming from the query log.
+# Seasonal traffic means the same few hundred questions dominate for weeks, and every cold cache entry
+# costs a full RAG call while a user waits. So the user messages the sendMessage Lambda stores
+# (store_message / HistoryWriter) are mined for the questions asked most often lately, and the top ones
+# are answered ahead of time, off-peak and within a call budget.
+#   - mine_queries: reads recent user messages with a paginated, projected Scan. This is a batch job;
+#     request paths never Scan the history table (see chat_history.py)
+#   - rank_queries: groups them by normalized prompt and ranks by recency-weighted frequency
+#   - Prewarmer: answers the top-K that aren't cached yet, paced and capped, and reports the hit-rate gain
+# Used by backend/app.py.
+
+
+def mine_queries(table, since_ms, max_scanned=50000, page_size=1000):
+    """Returns ([(timestamp_ms, message), ...], items_scanned) for user messages stored since since_ms.
+
+    Stops after max_scanned items, so one run's read cost stays bounded on a large table.
+    """
+    request = {
+        "FilterExpression": Attr("sender").eq("user") & Attr("timestamp").gte(since_ms),
+        # 'timestamp' is a DynamoDB reserved word
+        "ProjectionExpression": "#timestamp, #message",
+        "ExpressionAttributeNames": {"#timestamp": "timestamp", "#message": "message"},
+    }
+    entries = []
+    scanned = 0
+    while scanned < max_scanned:
+        response = table.scan(Limit=min(page_size, max_scanned - scanned), **request)
+        scanned += response.get("ScannedCount", len(response.get("Items", [])))
+        entries.extend((int(item["timestamp"]), item["message"]) for item in response.get("Items", [])
+                       if isinstance(item.get("message"), str))
+        if "LastEvaluatedKey" not in response:
+            break
+        request["ExclusiveStartKey"] = response["LastEvaluatedKey"]
+    return entries, scanned
+
+
+def rank_queries(entries, now_ms, half_life_hours=72.0, min_count=2, max_chars=300):
+    """Ranks logged messages by recency-weighted frequency, highest score first.
+
+    Each occurrence counts 0.5 ** (age / half_life), so last week's seasonal surge outranks a question
+    that was popular months ago. Messages asked fewer than min_count times, or longer than max_chars
+    (conversational turns rather than reusable questions), are left out. Returns dicts with the
+    normalized 'query', the latest 'prompt' phrasing, its 'count' and 'score'.
+    """
+    half_life_ms = half_life_hours * 3600 * 1000
+    groups = {}
+    for timestamp_ms, message in entries:
+        if len(message) > max_chars:
+            continue
+        query = normalize_prompt(message)
+        if not query:
+            continue
+        group = groups.setdefault(query, {"query": query, "prompt": message, "count": 0, "score": 0.0, "latest": 0})
+        group["count"] += 1
+        group["score"] += 0.5 ** (max(now_ms - timestamp_ms, 0) / half_life_ms)
+        if timestamp_ms >= group["latest"]:
+            group["prompt"], group["latest"] = message, timestamp_ms
+    ranked = [group for group in groups.values() if group["count"] >= min_count]
+    for group in ranked:
+        del group["latest"]
+        group["score"] = round(group["score"], 4)
+    ranked.sort(key=lambda group: (-group["score"], -group["count"], group["query"]))
+    return ranked
+
+
+def in_hours(hours, hour):
+    """True if hour (0-23) falls in a window like "1-6" (end exclusive; "22-5" wraps past midnight). Empty means always."""
+    if not hours:
+        return True
+    start, _, end = hours.partition("-")
+    start, end = int(start), int(end or int(start) + 1)
+    return start <= hour < end if start <= end else hour >= start or hour < end
+
+
+class PrewarmRunning(Exception):
+    """Raised by Prewarmer.run when another run is still in progress."""
+
+
+class Prewarmer:
+    """Answers the top-ranked queries that aren't cached yet, within a rate and call budget.
+
+    is_cached(prompt) and warm(prompt) are supplied by the app: warm generates and caches the answer
+    a default /api/ask-kb request would get, returning True on success. rate_per_second 0 disables pacing.
+
+    Only the top_k candidates are looked up in the cache (each lookup may be a DynamoDB read), so the
+    projected hit rates count the rest as uncached: their gain is exact, before/after are lower bounds.
+    project_all=True looks up every candidate for exact before/after rates.
+    """
+
+    def __init__(self, is_cached, warm, rate_per_second=0.5, max_calls=200, max_seconds=1800,
+                 max_consecutive_failures=3, project_all=False, clock=time.monotonic, sleep=time.sleep):
+        self.is_cached = is_cached
+        self.warm = warm
+        self.project_all = project_all
+        self.rate_per_second = rate_per_second
+        self.max_calls = max_calls
+        self.max_seconds = max_seconds
+        self.max_consecutive_failures = max_consecutive_failures
+        self.clock = clock
+        self.sleep = sleep
+        self.last_report = None
+        self._running = threading.Lock()
+
+    def run(self, ranked, top_k=100):
+        """Warms ranked[:top_k] and returns a report. Raises PrewarmRunning if a run is in progress."""
+        if not self._running.acquire(blocking=False):
+            raise PrewarmRunning("A prewarm run is already in progress")
+        try:
+            report = self._run(ranked, top_k)
+        finally:
+            self._running.release()
+        self.last_report = report
+        return report
+
+    def _run(self, ranked, top_k):
+        started = self.clock()
+        interval = 1.0 / self.rate_per_second if self.rate_per_second > 0 else 0.0
+        next_call_at = started
+        looked_up = ranked if self.project_all else ranked[:top_k]
+        cached = {group["query"]: False for group in ranked}
+        cached.update((group["query"], self.is_cached(group["prompt"])) for group in looked_up)
+        cached_before = dict(cached)
+        counts = {"already_cached": 0, "warmed": 0, "failed": 0, "skipped": 0}
+        queries = []
+        stop_reason = None
+        consecutive_failures = 0
+        for group in ranked[:top_k]:
+            if cached[group["query"]]:
+                status = "already_cached"
+            elif stop_reason:
+                status = "skipped"
+            else:
+                calls = counts["warmed"] + counts["failed"]
+                if calls >= self.max_calls:
+                    stop_reason, status = "call budget exhausted", "skipped"
+                elif max(next_call_at, self.clock()) + interval - started > self.max_seconds:
+                    stop_reason, status = "time budget exhausted", "skipped"
+                else:
+                    # Pace the calls so prewarming never competes with user traffic for Bedrock throughput
+                    self.sleep(max(next_call_at - self.clock(), 0))
+                    next_call_at = self.clock() + interval
+                    ok = self.warm(group["prompt"])
+                    status = "warmed" if ok else "failed"
+                    cached[group["query"]] = ok
+                    consecutive_failures = 0 if ok else consecutive_failures + 1
+                    if consecutive_failures >= self.max_consecutive_failures:
+                        stop_reason = "repeated failures (throttled or unavailable)"
+            counts[status] += 1
+            queries.append({"query": group["query"], "count": group["count"], "score": group["score"], "status": status})
+
+        report = {
+            "candidates": len(ranked),
+            "top_k": min(top_k, len(ranked)),
+            "cache_lookups": len(looked_up),
+            **counts,
+            "stopped": stop_reason,
+            "duration_seconds": round(self.clock() - started, 3),
+            "queries": queries,
+        }
+        report["hit_rate"] = self._hit_rates(ranked, cached_before, cached)
+        return report
+
+    @staticmethod
+    def _hit_rates(ranked, cached_before, cached_after):
+        """Projected answer cache hit rates over the mined query log, before and after the run.
+
+        'logged' weights each query by how often it was asked; 'weighted' by its recency-weighted
+        score, the better predictor of the coming days' traffic. Only repeat questions are counted,
+        and candidates that weren't looked up count as uncached.
+        """
+        rates = {}
+        for name, field in (("logged", "count"), ("weighted", "score")):
+            total = sum(group[field] for group in ranked)
+            before = sum(group[field] for group in ranked if cached_before[group["query"]])
+            after = sum(group[field] for group in ranked if cached_after[group["query"]])
+            rates[name] = {"before": round(before / total, 4) if total else 0.0,
+                           "after": round(after / total, 4) if total else 0.0,
+                           "gain": round((after - before) / total, 4) if total else 0.0}
+        return rates
@@ -0,0 +1,87 @@
+import gzip
+
+try:
+    import brotli # Optional (requirements-optional.txt): without it only gzip is offered
+except ImportError:
+    brotli = None
+
+# Compact, size-bounded serialization of answers.
+#   - compact_citations: each unique reference appears once in a table; citations point at it by index
+#   - choose_encoding / encode_body: gzip or brotli response compression, negotiated from Accept-Encoding
+# Used by backend/app.py and Lambda/sendMessage.py.
+#
+# Compact citation format:
+#   {"references": [{"text": "...", "location": "s3://..."}, ...],
+#    "citations":  [{"refs": [0, 2]}, {"refs": [1]}]}
+# The full format, [{"references": [{"text", "location"}, ...]}, ...], repeats a reference's text under
+# every citation that uses it.
+
+CITATION_FORMATS = ("compact", "full")
+COMPRESSIBLE_MIMETYPES = ("application/json", "application/x-ndjson", "text/plain", "text/html")
+ENCODING_PREFERENCE = ("br", "gzip") if brotli else ("gzip",)
+
+
+def truncate_snippet(text, max_chars):
+    """Cuts text to at most max_chars (plus an ellipsis) at a word boundary; max_chars 0 or None keeps it whole."""
+    if not text or not max_chars or len(text) <= max_chars:
+        return text
+    cut = text.rfind(" ", 0, max_chars)
+    return text[:cut if cut > max_chars // 2 else max_chars].rstrip() + " ..."
+
+
+def compact_citations(citations, snippet_chars=None):
+    """Converts full-format citations to the compact format, with reference texts cut to snippet_chars."""
+    references = []
+    positions = {} # (location, full text) -> index in references
+    compact = []
+    for citation in citations:
+        refs = []
+        for ref in citation.get("references", []):
+            key = (ref.get("location"), ref.get("text"))
+            if key not in positions:
+                positions[key] = len(references)
+                references.append({"text": truncate_snippet(ref.get("text"), snippet_chars), "location": ref.get("location")})
+            if positions[key] not in refs:
+                refs.append(positions[key])
+        if refs:
+            compact.append({"refs": refs})
+    return {"references": references, "citations": compact}
+
+
+def format_kb_response(response, citation_format="compact", snippet_chars=None):
+    """Returns a Knowledge Base answer ({"reply", "citations", ...}) with its citations in citation_format."""
+    if citation_format == "full":
+        if not snippet_chars:
+            return response
+        citations = [{"references": [{**ref, "text": truncate_snippet(ref.get("text"), snippet_chars)}
+                                     for ref in citation.get("references", [])]}
+                     for citation in response.get("citations", [])]
+        return {**response, "citations": citations}
+    return {**response, **compact_citations(response.get("citations", []), snippet_chars)}
+
+
+def choose_encoding(accept_encoding):
+    """Picks the best supported content coding from an Accept-Encoding header, or None for identity."""
+    accepted = {}
+    for part in (accept_encoding or "").split(","):
+        name, _, params = part.strip().partition(";")
+        quality = 1.0
+        if params.strip().startswith("q="):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    for encoding in ENCODING_PREFERENCE:
+        if accepted.get(encoding, accepted.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+
+def encode_body(body, encoding, level=6):
+    """Compresses a response body (bytes) with the given content coding."""
+    if encoding == "br":
+        return brotli.compress(body, quality=min(level, 11))
+    if encoding == "gzip":
+        return gzip.compress(body, compresslevel=min(level, 9))
+    return body
@@ -0,0 +1,127 @@
+import re
+import threading
+import time
+from collections import OrderedDict
+
+from answer_cache import make_cache_key
+
+# Helpers for the split retrieve-then-generate path (RETRIEVAL_MODE=split or local).
+#   - RetrievalCache: vector-search results per normalized query, with a TTL and a memory bound
+#   - dedupe_passages / fit_passages: trim retrieved passages before they are put into the prompt
+# Used by backend/app.py.
+
+WORD_PATTERN = re.compile(r"\w+")
+PASSAGE_OVERHEAD_BYTES = 200 # Rough per-passage cost of the dict, strings and location beyond the text itself
+
+
+def retrieval_cache_key(query, source_id, number_of_results):
+    """Key for one vector search: the normalized query, where it ran, and how many results were asked for."""
+    return make_cache_key(query, source_id, "retrieve", number_of_results)
+
+
+def passages_size(passages):
+    """Approximate memory held by a list of passages, in bytes."""
+    return sum(len(p.get("text") or "") + len(p.get("location") or "") + PASSAGE_OVERHEAD_BYTES for p in passages)
+
+
+class RetrievalCache:
+    """LRU cache of retrieval results bounded by total (approximate) bytes, with per-entry expiry."""
+
+    def __init__(self, max_bytes=32 * 1024 * 1024, ttl_seconds=600, clock=time.monotonic):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.bytes = 0
+        self._entries = OrderedDict() # key -> (expires_at, size, passages)
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0, "expirations": 0, "evictions": 0}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= self.clock():
+                self._remove(key)
+                self.counters["expirations"] += 1
+                entry = None
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            self._entries.move_to_end(key)
+            self.counters["hits"] += 1
+            return entry[2]
+
+    def put(self, key, passages):
+        size = passages_size(passages)
+        if size > self.max_bytes:
+            return # Would evict everything else and still not fit
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (self.clock() + self.ttl_seconds, size, passages)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.counters["evictions"] += 1
+
+    def _remove(self, key):
+        _, size, _ = self._entries.pop(key)
+        self.bytes -= size
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = self.bytes
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 3) if lookups else 0.0
+        return stats
+
+
+def _shingles(text, size=3):
+    words = WORD_PATTERN.findall(text.lower())
+    if len(words) <= size:
+        return {tuple(words)} if words else set()
+    return {tuple(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+
+def dedupe_passages(passages, threshold=0.8):
+    """Drops passages that mostly repeat a higher-ranked one (same text from overlapping chunks or copies).
+
+    Two passages are near-duplicates when the share of the smaller one's word 3-grams that also
+    appear in the other reaches threshold. Passages are expected best-first; the first of each
+    group of duplicates is kept.
+    """
+    kept = []
+    kept_shingles = []
+    for passage in passages:
+        shingles = _shingles(passage.get("text") or "")
+        if not shingles:
+            continue
+        duplicate = any(len(shingles & other) / min(len(shingles), len(other)) >= threshold
+                        for other in kept_shingles)
+        if not duplicate:
+            kept.append(passage)
+            kept_shingles.append(shingles)
+    return kept
+
+
+def fit_passages(passages, max_chars, min_chars=200):
+    """Keeps passages, best first, until their combined text reaches max_chars.
+
+    The passage that crosses the budget is cut at a word boundary, or dropped if less than
+    min_chars of budget is left for it.
+    """
+    fitted = []
+    remaining = max_chars
+    for passage in passages:
+        text = passage.get("text") or ""
+        if len(text) <= remaining:
+            fitted.append(passage)
+            remaining -= len(text)
+            continue
+        if remaining >= min_chars:
+            cut = text.rfind(" ", 0, remaining)
+            fitted.append({**passage, "text": text[:cut if cut > 0 else remaining].rstrip() + " ..."})
+        break
+    return fitted
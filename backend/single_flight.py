@@ -0,0 +1,76 @@
+import threading
+
+# Request coalescing ("single flight"): while a call for a key is in flight, identical calls
+# wait for it and share its result (or its exception) instead of going upstream themselves.
+
+
+class _Call:
+    """One in-flight upstream call and the callers waiting on it."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key into a single execution."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.counters = {"leaders": 0, "followers": 0, "errors": 0}
+
+    def do(self, key, fn):
+        """Runs fn() once per key at a time. Returns (result, shared) where shared is True for followers."""
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                call.waiters += 1
+                self.counters["followers"] += 1
+                leader = False
+            else:
+                call = _Call()
+                self._calls[key] = call
+                self.counters["leaders"] += 1
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            # Followers get the leader's exception; one that only makes sense in the leader's
+            # thread (KeyboardInterrupt, GeneratorExit, ...) is reported to them as a RuntimeError
+            if isinstance(e, Exception):
+                call.error = e
+            else:
+                call.error = RuntimeError(f"Coalesced call was interrupted: {type(e).__name__}")
+                call.error.__cause__ = e
+            with self._lock:
+                self.counters["errors"] += 1
+            raise
+        finally:
+            # Forget the key before waking followers so later callers start a fresh call
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._calls)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self.counters)
+            stats["in_flight"] = len(self._calls)
+        total = stats["leaders"] + stats["followers"]
+        # Share of requests that were answered without their own upstream call
+        stats["coalescing_ratio"] = round(stats["followers"] / total, 4) if total else 0.0
+        return stats
@@ -0,0 +1,416 @@
+import io
+import json
+import random
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+# Local stand-ins for the AWS services used by backend/app.py and Lambda/sendMessage.py.
+# Each fake mimics the response shapes of the real Boto3 client closely enough for the code under
+# test, and simulates configurable latency, throttling and payload sizes so it can be benchmarked
+# (or exercised) without network access or AWS credentials.
+
+
+class FakeServiceConfig:
+    """Latency/throttling/payload knobs shared by the fakes."""
+
+    def __init__(self, latency_ms=200.0, jitter_ms=50.0, first_token_ms=50.0, throttle_rate=0.0,
+                 output_chars=800, stream_chunks=20, citations=2, reference_chars=600, seed=None):
+        self.latency_ms = latency_ms           # Full response time of a blocking call
+        self.jitter_ms = jitter_ms             # Uniform +/- jitter added to latency_ms
+        self.first_token_ms = first_token_ms   # Delay before the first chunk of a streaming call
+        self.throttle_rate = throttle_rate     # Probability that a call raises ThrottlingException
+        self.output_chars = output_chars       # Size of the generated answer
+        self.stream_chunks = stream_chunks     # Number of chunks a streaming answer is split into
+        self.citations = citations             # Citations per Knowledge Base answer
+        self.reference_chars = reference_chars # Size of each retrieved reference text
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def latency_seconds(self):
+        with self._lock:
+            jitter = self.random.uniform(-self.jitter_ms, self.jitter_ms)
+        return max(self.latency_ms + jitter, 0.0) / 1000
+
+    def should_throttle(self):
+        with self._lock:
+            return self.random.random() < self.throttle_rate
+
+    def answer_text(self, prompt):
+        base = f"Here is some travel advice about '{prompt[:40]}'. "
+        return (base * (self.output_chars // len(base) + 1))[:self.output_chars]
+
+
+def throttling_error(operation):
+    return ClientError({"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}}, operation)
+
+
+def validation_error(operation, message):
+    return ClientError({"Error": {"Code": "ValidationException", "Message": message}}, operation)
+
+
+# Models with Bedrock prompt caching and their minimum cacheable prefix in tokens; cache points sent to
+# any other model are rejected, and shorter prefixes are processed without being cached
+PROMPT_CACHE_MIN_TOKENS = {"anthropic.claude-3-7-sonnet": 1024, "anthropic.claude-3-5-haiku": 2048,
+                           "anthropic.claude-sonnet-4": 1024, "anthropic.claude-opus-4": 1024}
+
+
+def split_chunks(text, count):
+    size = max(len(text) // max(count, 1), 1)
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+class CallStats:
+    """Counts calls per operation (thread-safe)."""
+
+    def __init__(self):
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def record(self, operation):
+        with self._lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+
+
+class FakeBedrockRuntime:
+    """Stand-in for the 'bedrock-runtime' client (InvokeModel / InvokeModelWithResponseStream)."""
+
+    def __init__(self, config=None):
+        self.config = config or FakeServiceConfig()
+        self.stats = CallStats()
+        self.requests = [] # Decoded request bodies, newest last (bounded)
+        self._cached_prefixes = set() # Prompt cache: serialized system blocks up to a cache point
+        self._lock = threading.Lock()
+
+    def _start(self, operation, body):
+        self.stats.record(operation)
+        self.requests = (self.requests + [json.loads(body)])[-100:]
+        if self.config.should_throttle():
+            time.sleep(self.config.latency_seconds() / 10) # Throttles come back fast
+            raise throttling_error(operation)
+
+    def _prompt_of(self, body):
+        payload = json.loads(body)
+        if "messages" in payload:
+            return payload["messages"][-1]["content"][0]["text"]
+        return payload.get("inputText", "")
+
+    def _input_usage(self, operation, body, model_id):
+        """Anthropic-style input token usage, simulating Bedrock's prompt cache.
+
+        The system blocks up to the last one marked with cache_control form the cacheable prefix: the
+        first request with a given prefix writes it to the cache, later ones read it. Like Bedrock,
+        cache points are rejected for models without prompt caching, and prefixes below the model's
+        minimum are not cached.
+        """
+        payload = json.loads(body)
+        input_tokens = len(body) // 4
+        system = payload.get("system") if isinstance(payload.get("system"), list) else []
+        cache_points = [i for i, block in enumerate(system) if "cache_control" in block]
+        if not cache_points:
+            return {"input_tokens": input_tokens}
+        min_tokens = next((tokens for pattern, tokens in PROMPT_CACHE_MIN_TOKENS.items() if pattern in model_id), None)
+        if min_tokens is None:
+            raise validation_error(operation, f"{model_id} does not support prompt caching")
+        prefix = json.dumps(system[:cache_points[-1] + 1], sort_keys=True)
+        prefix_tokens = len(prefix) // 4
+        if prefix_tokens < min_tokens:
+            return {"input_tokens": input_tokens}
+        with self._lock:
+            hit = prefix in self._cached_prefixes
+            self._cached_prefixes.add(prefix)
+        return {"input_tokens": max(input_tokens - prefix_tokens, 0),
+                "cache_read_input_tokens" if hit else "cache_creation_input_tokens": prefix_tokens}
+
+    def invoke_model(self, body, modelId, contentType='application/json', accept='application/json', **kwargs):
+        self._start("InvokeModel", body)
+        usage = self._input_usage("InvokeModel", body, modelId) if "anthropic" in modelId else None
+        time.sleep(self.config.latency_seconds())
+        text = self.config.answer_text(self._prompt_of(body))
+        input_tokens = len(body) // 4
+        output_tokens = len(text) // 4
+        if usage is not None:
+            result = {"content": [{"type": "text", "text": text}],
+                      "usage": {**usage, "output_tokens": output_tokens}}
+        else:
+            result = {"inputTextTokenCount": input_tokens,
+                      "results": [{"outputText": text, "tokenCount": output_tokens}]}
+        return {"body": io.BytesIO(json.dumps(result).encode("utf-8")), "contentType": "application/json"}
+
+    def invoke_model_with_response_stream(self, body, modelId, contentType='application/json',
+                                          accept='application/json', **kwargs):
+        self._start("InvokeModelWithResponseStream", body)
+        text = self.config.answer_text(self._prompt_of(body))
+        usage = (self._input_usage("InvokeModelWithResponseStream", body, modelId) if "anthropic" in modelId
+                 else {"input_tokens": len(body) // 4})
+        return {"body": self._stream_events(modelId, text, usage)}
+
+    def _stream_events(self, model_id, text, usage):
+        input_tokens = usage["input_tokens"]
+        chunks = split_chunks(text, self.config.stream_chunks)
+        per_chunk = max(self.config.latency_seconds() - self.config.first_token_ms / 1000, 0) / max(len(chunks), 1)
+        time.sleep(self.config.first_token_ms / 1000)
+        metrics = {"inputTokenCount": input_tokens, "outputTokenCount": len(text) // 4,
+                   "invocationLatency": int(self.config.latency_ms), "firstByteLatency": int(self.config.first_token_ms)}
+        if "anthropic" in model_id:
+            events = [{"type": "message_start", "message": {"usage": usage}}]
+            metrics.update({"cacheReadInputTokenCount": usage.get("cache_read_input_tokens", 0),
+                            "cacheWriteInputTokenCount": usage.get("cache_creation_input_tokens", 0)})
+            events += [{"type": "content_block_delta", "delta": {"type": "text_delta", "text": c}} for c in chunks]
+            events += [{"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": len(text) // 4}},
+                       {"type": "message_stop", "amazon-bedrock-invocationMetrics": metrics}]
+        else:
+            events = [{"outputText": c, "index": i} for i, c in enumerate(chunks)]
+            events[-1].update({"completionReason": "FINISH", "amazon-bedrock-invocationMetrics": metrics})
+        for event in events:
+            if event.get("type") == "content_block_delta" or "outputText" in event:
+                time.sleep(per_chunk)
+            yield {"chunk": {"bytes": json.dumps(event).encode("utf-8")}}
+
+
+class FakeBedrockAgentRuntime:
+    """Stand-in for the 'bedrock-agent-runtime' client (Retrieve / RetrieveAndGenerate / RetrieveAndGenerateStream)."""
+
+    def __init__(self, config=None):
+        self.config = config or FakeServiceConfig()
+        self.stats = CallStats()
+        self._session_counter = 0
+        self._lock = threading.Lock()
+
+    def _start(self, operation):
+        self.stats.record(operation)
+        if self.config.should_throttle():
+            time.sleep(self.config.latency_seconds() / 10)
+            raise throttling_error(operation)
+
+    def _session_id(self, kwargs):
+        if kwargs.get("sessionId"):
+            return kwargs["sessionId"]
+        with self._lock:
+            self._session_counter += 1
+            return f"fake-session-{self._session_counter}"
+
+    def _citations(self, prompt):
+        return [{
+            "generatedResponsePart": {"textResponsePart": {"text": prompt[:20]}},
+            "retrievedReferences": [{
+                "content": {"text": (f"Reference {i} for {prompt[:30]}. " * 50)[:self.config.reference_chars]},
+                "location": {"type": "S3", "s3Location": {"uri": f"s3://travel-docs/guide-{i}.pdf"}}
+            }]
+        } for i in range(self.config.citations)]
+
+    def retrieve(self, knowledgeBaseId, retrievalQuery, retrievalConfiguration=None, **kwargs):
+        self._start("Retrieve")
+        time.sleep(self.config.latency_seconds())
+        prompt = retrievalQuery["text"]
+        count = (retrievalConfiguration or {}).get("vectorSearchConfiguration", {}).get("numberOfResults", 5)
+        return {"retrievalResults": [{
+            "content": {"text": (f"Reference {i} for {prompt[:30]}. " * 50)[:self.config.reference_chars]},
+            "location": {"type": "S3", "s3Location": {"uri": f"s3://travel-docs/guide-{i}.pdf"}},
+            "score": round(1.0 - i / 100, 2)
+        } for i in range(count)]}
+
+    def retrieve_and_generate(self, input, retrieveAndGenerateConfiguration, **kwargs):
+        self._start("RetrieveAndGenerate")
+        time.sleep(self.config.latency_seconds())
+        prompt = input["text"]
+        return {"output": {"text": self.config.answer_text(prompt)},
+                "citations": self._citations(prompt),
+                "sessionId": self._session_id(kwargs)}
+
+    def retrieve_and_generate_stream(self, input, retrieveAndGenerateConfiguration, **kwargs):
+        self._start("RetrieveAndGenerateStream")
+        prompt = input["text"]
+        return {"stream": self._stream_events(prompt), "sessionId": self._session_id(kwargs)}
+
+    def _stream_events(self, prompt):
+        chunks = split_chunks(self.config.answer_text(prompt), self.config.stream_chunks)
+        per_chunk = max(self.config.latency_seconds() - self.config.first_token_ms / 1000, 0) / max(len(chunks), 1)
+        time.sleep(self.config.first_token_ms / 1000)
+        for chunk in chunks:
+            time.sleep(per_chunk)
+            yield {"output": {"text": chunk}}
+        for citation in self._citations(prompt):
+            yield {"citation": citation}
+
+
+def _matches(condition, item):
+    """Evaluates the subset of conditions Query/Scan use here: eq/lt/lte/gt/gte/between/begins_with joined by &."""
+    expression = condition.get_expression()
+    operator, values = expression["operator"], expression["values"]
+    if operator == "AND":
+        return all(_matches(value, item) for value in values)
+    actual = item.get(values[0].name)
+    if actual is None:
+        return False
+    if operator == "=":
+        return actual == values[1]
+    if operator == "<":
+        return actual < values[1]
+    if operator == "<=":
+        return actual <= values[1]
+    if operator == ">":
+        return actual > values[1]
+    if operator == ">=":
+        return actual >= values[1]
+    if operator == "BETWEEN":
+        return values[1] <= actual <= values[2]
+    if operator == "begins_with":
+        return str(actual).startswith(values[1])
+    raise NotImplementedError(f"Key condition operator {operator!r} is not supported by the fake")
+
+
+class FakeDynamoDBClient:
+    """The low-level client reached through Table.meta.client (batch_write_item only)."""
+
+    def __init__(self, tables):
+        self.tables = tables
+
+    def batch_write_item(self, RequestItems):
+        unprocessed = {}
+        for table_name, requests in RequestItems.items():
+            table = self.tables[table_name]
+            table.stats.record("BatchWriteItem")
+            time.sleep(table.config.latency_seconds())
+            for request in requests:
+                if table.config.should_throttle():
+                    unprocessed.setdefault(table_name, []).append(request)
+                else:
+                    table._store(request["PutRequest"]["Item"])
+        return {"UnprocessedItems": unprocessed}
+
+
+class FakeDynamoDBTable:
+    """Stand-in for a boto3 DynamoDB Table resource keyed by partition key + optional sort key (PutItem, GetItem, Query, Scan)."""
+
+    def __init__(self, name, partition_key, sort_key=None, config=None):
+        self.name = name
+        self.partition_key = partition_key
+        self.sort_key = sort_key
+        self.config = config or FakeServiceConfig(latency_ms=5, jitter_ms=2)
+        self.stats = CallStats()
+        self.items = {}
+        self._lock = threading.Lock()
+        self.meta = type("Meta", (), {})()
+        self.meta.client = FakeDynamoDBClient({name: self})
+
+    def _key(self, item):
+        return (item[self.partition_key], item.get(self.sort_key) if self.sort_key else None)
+
+    def _store(self, item):
+        with self._lock:
+            self.items[self._key(item)] = dict(item)
+
+    def put_item(self, Item, **kwargs):
+        self.stats.record("PutItem")
+        time.sleep(self.config.latency_seconds())
+        if self.config.should_throttle():
+            raise ClientError({"Error": {"Code": "ProvisionedThroughputExceededException", "Message": "Slow down"}}, "PutItem")
+        self._store(Item)
+        return {}
+
+    def get_item(self, Key, **kwargs):
+        self.stats.record("GetItem")
+        time.sleep(self.config.latency_seconds())
+        with self._lock:
+            item = self.items.get(self._key(Key))
+        return {"Item": dict(item)} if item else {}
+
+    def query(self, KeyConditionExpression, ScanIndexForward=True, Limit=None, ExclusiveStartKey=None,
+              ProjectionExpression=None, ExpressionAttributeNames=None, **kwargs):
+        """Key-condition query (boto3.dynamodb.conditions Key objects) with Limit/ExclusiveStartKey paging."""
+        self.stats.record("Query")
+        time.sleep(self.config.latency_seconds())
+        with self._lock:
+            matches = [dict(item) for item in self.items.values() if _matches(KeyConditionExpression, item)]
+        matches.sort(key=lambda item: item.get(self.sort_key), reverse=not ScanIndexForward)
+        if ExclusiveStartKey:
+            start = [self._key(item) for item in matches].index(self._key(ExclusiveStartKey)) + 1
+            matches = matches[start:]
+        response = {}
+        if Limit is not None and len(matches) >= Limit:
+            # Like DynamoDB, a page that fills Limit returns LastEvaluatedKey even if nothing follows it
+            matches = matches[:Limit]
+            last = matches[-1]
+            response["LastEvaluatedKey"] = {self.partition_key: last[self.partition_key], self.sort_key: last[self.sort_key]}
+        if ProjectionExpression:
+            names = [(ExpressionAttributeNames or {}).get(name.strip(), name.strip())
+                     for name in ProjectionExpression.split(",")]
+            matches = [{name: item[name] for name in names if name in item} for item in matches]
+        response["Items"] = matches
+        response["Count"] = len(matches)
+        return response
+
+    def scan(self, FilterExpression=None, Limit=None, ExclusiveStartKey=None, ProjectionExpression=None,
+             ExpressionAttributeNames=None, **kwargs):
+        """Full-table scan in key order; like DynamoDB, Limit caps the items read (before filtering) per page."""
+        self.stats.record("Scan")
+        time.sleep(self.config.latency_seconds())
+        with self._lock:
+            items = sorted((dict(item) for item in self.items.values()), key=self._key)
+        if ExclusiveStartKey:
+            start = [self._key(item) for item in items].index(self._key(ExclusiveStartKey)) + 1
+            items = items[start:]
+        response = {}
+        if Limit is not None and len(items) > Limit:
+            items = items[:Limit]
+            response["LastEvaluatedKey"] = {name: items[-1][name] for name in (self.partition_key, self.sort_key) if name}
+        response["ScannedCount"] = len(items)
+        if FilterExpression is not None:
+            items = [item for item in items if _matches(FilterExpression, item)]
+        if ProjectionExpression:
+            names = [(ExpressionAttributeNames or {}).get(name.strip(), name.strip())
+                     for name in ProjectionExpression.split(",")]
+            items = [{name: item[name] for name in names if name in item} for item in items]
+        response["Items"] = items
+        response["Count"] = len(items)
+        return response
+
+    def all_items(self):
+        with self._lock:
+            return [dict(item) for item in self.items.values()]
+
+
+class FakeApiGatewayManagementApi:
+    """Stand-in for the 'apigatewaymanagementapi' client used to push WebSocket frames."""
+
+    class exceptions:
+        class GoneException(Exception):
+            pass
+
+        class PayloadTooLargeException(Exception):
+            pass
+
+    MAX_PAYLOAD_BYTES = 128 * 1024
+
+    def __init__(self, config=None, keep_frames=False):
+        self.config = config or FakeServiceConfig(latency_ms=10, jitter_ms=3)
+        self.stats = CallStats()
+        self.keep_frames = keep_frames
+        self.frames = {} # connection_id -> [decoded frames], only if keep_frames
+        self.bytes_sent = 0
+        self._lock = threading.Lock()
+
+    def post_to_connection(self, ConnectionId, Data):
+        self.stats.record("PostToConnection")
+        time.sleep(self.config.latency_seconds())
+        data = Data if isinstance(Data, bytes) else Data.encode("utf-8")
+        if len(data) > self.MAX_PAYLOAD_BYTES:
+            raise self.exceptions.PayloadTooLargeException(f"Payload of {len(data)} bytes exceeds 128KB")
+        with self._lock:
+            self.bytes_sent += len(data)
+            if self.keep_frames:
+                self.frames.setdefault(ConnectionId, []).append(json.loads(data))
+        return {}
+
+
+class FakeLambdaContext:
+    """Minimal Lambda context object."""
+
+    def __init__(self, request_id, timeout_seconds=30):
+        self.aws_request_id = request_id
+        self._deadline = time.monotonic() + timeout_seconds
+
+    def get_remaining_time_in_millis(self):
+        return max(int((self._deadline - time.monotonic()) * 1000), 0)
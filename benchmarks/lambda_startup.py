@@ -0,0 +1,162 @@
+"""Cold-start benchmark for Lambda/sendMessage.py.
+
+Each run starts a fresh interpreter (a new "container"), imports the handler module and invokes it
+a few times against the local fakes in fakes.py. Reported per run:
+  import_ms            wall time of `import sendMessage` (everything Lambda bills as init)
+  imports_ms, init_ms  its split into module imports and resource setup (sendMessage.STARTUP_TIMINGS)
+  prewarm_ms           connection pre-warming during init (0 unless --prewarm)
+  first_invocation_ms  the first lambda_handler call, which pays for anything initialized lazily
+  warm_invocation_ms   median of the following calls
+The real boto3 clients are still created (so their cost is measured); only their calls go to fakes.
+Pass --baseline with an earlier results file to flag cold-start regressions.
+
+Example:
+    python benchmarks/lambda_startup.py --runs 10 --output startup.json
+    python benchmarks/lambda_startup.py --baseline startup.json --tolerance 0.2
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+REPO_ROOT = os.path.dirname(os.path.abspath(os.path.dirname(__file__)))
+METRICS = ("import_ms", "imports_ms", "init_ms", "prewarm_ms", "first_invocation_ms", "warm_invocation_ms")
+
+
+def child_environment(args):
+    env = dict(os.environ)
+    env.update({
+        "AWS_DEFAULT_REGION": "us-east-1",
+        "AWS_ACCESS_KEY_ID": "startup-benchmark", # Never used for a real call, but boto3 must not go looking
+        "AWS_SECRET_ACCESS_KEY": "startup-benchmark",
+        "KNOWLEDGE_BASE_ID": "bench-kb",
+        "MODEL_ARN": "arn:aws:bedrock:us-east-1::foundation-model/bench-model",
+        "CHAT_HISTORY_TABLE": "bench-chat-history",
+        "PREWARM_CONNECTIONS": "true" if args.prewarm else "false",
+        "METRICS_SAMPLE_RATE": "0",
+    })
+    return env
+
+
+def measure_one(args):
+    """Runs inside the child interpreter: one cold start followed by warm invocations."""
+    sys.path[:0] = [os.path.join(REPO_ROOT, "benchmarks"), os.path.join(REPO_ROOT, "backend"),
+                    os.path.join(REPO_ROOT, "Lambda")]
+    from fakes import (FakeApiGatewayManagementApi, FakeBedrockAgentRuntime, FakeDynamoDBTable,
+                       FakeLambdaContext, FakeServiceConfig)
+
+    with contextlib.redirect_stdout(io.StringIO()): # The Lambda logs with print()
+        started = time.perf_counter()
+        import sendMessage
+        import_ms = (time.perf_counter() - started) * 1000
+
+    config = FakeServiceConfig(latency_ms=args.latency_ms, jitter_ms=0, first_token_ms=args.latency_ms / 4)
+    api_gateway = FakeApiGatewayManagementApi(FakeServiceConfig(latency_ms=1, jitter_ms=0))
+    table = FakeDynamoDBTable("bench-chat-history", "chatId", "timestamp", FakeServiceConfig(latency_ms=1, jitter_ms=0))
+    sendMessage.bedrock_client = FakeBedrockAgentRuntime(config)
+    create_table = sendMessage.get_chat_history_table
+    # Build the real Table resource on first use so its cost is measured, but write to the fake
+    sendMessage.get_chat_history_table = lambda: (create_table(), table)[1]
+    create_client = sendMessage.new_api_gateway_client
+    # Build the real client so its creation cost is measured, but post frames to the fake
+    sendMessage.new_api_gateway_client = lambda endpoint_url: (create_client(endpoint_url), api_gateway)[1]
+
+    latencies = []
+    for i in range(args.invocations):
+        event = {
+            "requestContext": {"connectionId": f"conn-{i}", "domainName": "bench.local", "stage": "bench"},
+            "body": json.dumps({"message": f"startup benchmark question {i} about visiting Kyoto"})
+        }
+        with contextlib.redirect_stdout(io.StringIO()):
+            started = time.perf_counter()
+            sendMessage.lambda_handler(event, FakeLambdaContext(f"startup-{i}"))
+            latencies.append((time.perf_counter() - started) * 1000)
+
+    warm = sorted(latencies[1:])
+    return {
+        "import_ms": round(import_ms, 2),
+        **sendMessage.STARTUP_TIMINGS,
+        "first_invocation_ms": round(latencies[0], 2),
+        "warm_invocation_ms": round(warm[len(warm) // 2], 2) if warm else None,
+    }
+
+
+def run_cold_start(args):
+    command = [sys.executable, os.path.abspath(__file__), "--child", "--invocations", str(args.invocations),
+               "--latency-ms", str(args.latency_ms)] + (["--prewarm"] if args.prewarm else [])
+    output = subprocess.run(command, env=child_environment(args), check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def summarize(runs):
+    summary = {}
+    for metric in METRICS:
+        values = sorted(run[metric] for run in runs if run.get(metric) is not None)
+        if values:
+            summary[metric] = {"median": values[len(values) // 2], "min": values[0], "max": values[-1]}
+    return summary
+
+
+def compare(summary, baseline, tolerance):
+    """Returns human-readable regressions of the median timings against baseline."""
+    regressions = []
+    for metric, before in baseline.get("summary", {}).items():
+        after = summary.get(metric)
+        # A 1ms floor keeps tiny timings from flagging noise as a regression
+        if after and after["median"] > max(before["median"] * (1 + tolerance), before["median"] + 1):
+            regressions.append(f"{metric}: median {before['median']}ms -> {after['median']}ms")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5, help="Cold starts (fresh interpreters) to measure")
+    parser.add_argument("--invocations", type=int, default=5, help="Handler calls per cold start")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="Simulated Bedrock response time")
+    parser.add_argument("--prewarm", action="store_true",
+                        help="Keep PREWARM_CONNECTIONS on (without network access it runs until PREWARM_TIMEOUT_SECONDS)")
+    parser.add_argument("--output", default="startup_results.json", help="Where to write the JSON results")
+    parser.add_argument("--baseline", help="Earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.20, help="Allowed relative regression vs. baseline")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.child:
+        print(json.dumps(measure_one(args)))
+        return 0
+
+    runs = [run_cold_start(args) for _ in range(args.runs)]
+    summary = summarize(runs)
+    for metric, values in summary.items():
+        print(f"{metric:>20}  median={values['median']}ms  min={values['min']}ms  max={values['max']}ms")
+
+    report = {
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("baseline", "output", "child")},
+        "summary": summary,
+        "runs": runs,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(summary, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,157 @@
+"""Replay benchmark for answer cache prewarming (backend/prewarm.py).
+
+Seeds the fake chat history with a query log drawn from a Zipf-like distribution of travel questions
+(the last --log-days days, with the usual case/punctuation variations), then replays a fresh sample of
+the same distribution ("today's traffic") against /api/ask-kb twice: once with a cold answer cache and
+once after a prewarm pass. Reports the measured hit rate, latency and Bedrock calls of both replays
+next to the hit rate the prewarm report projected. Runs against the local fakes in fakes.py.
+
+Example:
+    python benchmarks/prewarm_replay.py --questions 300 --log-messages 5000 --top-k 100 --output prewarm.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+
+from run_benchmarks import build_fakes, configure_environment, load_backend, run_scenario
+
+TOPICS = ("Christmas markets", "best food markets", "cheap hotels", "day trips", "rainy day activities",
+          "family friendly things to do", "nightlife", "public transport passes", "museums", "hiking trails",
+          "vegetarian restaurants", "airport transfers")
+PLACES = ("Vienna", "Prague", "Kyoto", "Lisbon", "Barcelona", "Edinburgh", "Cape Town", "Lima", "Seoul",
+          "Marrakech", "Reykjavik", "Hanoi", "Quebec City", "Budapest", "Oaxaca")
+PHRASINGS = ("{topic} in {place}", "What are the {topic} in {place}?", "{topic} in {place}?", "{TOPIC} IN {PLACE}")
+
+
+def questions(count):
+    combos = [(topic, place) for place in PLACES for topic in TOPICS]
+    return combos[:count]
+
+
+def sample(rng, combos, skew):
+    """Picks a question with probability proportional to 1 / rank ** skew."""
+    weights = [1 / (rank + 1) ** skew for rank in range(len(combos))]
+    return lambda: rng.choices(combos, weights)[0]
+
+
+def phrase(rng, combo):
+    topic, place = combo
+    return rng.choice(PHRASINGS).format(topic=topic, place=place, TOPIC=topic.upper(), PLACE=place.upper())
+
+
+def seed_query_log(table, rng, draw, messages, days):
+    """Writes `messages` user questions (each followed by a bot reply) spread over the last `days` days."""
+    now_ms = int(time.time() * 1000)
+    for i in range(messages):
+        timestamp = now_ms - rng.randrange(int(days * 86400 * 1000))
+        chat_id = f"log-chat-{i % 500}"
+        table._store({"chatId": chat_id, "timestamp": timestamp, "sender": "user", "message": phrase(rng, draw())})
+        table._store({"chatId": chat_id, "timestamp": timestamp + 1, "sender": "bot", "message": "An answer."})
+
+
+def replay(backend, fake_agent, prompts, concurrency):
+    """Sends prompts to /api/ask-kb; returns the latency summary plus hit rate and upstream calls."""
+    local = threading.local()
+    hits = []
+
+    def ask(i):
+        if not hasattr(local, "client"):
+            local.client = backend.app.test_client()
+        response = local.client.post('/api/ask-kb', json={"message": prompts[i]})
+        hits.append(response.headers.get("X-Cache", "").startswith("HIT"))
+        return response.status_code == 200
+
+    calls_before = sum(fake_agent.stats.calls.values())
+    result = run_scenario("ask-kb", ask, concurrency, len(prompts))
+    result["hit_rate"] = round(sum(hits) / len(hits), 4) if hits else 0.0
+    result["bedrock_calls"] = sum(fake_agent.stats.calls.values()) - calls_before
+    return result
+
+
+def reset_answer_cache(backend):
+    backend.answer_cache = backend.AnswerCache(backend.LRUCache(backend.ANSWER_CACHE_SIZE, ttl_seconds=backend.ANSWER_CACHE_TTL_SECONDS),
+                                               logger=backend.app.logger)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--questions", type=int, default=len(TOPICS) * len(PLACES), help="Distinct questions in the distribution")
+    parser.add_argument("--skew", type=float, default=1.1, help="Zipf exponent of question popularity")
+    parser.add_argument("--log-messages", type=int, default=5000, help="User messages seeded into the query log")
+    parser.add_argument("--log-days", type=float, default=14.0)
+    parser.add_argument("--requests", type=int, default=400, help="Replayed /api/ask-kb requests")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--top-k", type=int, default=100, help="Questions the prewarm pass may answer")
+    parser.add_argument("--latency-ms", type=float, default=50.0, help="Simulated Bedrock response time")
+    parser.add_argument("--jitter-ms", type=float, default=10.0)
+    parser.add_argument("--output-chars", type=int, default=800)
+    parser.add_argument("--dynamodb-latency-ms", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", default="prewarm_results.json", help="Where to write the JSON results")
+    args = parser.parse_args(argv)
+    # Settings the shared run_benchmarks helpers expect
+    args.concurrency_levels = [args.concurrency]
+    args.rate_limit = 1000.0
+    args.first_token_ms = args.latency_ms / 4
+    args.throttle_rate = 0.0
+    args.stream_chunks = 20
+    args.apigw_latency_ms = 1.0
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_environment(args)
+    os.environ.setdefault("PREWARM_RATE_PER_SECOND", "0") # No pacing: nothing else competes with the fakes
+    os.environ.setdefault("PREWARM_MAX_CALLS", str(args.top_k))
+    fakes = build_fakes(args)
+    with contextlib.redirect_stdout(io.StringIO()):
+        backend = load_backend(fakes)
+
+    rng = random.Random(args.seed)
+    combos = questions(args.questions)
+    draw = sample(rng, combos, args.skew)
+    seed_query_log(fakes["chat_history_table"], rng, draw, args.log_messages, args.log_days)
+    todays_prompts = [phrase(rng, draw()) for _ in range(args.requests)]
+
+    reset_answer_cache(backend)
+    cold = replay(backend, fakes["bedrock_agent_runtime"], todays_prompts, args.concurrency)
+
+    reset_answer_cache(backend)
+    prewarm_calls_before = sum(fakes["bedrock_agent_runtime"].stats.calls.values())
+    prewarm = backend.run_prewarm(args.top_k)
+    prewarm_calls = sum(fakes["bedrock_agent_runtime"].stats.calls.values()) - prewarm_calls_before
+    warm = replay(backend, fakes["bedrock_agent_runtime"], todays_prompts, args.concurrency)
+
+    for label, result in (("cold", cold), ("prewarmed", warm)):
+        latency = result["latency_ms"]
+        print(f"{label:>10}  hit rate={result['hit_rate']:<7} p50={latency['p50']}ms p95={latency['p95']}ms "
+              f"bedrock calls={result['bedrock_calls']} errors={result['errors']}")
+    print(f"   prewarm  warmed={prewarm['warmed']} in {prewarm['duration_seconds']}s ({prewarm_calls} bedrock calls), "
+          f"projected hit rate {prewarm['hit_rate']['weighted']['before']} -> {prewarm['hit_rate']['weighted']['after']}, "
+          f"measured gain {round(warm['hit_rate'] - cold['hit_rate'], 4)}")
+
+    report = {
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k != "output"},
+        "cold": cold,
+        "prewarmed": warm,
+        "hit_rate_gain": round(warm["hit_rate"] - cold["hit_rate"], 4),
+        "prewarm": {**{k: v for k, v in prewarm.items() if k != "queries"}, "bedrock_calls": prewarm_calls},
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,268 @@
+"""Offline benchmark harness for backend/app.py and Lambda/sendMessage.py.
+
+Drives /api/chat, /api/ask-kb, /api/history and lambda_handler at fixed concurrency levels against the local
+fakes in fakes.py (no AWS access needed), reports throughput and p50/p95/p99 latency, and writes
+the results as JSON. Pass --baseline with an earlier results file to flag regressions.
+
+Example:
+    python benchmarks/run_benchmarks.py --concurrency 1,8,32 --requests 200 --output bench.json
+    python benchmarks/run_benchmarks.py --baseline bench.json --tolerance 0.15
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fakes import (FakeApiGatewayManagementApi, FakeBedrockAgentRuntime, FakeBedrockRuntime,
+                   FakeDynamoDBTable, FakeLambdaContext, FakeServiceConfig)
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("chat", "ask-kb", "history", "lambda")
+HISTORY_CHATS = 50 # Chats seeded into the fake history table for the history scenario
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(int(round(pct / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarize(scenario, concurrency, latencies, errors, duration):
+    latencies_ms = sorted(latency * 1000 for latency in latencies)
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": len(latencies),
+        "errors": errors,
+        "duration_s": round(duration, 3),
+        "throughput_rps": round(len(latencies) / duration, 2) if duration else None,
+        "latency_ms": {
+            "mean": round(sum(latencies_ms) / len(latencies_ms), 2) if latencies_ms else None,
+            "p50": round(percentile(latencies_ms, 50), 2) if latencies_ms else None,
+            "p95": round(percentile(latencies_ms, 95), 2) if latencies_ms else None,
+            "p99": round(percentile(latencies_ms, 99), 2) if latencies_ms else None,
+            "max": round(latencies_ms[-1], 2) if latencies_ms else None,
+        }
+    }
+
+
+def run_scenario(scenario, call, concurrency, requests):
+    """Runs call(i) for i in range(requests) on `concurrency` threads. call returns True on success."""
+    def timed(i):
+        started = time.perf_counter()
+        try:
+            ok = call(i)
+        except Exception:
+            ok = False
+        return time.perf_counter() - started, ok
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(timed, range(requests)))
+    duration = time.perf_counter() - started
+    return summarize(scenario, concurrency, [latency for latency, _ in outcomes],
+                     sum(1 for _, ok in outcomes if not ok), duration)
+
+
+def configure_environment(args):
+    """Sets the env vars both entry points read at import time (existing values win)."""
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.setdefault("AWS_REGION", "us-east-1")
+    os.environ.setdefault("BEDROCK_KNOWLEDGE_BASE_ID", "bench-kb")
+    os.environ.setdefault("KNOWLEDGE_BASE_ID", "bench-kb")
+    os.environ.setdefault("MODEL_ARN", "arn:aws:bedrock:us-east-1::foundation-model/bench-model")
+    os.environ.setdefault("CHAT_HISTORY_TABLE", "bench-chat-history")
+    os.environ.setdefault("HISTORY_API_TOKEN", "bench-history-token")
+    # The client-side rate limiter would otherwise cap the measured throughput
+    os.environ.setdefault("BEDROCK_RATE_LIMIT", str(args.rate_limit))
+    os.environ.setdefault("BEDROCK_RATE_BURST", str(int(args.rate_limit)))
+    os.environ.setdefault("BEDROCK_MAX_RATE_LIMIT", str(args.rate_limit))
+    os.environ.setdefault("BEDROCK_MAX_QUEUE", str(max(args.concurrency_levels) * 4))
+    os.environ.setdefault("BEDROCK_MAX_POOL_CONNECTIONS", str(max(args.concurrency_levels)))
+    sys.path[:0] = [os.path.join(REPO_ROOT, "backend"), os.path.join(REPO_ROOT, "Lambda")]
+
+
+def build_fakes(args):
+    bedrock_config = FakeServiceConfig(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                                       first_token_ms=args.first_token_ms, throttle_rate=args.throttle_rate,
+                                       output_chars=args.output_chars, stream_chunks=args.stream_chunks,
+                                       seed=args.seed)
+    return {
+        "bedrock_runtime": FakeBedrockRuntime(bedrock_config),
+        "bedrock_agent_runtime": FakeBedrockAgentRuntime(bedrock_config),
+        "chat_history_table": FakeDynamoDBTable(os.environ["CHAT_HISTORY_TABLE"], "chatId", "timestamp",
+                                                FakeServiceConfig(latency_ms=args.dynamodb_latency_ms,
+                                                                  jitter_ms=args.dynamodb_latency_ms / 4)),
+        "api_gateway": FakeApiGatewayManagementApi(FakeServiceConfig(latency_ms=args.apigw_latency_ms,
+                                                                     jitter_ms=args.apigw_latency_ms / 4)),
+    }
+
+
+def load_backend(fakes):
+    import app as backend
+    backend.app.logger.setLevel("ERROR")
+    backend.bedrock_runtime = fakes["bedrock_runtime"]
+    backend.bedrock_agent_runtime = fakes["bedrock_agent_runtime"]
+    backend.history_reader.table = fakes["chat_history_table"]
+    return backend
+
+
+def seed_history(table, messages_per_chat):
+    """Writes HISTORY_CHATS conversations of messages_per_chat messages in the Lambda's item format."""
+    started_ms = int(time.time() * 1000) - HISTORY_CHATS * messages_per_chat
+    for chat in range(HISTORY_CHATS):
+        for i in range(messages_per_chat):
+            table._store({"chatId": f"history-chat-{chat}", "timestamp": started_ms + i,
+                          "sender": "user" if i % 2 == 0 else "bot", "message": f"Message {i} about Kyoto in spring"})
+
+
+def load_lambda(fakes):
+    os.environ.setdefault("PREWARM_CONNECTIONS", "false") # Pre-warming would try to reach AWS
+    import sendMessage
+    sendMessage.bedrock_client = fakes["bedrock_agent_runtime"]
+    sendMessage.chat_history_table = fakes["chat_history_table"]
+    sendMessage.history_writer.table = fakes["chat_history_table"]
+    # The handler gets its API Gateway client from a per-endpoint cache filled by new_api_gateway_client
+    sendMessage.new_api_gateway_client = lambda endpoint_url: fakes["api_gateway"]
+    return sendMessage
+
+
+def make_callers(args, backend, lambda_module):
+    local = threading.local()
+
+    def client():
+        if not hasattr(local, "client"):
+            local.client = backend.app.test_client()
+        return local.client
+
+    def prompt(run, i):
+        # Run-specific prompts keep caches from leaking between scenarios and concurrency levels
+        return f"{run} benchmark question {i % args.distinct_prompts} about visiting Kyoto in spring"
+
+    def chat(run, i):
+        return client().post('/api/chat', json={"message": prompt(run, i)}).status_code == 200
+
+    def ask_kb(run, i):
+        return client().post('/api/ask-kb', json={"message": prompt(run, i)}).status_code == 200
+
+    def history(run, i):
+        # A session reload: the newest page (mostly served from the recent-window cache), then one older page
+        chat_id = f"history-chat-{i % HISTORY_CHATS}"
+        headers = {"Authorization": f"Bearer {os.environ['HISTORY_API_TOKEN']}"}
+        response = client().get(f'/api/history/{chat_id}?limit=20', headers=headers)
+        if response.status_code != 200:
+            return False
+        cursor = response.get_json()["next_cursor"]
+        return not cursor or client().get(f'/api/history/{chat_id}?limit=20&cursor={cursor}',
+                                          headers=headers).status_code == 200
+
+    def invoke_lambda(run, i):
+        event = {
+            "requestContext": {"connectionId": f"{run}-conn-{i}", "domainName": "bench.local", "stage": "bench"},
+            "body": json.dumps({"message": prompt(run, i)})
+        }
+        return lambda_module.lambda_handler(event, FakeLambdaContext(f"{run}-{i}"))["statusCode"] == 200
+
+    return {"chat": chat, "ask-kb": ask_kb, "history": history, "lambda": invoke_lambda}
+
+
+def compare(results, baseline, tolerance):
+    """Returns human-readable regressions of results against baseline."""
+    previous = {(r["scenario"], r["concurrency"]): r for r in baseline.get("results", [])}
+    regressions = []
+    for result in results:
+        before = previous.get((result["scenario"], result["concurrency"]))
+        if not before:
+            continue
+        label = f"{result['scenario']} @ concurrency {result['concurrency']}"
+        if result["latency_ms"]["p95"] > before["latency_ms"]["p95"] * (1 + tolerance):
+            regressions.append(f"{label}: p95 {before['latency_ms']['p95']}ms -> {result['latency_ms']['p95']}ms")
+        if result["throughput_rps"] < before["throughput_rps"] * (1 - tolerance):
+            regressions.append(f"{label}: throughput {before['throughput_rps']} -> {result['throughput_rps']} req/s")
+        if result["errors"] > before["errors"]:
+            regressions.append(f"{label}: errors {before['errors']} -> {result['errors']}")
+    return regressions
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma-separated subset of: " + ", ".join(SCENARIOS))
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per scenario and concurrency level")
+    parser.add_argument("--distinct-prompts", type=int, default=None,
+                        help="Size of the prompt pool (default: every request unique, so caches never hit)")
+    parser.add_argument("--latency-ms", type=float, default=200.0, help="Simulated Bedrock response time")
+    parser.add_argument("--jitter-ms", type=float, default=50.0)
+    parser.add_argument("--first-token-ms", type=float, default=50.0)
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="Probability a Bedrock call is throttled")
+    parser.add_argument("--output-chars", type=int, default=800, help="Size of each generated answer")
+    parser.add_argument("--stream-chunks", type=int, default=20)
+    parser.add_argument("--dynamodb-latency-ms", type=float, default=5.0)
+    parser.add_argument("--apigw-latency-ms", type=float, default=10.0)
+    parser.add_argument("--history-messages", type=int, default=120, help="Messages per chat seeded for the history scenario")
+    parser.add_argument("--rate-limit", type=float, default=1000.0, help="Client-side Bedrock rate limit (req/s)")
+    parser.add_argument("--seed", type=int, default=1234)
+    parser.add_argument("--output", default="bench_results.json", help="Where to write the JSON results")
+    parser.add_argument("--baseline", help="Earlier results file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="Allowed relative regression vs. baseline")
+    args = parser.parse_args(argv)
+    args.scenario_list = [s for s in args.scenarios.split(",") if s]
+    args.concurrency_levels = [int(c) for c in args.concurrency.split(",") if c]
+    args.distinct_prompts = args.distinct_prompts or args.requests
+    unknown = set(args.scenario_list) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_environment(args)
+    fakes = build_fakes(args)
+    with contextlib.redirect_stdout(io.StringIO()): # The Lambda logs with print()
+        backend = load_backend(fakes)
+        lambda_module = load_lambda(fakes)
+    callers = make_callers(args, backend, lambda_module)
+    seed_history(fakes["chat_history_table"], args.history_messages)
+
+    results = []
+    for scenario in args.scenario_list:
+        for concurrency in args.concurrency_levels:
+            with contextlib.redirect_stdout(io.StringIO()):
+                run = f"{scenario}-c{concurrency}"
+                result = run_scenario(scenario, lambda i: callers[scenario](run, i), concurrency, args.requests)
+            results.append(result)
+            latency = result["latency_ms"]
+            print(f"{scenario:>8} c={concurrency:<4} {result['throughput_rps']:>9} req/s  "
+                  f"p50={latency['p50']}ms p95={latency['p95']}ms p99={latency['p99']}ms errors={result['errors']}")
+
+    report = {
+        "generated_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("baseline", "output")},
+        "upstream_calls": {name: fake.stats.calls for name, fake in fakes.items()},
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,75 @@
+import os
+import sys
+
+import pytest
+
+# The backend, the Lambda function and the AWS fakes are plain modules rather than installed packages,
+# so the tests import them the way the benchmarks do. Every AWS client is replaced by a fake from
+# benchmarks/fakes.py; the env vars below only satisfy the import-time configuration.
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(REPO_ROOT, "backend"), os.path.join(REPO_ROOT, "Lambda"),
+                os.path.join(REPO_ROOT, "benchmarks")]
+
+for name, value in {
+    "AWS_DEFAULT_REGION": "us-east-1",
+    "AWS_REGION": "us-east-1",
+    "AWS_ACCESS_KEY_ID": "testing",
+    "AWS_SECRET_ACCESS_KEY": "testing",
+    "KNOWLEDGE_BASE_ID": "test-kb",
+    "BEDROCK_KNOWLEDGE_BASE_ID": "test-kb",
+    "MODEL_ARN": "arn:aws:bedrock:us-east-1::foundation-model/test-model",
+    "CHAT_HISTORY_TABLE": "test-chat-history",
+    "PREWARM_CONNECTIONS": "false",
+    "METRICS_SAMPLE_RATE": "0",
+}.items():
+    os.environ.setdefault(name, value)
+
+from fakes import FakeBedrockRuntime, FakeDynamoDBTable, FakeServiceConfig
+
+
+def fast_config(**overrides):
+    """A FakeServiceConfig without simulated latency."""
+    return FakeServiceConfig(**{"latency_ms": 0.0, "jitter_ms": 0.0, "first_token_ms": 0.0, "seed": 1, **overrides})
+
+
+@pytest.fixture
+def backend(monkeypatch):
+    """backend/app.py with a fake bedrock-runtime client and a fresh model router."""
+    import app
+    from model_router import ModelRouter
+    monkeypatch.setattr(app, "bedrock_runtime", FakeBedrockRuntime(fast_config()))
+    monkeypatch.setattr(app, "model_router", ModelRouter(app.MODEL_TIERS))
+    return app
+
+
+@pytest.fixture
+def split_backend(backend, monkeypatch):
+    """backend/app.py in RETRIEVAL_MODE=split against a fake Knowledge Base, with empty caches."""
+    from answer_cache import AnswerCache, LRUCache
+    from fakes import FakeBedrockAgentRuntime
+    from retrieval import RetrievalCache
+    monkeypatch.setattr(backend, "bedrock_agent_runtime", FakeBedrockAgentRuntime(fast_config(reference_chars=400)))
+    monkeypatch.setattr(backend, "local_index", None)
+    monkeypatch.setattr(backend, "retrieval_source", f"kb:{backend.KNOWLEDGE_BASE_ID}")
+    monkeypatch.setattr(backend, "retrieval_cache", RetrievalCache())
+    monkeypatch.setattr(backend, "answer_cache", AnswerCache(LRUCache(64)))
+    return backend
+
+
+@pytest.fixture
+def history_table():
+    return FakeDynamoDBTable(os.environ["CHAT_HISTORY_TABLE"], "chatId", "timestamp", fast_config())
+
+
+@pytest.fixture
+def send_message(monkeypatch, history_table):
+    """Lambda/sendMessage.py with its AWS clients replaced by fakes; history goes to history_table."""
+    import sendMessage
+    from fakes import FakeApiGatewayManagementApi, FakeBedrockAgentRuntime
+    api_gateway = FakeApiGatewayManagementApi(fast_config(), keep_frames=True)
+    monkeypatch.setattr(sendMessage, "bedrock_client", FakeBedrockAgentRuntime(fast_config()))
+    monkeypatch.setattr(sendMessage, "chat_history_table", history_table)
+    monkeypatch.setattr(sendMessage, "history_writer", sendMessage.HistoryWriter(history_table, sleep=lambda seconds: None))
+    monkeypatch.setattr(sendMessage, "new_api_gateway_client", lambda endpoint_url: api_gateway)
+    monkeypatch.setattr(sendMessage, "api_gateway_clients", sendMessage.LRUCache(4))
+    return sendMessage
@@ -0,0 +1,71 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionClass, AdmissionController, Overloaded
+
+
+def controller(max_concurrent=1, max_queue=4, deadline=5.0):
+    return AdmissionController([AdmissionClass("chat", max_concurrent=max_concurrent, max_queue=max_queue,
+                                               queue_deadline_seconds=deadline, expected_service_seconds=0.01)])
+
+
+def test_queue_full_is_shed():
+    admission = controller(max_queue=0)
+    admission.acquire("chat", "client-a")
+    with pytest.raises(Overloaded) as error:
+        admission.acquire("chat", "client-b")
+    assert error.value.reason == "queue_full" and admission.stats()["chat_shed"] == 1
+
+
+def test_cancelled_waiter_leaves_the_queue():
+    admission = controller()
+
+    async def scenario():
+        ticket = await admission.acquire_async("chat", "client-a")
+        waiting = asyncio.create_task(admission.acquire_async("chat", "client-b"))
+        await asyncio.sleep(0.01)
+        assert admission.stats()["chat_queue_length"] == 1
+        waiting.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        admission.release(ticket)
+
+    asyncio.run(scenario())
+    stats = admission.stats()
+    assert stats["chat_queue_length"] == 0 and stats["chat_cancelled"] == 1
+    assert stats["running"] == 0 and stats["chat_running"] == 0
+
+
+def test_slot_granted_before_the_cancellation_is_released():
+    admission = controller()
+
+    async def scenario():
+        ticket = await admission.acquire_async("chat", "client-a")
+        waiting = asyncio.create_task(admission.acquire_async("chat", "client-b"))
+        third = asyncio.create_task(admission.acquire_async("chat", "client-c"))
+        await asyncio.sleep(0.01)
+        waiting.cancel()          # client-b's cancellation is pending...
+        admission.release(ticket) # ...when the freed slot is handed to it
+        with pytest.raises(asyncio.CancelledError):
+            await waiting
+        # The slot went on to the next waiter instead of leaking
+        admission.release(await asyncio.wait_for(third, 1))
+
+    asyncio.run(scenario())
+    stats = admission.stats()
+    assert stats["running"] == 0 and stats["chat_running"] == 0 and stats["chat_queue_length"] == 0
+    assert stats["chat_admitted"] == 3
+
+
+def test_async_waiter_times_out():
+    admission = controller(deadline=0.05)
+
+    async def scenario():
+        await admission.acquire_async("chat", "client-a")
+        with pytest.raises(Overloaded) as error:
+            await admission.acquire_async("chat", "client-b")
+        return error.value
+
+    assert asyncio.run(scenario()).reason == "timed_out"
+    assert admission.stats()["chat_timed_out"] == 1 and admission.stats()["chat_queue_length"] == 0
@@ -0,0 +1,47 @@
+from answer_cache import AnswerCache, InMemoryAnswerStore, LRUCache
+
+
+class FakeClock:
+    def __init__(self, now=1000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_lru_entries_expire_after_ttl():
+    clock = FakeClock()
+    cache = LRUCache(4, ttl_seconds=60, clock=clock)
+    cache.put("kyoto", "answer")
+    clock.now += 59
+    assert cache.get("kyoto") == "answer" and "kyoto" in cache
+    clock.now += 1
+    assert cache.get("kyoto") is None and "kyoto" not in cache
+    assert len(cache) == 0
+
+
+def test_lru_without_ttl_keeps_entries():
+    clock = FakeClock()
+    cache = LRUCache(2, clock=clock)
+    cache.put("a", 1)
+    clock.now += 10 ** 9
+    assert cache.get("a") == 1
+
+
+def test_lru_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3)
+    assert "b" not in cache and cache.get("a") == 1 and cache.evictions == 1
+
+
+def test_local_tier_expires_with_the_shared_tier():
+    clock = FakeClock()
+    cache = AnswerCache(LRUCache(4, ttl_seconds=60, clock=clock), InMemoryAnswerStore(ttl_seconds=60, clock=clock))
+    cache.put("key", {"answer": "Visit in spring."})
+    assert cache.get("key") == ({"answer": "Visit in spring."}, "HIT-LOCAL")
+    clock.now += 60
+    assert cache.get("key") == (None, "MISS")
+    assert not cache.contains("key")
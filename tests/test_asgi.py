@@ -0,0 +1,83 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from admission import AdmissionClass, AdmissionController
+from conftest import fast_config
+from fakes import FakeBedrockAgentRuntime
+
+
+@pytest.fixture
+def asgi_client(backend, monkeypatch):
+    """A TestClient for asgi.app on a fresh executor, answering /api/ask-kb from a fake Knowledge Base."""
+    from answer_cache import AnswerCache, LRUCache
+    from starlette.testclient import TestClient
+    import asgi
+    monkeypatch.setattr(asgi, "bedrock_executor", ThreadPoolExecutor(max_workers=4))
+    monkeypatch.setattr(backend, "bedrock_agent_runtime", FakeBedrockAgentRuntime(fast_config(citations=3, reference_chars=800)))
+    monkeypatch.setattr(backend, "retrieval_source", None)
+    monkeypatch.setattr(backend, "answer_cache", AnswerCache(LRUCache(64)))
+    return TestClient(asgi.app)
+
+
+def test_chat_replies_and_continues_the_session(asgi_client):
+    first = asgi_client.post("/api/chat", json={"message": "Best time to visit Kyoto?"})
+    assert first.status_code == 200
+    body = first.json()
+    assert body["reply"] and body["session_id"]
+    assert int(first.headers["X-Payload-Bytes"]) == len(first.content)
+
+    second = asgi_client.post("/api/chat", json={"message": "And Osaka?", "session_id": body["session_id"]})
+    assert second.status_code == 200 and second.json()["session_id"] == body["session_id"]
+
+
+@pytest.mark.parametrize("kwargs, status", [
+    ({"content": "hello", "headers": {"Content-Type": "text/plain"}}, 415),
+    ({"content": "{not json", "headers": {"Content-Type": "application/json"}}, 400),
+    ({"json": {"text": "no message field"}}, 400),
+])
+def test_chat_validation_matches_flask(asgi_client, backend, kwargs, status):
+    response = asgi_client.post("/api/chat", **kwargs)
+    assert response.status_code == status and "error" in response.json()
+    flask_kwargs = {"data": kwargs["content"], "headers": kwargs["headers"]} if "content" in kwargs else kwargs
+    assert backend.app.test_client().post("/api/chat", **flask_kwargs).status_code == status
+
+
+def test_ask_kb_is_cached_and_compressed(asgi_client):
+    first = asgi_client.post("/api/ask-kb", json={"message": "Kyoto temples?"}, headers={"Accept-Encoding": "gzip"})
+    assert first.status_code == 200 and first.headers["X-Cache"] == "MISS"
+    assert first.headers["Content-Encoding"] == "gzip" and "Accept-Encoding" in first.headers["Vary"]
+    body = first.json() # The test client decodes gzip transparently
+    assert body["reply"] and body["references"] and body["citations"]
+    assert int(first.headers["X-Payload-Bytes"]) == len(json.dumps(body, separators=(",", ":")).encode("utf-8"))
+
+    second = asgi_client.post("/api/ask-kb", json={"message": "kyoto temples?"})
+    assert second.headers["X-Cache"] == "HIT-LOCAL" and second.json()["reply"] == body["reply"]
+    bypass = asgi_client.post("/api/ask-kb", json={"message": "Kyoto temples?"}, headers={"X-Cache-Bypass": "1"})
+    assert bypass.headers["X-Cache"] == "BYPASS"
+
+
+def test_ask_kb_without_a_knowledge_base(asgi_client, backend, monkeypatch):
+    monkeypatch.setattr(backend, "KNOWLEDGE_BASE_ID", None)
+    response = asgi_client.post("/api/ask-kb", json={"message": "Kyoto temples?"})
+    assert response.status_code == 501
+
+
+def test_busy_reply_matches_flask(asgi_client, monkeypatch):
+    import asgi
+    monkeypatch.setattr(asgi, "ASGI_MAX_PENDING_REQUESTS", 0)
+    response = asgi_client.post("/api/chat", json={"message": "Best time to visit Kyoto?"})
+    assert response.status_code == 503 and response.headers["Retry-After"] == "1"
+    assert response.json() == {"error": asgi.backend.SERVER_BUSY_MESSAGE}
+
+
+def test_requests_over_the_admission_limit_are_shed(asgi_client, backend, monkeypatch):
+    admission = AdmissionController([AdmissionClass("chat", max_concurrent=1, max_queue=0)])
+    monkeypatch.setattr(backend, "admission", admission)
+    ticket = admission.acquire("chat", "someone-else")
+    response = asgi_client.post("/api/chat", json={"message": "Best time to visit Kyoto?"})
+    assert response.status_code == 503 and "Retry-After" in response.headers
+    admission.release(ticket)
+    assert asgi_client.post("/api/chat", json={"message": "Best time to visit Kyoto?"}).status_code == 200
+    assert admission.stats()["running"] == 0
@@ -0,0 +1,103 @@
+import json
+
+import pytest
+from botocore.exceptions import ClientError
+
+from conftest import fast_config
+from fakes import FakeBedrockAgentRuntime
+
+
+class RejectingRuntime:
+    """Wraps a fake bedrock-runtime client so prompts containing "FAIL" are rejected."""
+
+    def __init__(self, runtime):
+        self.runtime = runtime
+
+    def invoke_model(self, body, **kwargs):
+        if b"FAIL" in body:
+            raise ClientError({"Error": {"Code": "ValidationException", "Message": "Bad prompt"}}, "InvokeModel")
+        return self.runtime.invoke_model(body=body, **kwargs)
+
+
+@pytest.fixture
+def kb_backend(backend, monkeypatch):
+    from answer_cache import AnswerCache, LRUCache
+    monkeypatch.setattr(backend, "bedrock_agent_runtime", FakeBedrockAgentRuntime(fast_config()))
+    monkeypatch.setattr(backend, "retrieval_source", None)
+    monkeypatch.setattr(backend, "answer_cache", AnswerCache(LRUCache(64)))
+    return backend
+
+
+def post_batch(backend, **body):
+    response = backend.app.test_client().post("/api/batch", json=body)
+    data = response.get_data()
+    response.close() # Ends the stream, which frees the batch's admission slot
+    if response.status_code != 200:
+        return response, None, None
+    lines = [json.loads(line) for line in data.decode("utf-8").splitlines()]
+    return response, lines[:-1], lines[-1]
+
+
+def test_results_stream_as_ndjson_with_a_summary_last(backend):
+    prompts = [f"Question {i}?" for i in range(10)]
+    response, results, summary = post_batch(backend, prompts=prompts, concurrency=4)
+    assert response.status_code == 200 and response.mimetype == "application/x-ndjson"
+    assert sorted(result["index"] for result in results) == list(range(10))
+    assert all(result["prompt"] == prompts[result["index"]] and result["ok"] and result["reply"] for result in results)
+    assert summary["summary"]["total"] == 10 and summary["summary"]["succeeded"] == 10
+    assert summary["summary"]["concurrency"] == 4
+
+
+def test_one_at_a_time_keeps_prompt_order(backend):
+    _, results, _ = post_batch(backend, prompts=["a?", "b?", "c?"], concurrency=1)
+    assert [result["index"] for result in results] == [0, 1, 2]
+
+
+def test_failed_items_get_an_error_record(backend, monkeypatch):
+    monkeypatch.setattr(backend, "bedrock_runtime", RejectingRuntime(backend.bedrock_runtime))
+    _, results, summary = post_batch(backend, prompts=["Fine?", "Please FAIL", "Also fine?"])
+    failed = [result for result in results if not result["ok"]]
+    assert [result["index"] for result in failed] == [1] and failed[0]["error"] and "reply" not in failed[0]
+    assert summary["summary"]["succeeded"] == 2 and summary["summary"]["failed"] == 1
+
+
+def test_run_batch_item_never_raises(backend, monkeypatch):
+    def explode(*args, **kwargs):
+        raise RuntimeError("boom")
+    monkeypatch.setattr(backend, "invoke_bedrock_model", explode)
+    result = backend.run_batch_item(3, "Question?", "direct", bypass_cache=False)
+    assert result["index"] == 3 and not result["ok"] and "boom" in result["error"]
+    assert result["latency_ms"] >= 0
+
+
+@pytest.mark.parametrize("body, error", [
+    ({"prompts": []}, "non-empty list"),
+    ({"prompts": ["ok", ""]}, "non-empty string"),
+    ({"prompts": ["ok"], "mode": "fast"}, "'mode'"),
+    ({"prompts": ["ok"], "concurrency": "many"}, "'concurrency'"),
+])
+def test_invalid_batches_are_rejected(backend, body, error):
+    response, _, _ = post_batch(backend, **body)
+    assert response.status_code == 400 and error in response.get_json()["error"]
+
+
+def test_batch_size_is_limited(backend, monkeypatch):
+    monkeypatch.setattr(backend, "BATCH_MAX_PROMPTS", 3)
+    response, _, _ = post_batch(backend, prompts=["a", "b", "c", "d"])
+    assert response.status_code == 400 and "limit 3" in response.get_json()["error"]
+    response, results, _ = post_batch(backend, prompts=["a", "b", "c"])
+    assert response.status_code == 200 and len(results) == 3
+
+
+def test_concurrency_is_capped(backend, monkeypatch):
+    monkeypatch.setattr(backend, "BATCH_MAX_CONCURRENCY", 2)
+    _, _, summary = post_batch(backend, prompts=["a", "b", "c"], concurrency=50)
+    assert summary["summary"]["concurrency"] == 2
+
+
+def test_kb_items_report_their_cache_status(kb_backend):
+    _, results, _ = post_batch(kb_backend, prompts=["Kyoto temples?", "kyoto temples?"], mode="kb", concurrency=1)
+    assert [result["cache"] for result in results] == ["MISS", "HIT-LOCAL"]
+    assert all(result["ok"] and "citations" in result for result in results)
+    _, results, _ = post_batch(kb_backend, prompts=["Kyoto temples?"], mode="kb", bypass_cache=True)
+    assert results[0]["cache"] == "BYPASS"
@@ -0,0 +1,162 @@
+import pytest
+
+from bedrock_scheduler import AdaptiveTokenBucket, BedrockScheduler, LoadShedError
+from fakes import FakeLambdaContext
+
+
+class FakeClock:
+    """Manual clock; sleep() advances it instead of blocking."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class Throttled(Exception):
+    def __init__(self, code="ThrottlingException"):
+        super().__init__(code)
+        self.response = {"Error": {"Code": code}}
+
+
+def scheduler(clock, rate=10.0, burst=20, **overrides):
+    bucket = AdaptiveTokenBucket(rate=rate, burst=burst, clock=clock, sleep=clock.sleep)
+    return BedrockScheduler(bucket, clock=clock, sleep=clock.sleep, **overrides)
+
+
+def flaky(failures, code="ThrottlingException"):
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if len(calls) <= failures:
+            raise Throttled(code)
+        return "ok"
+    return fn, calls
+
+
+def test_rate_increases_additively_on_success():
+    clock = FakeClock()
+    bucket = AdaptiveTokenBucket(rate=10.0, max_rate=10.25, increase_per_success=0.1, clock=clock)
+    bucket.on_success()
+    assert bucket.rate == pytest.approx(10.1)
+    bucket.on_success()
+    bucket.on_success()
+    assert bucket.rate == 10.25
+
+
+def test_rate_decreases_once_per_cooldown():
+    clock = FakeClock()
+    bucket = AdaptiveTokenBucket(rate=8.0, min_rate=1.5, decrease_factor=0.5, decrease_cooldown=1.0, clock=clock)
+    bucket.on_throttle()
+    bucket.on_throttle()  # same congestion burst, not a second signal
+    assert bucket.rate == 4.0 and bucket.tokens == 0.0
+    clock.now += 1.0
+    bucket.on_throttle()
+    assert bucket.rate == 2.0
+    clock.now += 1.0
+    bucket.on_throttle()
+    assert bucket.rate == 1.5
+
+
+def test_acquire_waits_for_a_token_until_the_deadline():
+    clock = FakeClock()
+    bucket = AdaptiveTokenBucket(rate=2.0, burst=1, clock=clock, sleep=clock.sleep)
+    assert bucket.acquire(deadline=10.0)
+    assert bucket.acquire(deadline=10.0)
+    assert clock.sleeps == [0.5]
+    assert not bucket.acquire(deadline=clock.now + 0.1)
+
+
+def test_throttles_are_retried_with_jittered_backoff_inside_the_budget():
+    clock = FakeClock()
+    sched = scheduler(clock, max_attempts=4, base_delay=0.25, max_delay=4.0)
+    delays = []
+    backoff_delay = sched.backoff_delay
+
+    def recorded_backoff(attempt):
+        delays.append(backoff_delay(attempt))
+        return delays[-1]
+    sched.backoff_delay = recorded_backoff
+    fn, calls = flaky(failures=2)
+    assert sched.call(fn, budget_seconds=10.0) == "ok"
+    assert len(calls) == 3 and len(delays) == 2 and clock.now <= 10.0
+    # Full jitter: each delay is within [0, base * 2^(attempt-1)], and every one was slept
+    assert 0 <= delays[0] <= 0.25 and 0 <= delays[1] <= 0.5
+    assert all(delay in clock.sleeps for delay in delays)
+    stats = sched.stats()
+    assert stats["throttles"] == 2 and stats["retries"] == 2 and stats["successes"] == 1
+
+
+def test_retries_stop_when_the_backoff_would_overrun_the_deadline(monkeypatch):
+    clock = FakeClock()
+    sched = scheduler(clock, max_attempts=10)
+    monkeypatch.setattr(sched, "backoff_delay", lambda attempt: 0.6)
+    fn, calls = flaky(failures=10)
+    with pytest.raises(Throttled):
+        sched.call(fn, budget_seconds=1.0)
+    assert len(calls) == 2 and clock.now <= 1.0
+
+
+def test_max_attempts_limits_retries():
+    clock = FakeClock()
+    sched = scheduler(clock, max_attempts=3)
+    fn, calls = flaky(failures=10)
+    with pytest.raises(Throttled):
+        sched.call(fn, budget_seconds=60.0)
+    assert len(calls) == 3
+
+    fn, calls = flaky(failures=10)
+    with pytest.raises(Throttled):
+        sched.call(fn, budget_seconds=60.0, max_attempts=1)
+    assert len(calls) == 1
+
+
+def test_non_retryable_errors_are_not_retried():
+    clock = FakeClock()
+    sched = scheduler(clock)
+    fn, calls = flaky(failures=1, code="ValidationException")
+    with pytest.raises(Throttled):
+        sched.call(fn)
+    assert len(calls) == 1 and sched.stats()["throttles"] == 0
+
+
+def test_full_queue_is_shed():
+    clock = FakeClock()
+    sched = scheduler(clock, max_queue=2)
+    sched.waiting = 2
+    with pytest.raises(LoadShedError):
+        sched.call(lambda: "ok")
+    assert sched.stats()["shed"] == 1
+
+
+def test_queue_that_cannot_drain_before_the_deadline_is_shed():
+    clock = FakeClock()
+    sched = scheduler(clock, rate=1.0, max_queue=100)
+    sched.waiting = 5  # five requests ahead at one token per second
+    with pytest.raises(LoadShedError):
+        sched.call(lambda: "ok", budget_seconds=2.0)
+    assert sched.call(lambda: "ok", budget_seconds=10.0) == "ok"
+
+
+def test_no_token_before_the_deadline_is_shed():
+    clock = FakeClock()
+    sched = scheduler(clock, rate=1.0, burst=1)
+    assert sched.call(lambda: "ok", budget_seconds=5.0) == "ok"
+    with pytest.raises(LoadShedError):
+        sched.call(lambda: "ok", budget_seconds=0.5)
+    assert sched.stats()["shed"] == 1 and sched.waiting == 0
+
+
+@pytest.mark.parametrize("timeout_seconds", [3, 30, 900])
+def test_lambda_budget_stays_positive(send_message, timeout_seconds):
+    budget = send_message.latency_budget(FakeLambdaContext("req-1", timeout_seconds=timeout_seconds))
+    assert send_message.MIN_LATENCY_BUDGET_SECONDS <= budget <= send_message.BEDROCK_LATENCY_BUDGET_SECONDS
+    assert budget < timeout_seconds
+    assert send_message.latency_budget(None) == send_message.BEDROCK_LATENCY_BUDGET_SECONDS
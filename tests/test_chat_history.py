@@ -0,0 +1,138 @@
+import pytest
+
+from chat_history import ChatHistoryReader, decode_cursor, encode_cursor, pair_turns
+
+TOKEN = "test-history-token"
+
+
+class FakeClock:
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def seed(table, chat_id, count, start_ms=1000):
+    for i in range(count):
+        table._store({"chatId": chat_id, "timestamp": start_ms + i, "sender": "user" if i % 2 == 0 else "bot",
+                      "message": f"message {i}"})
+
+
+def read_all(reader, chat_id, limit, newest_first=True):
+    pages, cursor = [], None
+    while True:
+        messages, cursor, _ = reader.page(chat_id, limit, cursor, newest_first)
+        pages.append(messages)
+        if not cursor:
+            return pages
+
+
+def test_cursor_round_trip():
+    cursor = encode_cursor({"chatId": "chat-1", "timestamp": 1234})
+    assert "=" not in cursor
+    assert decode_cursor(cursor, "chat-1") == {"chatId": "chat-1", "timestamp": 1234}
+    with pytest.raises(ValueError, match="different chat"):
+        decode_cursor(cursor, "chat-2")
+    with pytest.raises(ValueError, match="Malformed"):
+        decode_cursor("not-a-cursor", "chat-1")
+
+
+@pytest.mark.parametrize("newest_first", [True, False])
+def test_pages_cover_the_chat_once(history_table, newest_first):
+    seed(history_table, "chat-1", 23)
+    seed(history_table, "chat-2", 5)
+    reader = ChatHistoryReader(history_table, recent_window=10)
+
+    pages = read_all(reader, "chat-1", 7, newest_first)
+    timestamps = [message["timestamp"] for page in pages for message in page]
+    assert [len(page) for page in pages] == [7, 7, 7, 2]
+    assert timestamps == sorted(range(1000, 1023), reverse=newest_first)
+
+
+def test_first_page_is_served_from_the_recent_window(history_table):
+    seed(history_table, "chat-1", 30)
+    reader = ChatHistoryReader(history_table, recent_window=10)
+
+    assert reader.page("chat-1", 5)[2] == "MISS"
+    assert reader.page("chat-1", 5)[2] == "HIT"
+    assert reader.page("chat-1", 20)[2] == "BYPASS" # Larger than the window
+    assert reader.stats()["queries"] == 2
+
+
+def test_recent_window_expires_after_ttl(history_table):
+    clock = FakeClock()
+    seed(history_table, "chat-1", 4)
+    reader = ChatHistoryReader(history_table, recent_window=10, ttl_seconds=30, clock=clock)
+    assert [m["message"] for m in reader.recent("chat-1", 10)] == [f"message {i}" for i in range(4)]
+
+    # A message written by the Lambda meanwhile shows up once the cached window expires
+    history_table._store({"chatId": "chat-1", "timestamp": 2000, "sender": "user", "message": "new"})
+    clock.now = 29
+    assert reader.page("chat-1", 10)[2] == "HIT"
+    assert len(reader.recent("chat-1", 10)) == 4
+    clock.now = 30
+    messages, _, status = reader.page("chat-1", 10)
+    assert status == "MISS" and messages[0]["message"] == "new"
+
+
+def test_recent_windows_are_bounded(history_table):
+    for chat in range(3):
+        seed(history_table, f"chat-{chat}", 2)
+    reader = ChatHistoryReader(history_table, recent_window=10, max_chats=2)
+    for chat in range(3):
+        reader.page(f"chat-{chat}", 5)
+    assert reader.stats()["cached_chats"] == 2
+    assert reader.page("chat-0", 5)[2] == "MISS" # Evicted as the least recently used chat
+    assert reader.page("chat-2", 5)[2] == "HIT"
+
+
+def test_pair_turns():
+    messages = [{"sender": "user", "message": "a"}, {"sender": "bot", "message": "b"},
+                {"sender": "bot", "message": "orphan"}, {"sender": "user", "message": "c"},
+                {"sender": "user", "message": "d"}, {"sender": "bot", "message": "e"}]
+    assert pair_turns(messages) == [("a", "b"), ("d", "e")]
+
+
+@pytest.fixture
+def history_api(backend, history_table, monkeypatch):
+    seed(history_table, "chat-1", 150)
+    monkeypatch.setattr(backend, "history_reader", ChatHistoryReader(history_table, recent_window=50))
+    monkeypatch.setattr(backend, "HISTORY_API_TOKEN", TOKEN)
+    monkeypatch.setattr(backend, "HISTORY_MAX_PAGE_SIZE", 100)
+    client = backend.app.test_client()
+    return lambda url, token=TOKEN: client.get(url, headers={"Authorization": f"Bearer {token}"} if token else {})
+
+
+def test_page_size_is_clamped(history_api):
+    assert len(history_api("/api/history/chat-1?limit=1000").get_json()["messages"]) == 100
+    assert len(history_api("/api/history/chat-1?limit=0").get_json()["messages"]) == 1
+    assert len(history_api("/api/history/chat-1?limit=-5").get_json()["messages"]) == 1
+    assert history_api("/api/history/chat-1?limit=ten").status_code == 400
+
+
+def test_endpoint_cursor_round_trip(history_api):
+    first = history_api("/api/history/chat-1?limit=40").get_json()
+    second = history_api(f"/api/history/chat-1?limit=40&cursor={first['next_cursor']}").get_json()
+    assert first["messages"][-1]["timestamp"] - 1 == second["messages"][0]["timestamp"]
+    assert history_api(f"/api/history/chat-2?cursor={first['next_cursor']}").status_code == 400
+
+
+def test_endpoint_requires_the_token(history_api, backend, monkeypatch):
+    assert history_api("/api/history/chat-1", token=None).status_code == 401
+    assert history_api("/api/history/chat-1", token="wrong").status_code == 401
+    monkeypatch.setattr(backend, "HISTORY_API_TOKEN", None)
+    assert history_api("/api/history/chat-1").status_code == 403
+
+
+def test_unknown_sessions_are_not_seeded_by_default(backend, history_table, monkeypatch):
+    seed(history_table, "chat-1", 4)
+    monkeypatch.setattr(backend, "history_reader", ChatHistoryReader(history_table))
+    backend.handle_chat_message("Where next?", session_id="chat-1")
+    assert history_table.stats.calls.get("Query", 0) == 0
+
+    seed(history_table, "chat-2", 4)
+    monkeypatch.setattr(backend, "HISTORY_SEED_SESSIONS", True)
+    backend.handle_chat_message("Where next?", session_id="chat-2")
+    assert history_table.stats.calls["Query"] == 1
+    assert backend.conversations.get_or_create("chat-2").turns[:2] == [("message 0", "message 1"), ("message 2", "message 3")]
@@ -0,0 +1,111 @@
+import itertools
+import threading
+import time
+
+import pytest
+
+from conftest import fast_config
+from fakes import FakeBedrockRuntime
+
+FAST = "anthropic.claude-3-haiku-20240307-v1:0"
+CAPABLE = "anthropic.claude-3-sonnet-20240229-v1:0"
+
+
+@pytest.fixture
+def slow_backend(backend, monkeypatch):
+    """Bedrock answers after 200ms, so concurrent requests overlap."""
+    monkeypatch.setattr(backend, "bedrock_runtime", FakeBedrockRuntime(fast_config(latency_ms=200.0)))
+    return backend
+
+
+def concurrently(backend, *prompts):
+    barrier = threading.Barrier(len(prompts))
+
+    def send(prompt):
+        barrier.wait()
+        backend.handle_chat_message(prompt)
+
+    threads = [threading.Thread(target=send, args=(prompt,)) for prompt in prompts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return backend.bedrock_runtime.stats.calls.get("InvokeModel", 0)
+
+
+def test_identical_prompts_share_a_call(slow_backend):
+    assert concurrently(slow_backend, "Best ramen in Tokyo?", "Best ramen in Tokyo?", "Best ramen in Tokyo?") == 1
+
+
+def test_prompts_that_differ_only_in_case_are_not_coalesced(slow_backend):
+    # A model may answer them differently, so only the exact prompt is shared
+    assert concurrently(slow_backend, "Best ramen in Tokyo?", "best ramen in tokyo") == 2
+
+
+def test_prompts_routed_to_different_models_are_not_coalesced(slow_backend, monkeypatch):
+    orders = itertools.cycle([[FAST, CAPABLE], [CAPABLE, FAST]])
+    lock = threading.Lock()
+
+    def candidates(prompt, context_tokens=0, budget_seconds=None):
+        with lock:
+            return next(orders)
+
+    monkeypatch.setattr(slow_backend.model_router, "candidates", candidates)
+    assert concurrently(slow_backend, "Best ramen in Tokyo?", "Best ramen in Tokyo?") == 2
+
+
+def test_sessions_with_a_summary_are_not_coalesced_with_new_ones(slow_backend, monkeypatch):
+    from conversation import ConversationStore
+    monkeypatch.setattr(slow_backend, "conversations", ConversationStore())
+    # Only a summary left (e.g. seeded from stored history): the answer still depends on it
+    slow_backend.conversations.get_or_create("seeded").summary = "- User asked: Any tips for Japan? Assistant: Get a rail pass."
+    barrier = threading.Barrier(2)
+
+    def send(session_id):
+        barrier.wait()
+        slow_backend.handle_chat_message("Best ramen in Tokyo?", session_id)
+
+    threads = [threading.Thread(target=send, args=(session_id,)) for session_id in ("seeded", None)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert slow_backend.bedrock_runtime.stats.calls["InvokeModel"] == 2
+
+
+def test_followers_fail_when_the_leader_is_interrupted():
+    from single_flight import SingleFlight
+    flight = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    outcome = {}
+
+    def interrupted():
+        started.set()
+        release.wait()
+        raise KeyboardInterrupt
+
+    def lead():
+        try:
+            flight.do("key", interrupted)
+        except KeyboardInterrupt:
+            outcome["leader"] = "interrupted"
+
+    def follow():
+        try:
+            outcome["follower"] = flight.do("key", lambda: "unexpected")
+        except RuntimeError as e:
+            outcome["follower"] = e
+
+    leader = threading.Thread(target=lead)
+    leader.start()
+    started.wait()
+    follower = threading.Thread(target=follow)
+    follower.start()
+    while flight.stats()["followers"] == 0:
+        time.sleep(0.001)
+    release.set()
+    leader.join()
+    follower.join()
+    assert outcome["leader"] == "interrupted"
+    assert isinstance(outcome["follower"], RuntimeError) and isinstance(outcome["follower"].__cause__, KeyboardInterrupt)
+    assert flight.stats()["errors"] == 1 and flight.in_flight() == 0
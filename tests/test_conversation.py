@@ -0,0 +1,80 @@
+from conversation import ConversationContext, ConversationStore, estimate_tokens, extractive_summary
+
+
+def words(count, word="word"):
+    return " ".join([word] * count)
+
+
+def prompt_tokens(conversation, prompt=""):
+    summary, turns = conversation.snapshot(prompt)
+    return (estimate_tokens(summary) if summary else 0) + sum(estimate_tokens(u) + estimate_tokens(a) for u, a in turns)
+
+
+def test_tokens_tracks_summary_and_turns():
+    conversation = ConversationContext("s", token_budget=10_000, recent_turns=2)
+    assert conversation.tokens() == 0
+    conversation.add_turn("What is there to do in Kyoto?", "Visit the temples.")
+    assert conversation.tokens() == estimate_tokens("What is there to do in Kyoto?") + estimate_tokens("Visit the temples.")
+    conversation.add_turn("And Osaka?", "Eat street food.")
+    conversation.add_turn("And Nara?", "Feed the deer.")
+    assert conversation.tokens() == prompt_tokens(conversation)
+
+
+def test_turns_beyond_the_window_are_summarized():
+    conversation = ConversationContext("s", token_budget=10_000, recent_turns=2)
+    conversation.add_turn("What is there to do in Kyoto? I have two days.", "Visit the temples. Go early.")
+    conversation.add_turn("And Osaka?", "Eat street food.")
+    conversation.add_turn("And Nara?", "Feed the deer.")
+    assert conversation.turns == [("And Osaka?", "Eat street food."), ("And Nara?", "Feed the deer.")]
+    assert conversation.summary == extractive_summary("", "What is there to do in Kyoto?", "Visit the temples.")
+
+
+def test_turns_are_folded_until_the_budget_fits():
+    conversation = ConversationContext("s", token_budget=300, recent_turns=10)
+    for i in range(12):
+        conversation.add_turn(f"Question {i}. " + words(100), f"Answer {i}. " + words(100))
+    assert conversation.tokens() <= 300
+    assert conversation.turns[-1][0].startswith("Question 11.")
+    assert "Question 10." in conversation.summary
+    # The summary keeps at most a quarter of the budget, dropping its oldest lines
+    assert estimate_tokens(conversation.summary) <= 75 and "Question 0." not in conversation.summary
+
+
+def test_oversized_newest_turn_is_truncated():
+    conversation = ConversationContext("s", token_budget=200)
+    conversation.add_turn("Plan my trip. " + words(500), "Here is a plan. " + words(2000))
+    assert conversation.tokens() <= 200
+    [(user, assistant)] = conversation.turns
+    assert user.startswith("Plan my trip.") and user.endswith(" ...")
+    assert assistant.startswith("Here is a plan.") and assistant.endswith(" ...")
+
+
+def test_snapshot_budgets_the_prompt_too():
+    conversation = ConversationContext("s", token_budget=400, recent_turns=10)
+    for i in range(3):
+        conversation.add_turn(f"Question {i}. " + words(60), f"Answer {i}. " + words(60))
+    stored = (conversation.summary, list(conversation.turns))
+    assert conversation.snapshot() == stored
+
+    prompt = words(200)
+    summary, turns = conversation.snapshot(prompt)
+    assert prompt_tokens(conversation, prompt) + estimate_tokens(prompt) <= 400
+    assert turns and turns[-1][0].startswith("Question 2.")
+    assert len(turns) == 1 and "Question 1." in summary
+    assert (conversation.summary, conversation.turns) == stored # Reading never changes the context
+
+    # A prompt that fills the whole budget leaves no room for history
+    assert conversation.snapshot(words(2000)) == ("", [])
+
+
+def test_store_reuses_sessions_and_evicts_the_least_recently_used():
+    store = ConversationStore(max_sessions=2, token_budget=500, recent_turns=3)
+    first = store.get_or_create("a")
+    assert store.get_or_create("a") is first
+    assert first.token_budget == 500 and first.recent_turns == 3
+    fresh = store.get_or_create()
+    assert fresh.session_id and fresh.session_id != "a"
+    store.get_or_create("a")
+    store.get_or_create("b") # Evicts the fresh session, which was used least recently
+    assert store.get_or_create("a") is first
+    assert store.sessions.get(fresh.session_id) is None
@@ -0,0 +1,103 @@
+import json
+
+from conftest import fast_config
+from fakes import FakeApiGatewayManagementApi
+
+CONNECTION = "conn-1"
+
+
+class DisconnectingApi(FakeApiGatewayManagementApi):
+    """Delivers the first `after` frames, then reports the connection as gone."""
+
+    def __init__(self, after):
+        super().__init__(fast_config(), keep_frames=True)
+        self.after = after
+        self.attempts = 0
+
+    def post_to_connection(self, ConnectionId, Data):
+        self.attempts += 1
+        if self.attempts > self.after:
+            raise self.exceptions.GoneException("gone")
+        return super().post_to_connection(ConnectionId=ConnectionId, Data=Data)
+
+
+def sender_for(send_message, max_frame_bytes=512, api=None):
+    api = api or FakeApiGatewayManagementApi(fast_config(), keep_frames=True)
+    return send_message.FrameSender(api, CONNECTION, "req-1", max_frame_bytes=max_frame_bytes), api
+
+
+def raw_sizes(api):
+    return [len(json.dumps(frame, separators=(",", ":")).encode("utf-8")) for frame in api.frames[CONNECTION]]
+
+
+def test_split_text_fits_the_encoded_size(send_message):
+    for text in ["a" * 1000, "é" * 1000, "\"quoted\"\n" * 100, "日本語のテキスト" * 100, "🙂" * 300]:
+        pieces = send_message.split_text_for_frames(text, 100)
+        assert "".join(pieces) == text
+        # json.dumps escapes non-ASCII characters (é, surrogate pairs), so the limit applies to the escaped form
+        assert all(len(json.dumps(piece)) <= 100 for piece in pieces)
+    assert send_message.split_text_for_frames("", 100) == []
+
+
+def test_text_frames_stay_under_the_limit_in_order(send_message):
+    sender, api = sender_for(send_message)
+    text = "Kyoto 京都 " * 200
+    sender.send_text(text)
+    sender.finish(citations=0)
+    frames = api.frames[CONNECTION]
+    assert len(frames) > 2
+    assert [frame["seq"] for frame in frames] == list(range(len(frames)))
+    assert max(raw_sizes(api)) <= 512
+    assert "".join(frame["text"] for frame in frames[:-1]) == text
+
+
+def test_done_frame_reports_frames_and_bytes(send_message):
+    sender, api = sender_for(send_message)
+    sender.send_text("short answer")
+    sender.finish(cacheStatus="MISS")
+    delta, done = api.frames[CONNECTION]
+    assert delta == {"type": "delta", "seq": 0, "text": "short answer"}
+    assert done["type"] == "done" and done["seq"] == 1 and done["frames"] == 2
+    assert done["bytes"] == raw_sizes(api)[0] and done["cacheStatus"] == "MISS"
+
+
+def citations(count, text_chars):
+    return [{"references": [{"text": f"passage {i} " + "x" * text_chars, "location": f"s3://kb/{i}"},
+                            {"text": "shared passage", "location": "s3://kb/shared"}]}
+            for i in range(count)]
+
+
+def test_compact_citations_are_chunked_into_reference_frames(send_message):
+    sender, api = sender_for(send_message)
+    sender.send_citations(citations(10, 100), citation_format="compact", snippet_chars=200)
+    frames = api.frames[CONNECTION]
+    reference_frames = [frame for frame in frames if frame["type"] == "references"]
+    assert len(reference_frames) > 1 and frames[-1]["type"] == "citations"
+    assert max(raw_sizes(api)) <= 512
+    # Offsets index into the concatenated reference list that the citations point at
+    references = []
+    for frame in reference_frames:
+        assert frame["offset"] == len(references)
+        references.extend(frame["references"])
+    assert len(references) == 11 # The shared passage is sent once
+    assert all(max(citation["refs"]) < len(references) for citation in frames[-1]["citations"])
+
+
+def test_full_citations_are_batched_and_truncated(send_message):
+    sender, api = sender_for(send_message)
+    sender.send_citations(citations(4, 2000), citation_format="full", snippet_chars=None)
+    frames = api.frames[CONNECTION]
+    assert all(frame["type"] == "citations" for frame in frames)
+    assert sum(len(frame["citations"]) for frame in frames) == 4
+    assert max(raw_sizes(api)) <= 512
+
+
+def test_frames_after_gone_are_dropped(send_message):
+    api = DisconnectingApi(after=1)
+    sender, _ = sender_for(send_message, api=api)
+    assert sender.send("delta", text="first")
+    assert not sender.send("delta", text="second")
+    assert sender.gone
+    sender.send_text("more text")
+    sender.finish()
+    assert api.attempts == 2 and len(api.frames[CONNECTION]) == 1
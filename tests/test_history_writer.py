@@ -0,0 +1,121 @@
+import json
+import threading
+
+import pytest
+
+from conftest import fast_config
+from fakes import FakeDynamoDBTable, FakeLambdaContext
+
+
+class FlakyClient:
+    """batch_write_item that leaves all but the first item unprocessed for the first `failures` calls."""
+
+    def __init__(self, table, failures):
+        self.table = table
+        self.failures = failures
+        self.batch_sizes = []
+
+    def batch_write_item(self, RequestItems):
+        requests = RequestItems[self.table.name]
+        self.batch_sizes.append(len(requests))
+        if self.failures:
+            self.failures -= 1
+            self.table._store(requests[0]["PutRequest"]["Item"])
+            return {"UnprocessedItems": {self.table.name: requests[1:]}} if requests[1:] else {"UnprocessedItems": {}}
+        for request in requests:
+            self.table._store(request["PutRequest"]["Item"])
+        return {"UnprocessedItems": {}}
+
+
+def writer_for(send_message, table, failures, max_retries=3):
+    table.meta.client = FlakyClient(table, failures)
+    delays = []
+    return send_message.HistoryWriter(table, max_retries=max_retries, base_delay=0.05, sleep=delays.append), delays
+
+
+def test_unprocessed_items_are_retried(send_message, history_table):
+    writer, delays = writer_for(send_message, history_table, failures=2)
+    for i in range(4):
+        writer.add("chat-1", "user", f"message {i}")
+    writer.flush()
+
+    assert history_table.meta.client.batch_sizes == [4, 3, 2]
+    assert len(history_table.items) == 4
+    assert delays == [0.05, 0.1] # Exponential backoff
+    assert writer.counters == {"written": 4, "retried": 5, "dropped": 0, "batches": 3}
+
+
+def test_items_are_dropped_after_max_retries(send_message, history_table):
+    writer, delays = writer_for(send_message, history_table, failures=10, max_retries=2)
+    for i in range(5):
+        writer.add("chat-1", "user", f"message {i}")
+    writer.flush()
+
+    assert history_table.meta.client.batch_sizes == [5, 4, 3]
+    assert len(history_table.items) == 3
+    assert writer.counters["dropped"] == 2 and writer.counters["written"] == 3
+    assert not writer.pending
+
+
+def test_large_flush_is_split_into_batches(send_message, history_table):
+    writer, _ = writer_for(send_message, history_table, failures=0)
+    for i in range(30):
+        writer.add("chat-1", "user", f"message {i}")
+    writer.flush()
+    assert history_table.meta.client.batch_sizes == [25, 5]
+    # Messages added in the same millisecond still get distinct, ordered timestamps
+    assert len(history_table.items) == 30
+
+
+def event(message, connection_id="conn-1"):
+    return {"requestContext": {"connectionId": connection_id, "domainName": "test.local", "stage": "test"},
+            "body": json.dumps({"message": message})}
+
+
+def test_handler_flushes_history(send_message, history_table):
+    send_message.lambda_handler(event("Best time to visit Kyoto?"), FakeLambdaContext("req-1"))
+    senders = [item["sender"] for _, item in sorted(history_table.items.items())]
+    assert senders == ["user", "bot"]
+    assert not send_message.history_writer.pending
+
+
+def test_handler_flushes_history_when_the_turn_fails(send_message, history_table, monkeypatch):
+    def broken_sender(*args, **kwargs):
+        raise RuntimeError("boom")
+    monkeypatch.setattr(send_message, "FrameSender", broken_sender)
+
+    with pytest.raises(RuntimeError):
+        send_message.lambda_handler(event("Best time to visit Kyoto?"), FakeLambdaContext("req-2"))
+    assert [item["message"] for item in history_table.items.values()] == ["Best time to visit Kyoto?"]
+    assert not send_message.history_writer.pending
+
+
+def test_concurrent_add_and_flush(send_message):
+    table = FakeDynamoDBTable("test-chat-history", "chatId", "timestamp", fast_config())
+    writer = send_message.HistoryWriter(table, sleep=lambda seconds: None)
+    adders, per_thread = 8, 200
+    done = threading.Event()
+
+    def add(thread):
+        for i in range(per_thread):
+            writer.add(f"chat-{thread}", "user", f"message {i}")
+
+    def flush():
+        while not done.is_set():
+            writer.flush()
+
+    flushers = [threading.Thread(target=flush) for _ in range(2)]
+    threads = [threading.Thread(target=add, args=(thread,)) for thread in range(adders)]
+    for thread in flushers + threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    done.set()
+    for thread in flushers:
+        thread.join()
+    writer.flush()
+
+    # Every message is written exactly once, with a distinct key
+    assert len(table.items) == adders * per_thread
+    assert writer.counters["written"] == adders * per_thread
+    assert not writer.pending
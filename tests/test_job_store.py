@@ -0,0 +1,101 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from job_store import JobStore
+
+
+@pytest.fixture
+def blocked_job():
+    """A JobStore (one long-poll slot) with a job that runs until the returned event is set."""
+    release = threading.Event()
+    store = JobStore(ThreadPoolExecutor(max_workers=1), max_long_polls=1)
+    job_id = store.submit("chat", lambda: (release.wait(5), ({"reply": "done"}, 200))[1])
+    yield store, job_id, release
+    release.set()
+
+
+def test_long_poll_returns_when_the_job_finishes(blocked_job):
+    store, job_id, release = blocked_job
+    threading.Timer(0.05, release.set).start()
+    assert store.get(job_id, wait_seconds=5)["status"] == "done"
+    assert store.stats()["long_polling"] == 0
+
+
+def test_long_polls_beyond_the_cap_return_at_once(blocked_job):
+    store, job_id, release = blocked_job
+    waiter = threading.Thread(target=store.get, args=(job_id, 5))
+    waiter.start()
+    time.sleep(0.05)
+    assert store.stats()["long_polling"] == 1
+
+    started = time.monotonic()
+    assert store.get(job_id, wait_seconds=5)["status"] in ("queued", "running")
+    assert time.monotonic() - started < 1
+    assert store.stats()["long_polls_capped"] == 1
+
+    release.set()
+    waiter.join(5)
+    assert store.stats()["long_polling"] == 0
+
+
+def test_asgi_long_poll_cap(backend, monkeypatch, blocked_job):
+    from starlette.testclient import TestClient
+    import asgi
+    store, job_id, release = blocked_job
+    monkeypatch.setattr(backend, "job_store", store)
+    assert store.begin_long_poll() # Every slot taken
+
+    started = time.monotonic()
+    with TestClient(asgi.app) as client:
+        response = client.get(f"/api/jobs/{job_id}?wait=5")
+    assert response.status_code == 200 and response.headers["Retry-After"] == "1"
+    assert time.monotonic() - started < 1
+    assert store.stats()["long_polls_capped"] == 1
+
+
+class InlineExecutor:
+    def submit(self, fn, *args):
+        fn(*args)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_results_expire_after_the_ttl():
+    clock = FakeClock()
+    store = JobStore(InlineExecutor(), ttl_seconds=10, clock=clock)
+    first = store.submit("chat", lambda: ({"reply": "one"}, 200))
+    clock.now = 5
+    second = store.submit("chat", lambda: ({"reply": "two"}, 200))
+    clock.now = 12
+    assert store.get(first) is None
+    assert store.get(second)["result"] == {"reply": "two"}
+    clock.now = 15
+    assert store.get(second) is None
+    assert store.stats()["expired"] == 2 and store.stats()["stored"] == 0
+
+
+def test_oldest_results_are_evicted_beyond_the_cap():
+    store = JobStore(InlineExecutor(), max_results=2)
+    job_ids = [store.submit("chat", lambda i=i: ({"reply": i}, 200)) for i in range(3)]
+    assert store.get(job_ids[0]) is None
+    assert [store.get(job_id)["result"]["reply"] for job_id in job_ids[1:]] == [1, 2]
+    assert store.stats()["evicted"] == 1 and store.stats()["stored"] == 2
+
+
+def test_running_jobs_are_never_evicted(blocked_job):
+    store, job_id, release = blocked_job
+    store.max_results = 0
+    assert store.get(job_id)["status"] in ("queued", "running")
+    release.set()
+    assert store.get(job_id, wait_seconds=5)["status"] == "done"
+    assert store.get(job_id) is None # Finished, so its result was dropped at once
+    assert store.stats()["evicted"] == 1
@@ -0,0 +1,21 @@
+import subprocess
+import sys
+import zipfile
+
+import build_package
+
+
+def test_package_bundles_shared_modules(tmp_path):
+    output = build_package.build(str(tmp_path / "sendMessage.zip"))
+    with zipfile.ZipFile(output) as package:
+        names = set(package.namelist())
+    assert names == {"sendMessage.py", *(f"{module}.py" for module in build_package.SHARED_MODULES)}
+
+
+def test_handler_imports_from_the_unpacked_package(tmp_path):
+    # Only the unpacked zip is importable, as in the Lambda runtime
+    with zipfile.ZipFile(build_package.build(str(tmp_path / "sendMessage.zip"))) as package:
+        package.extractall(tmp_path / "task")
+    result = subprocess.run([sys.executable, "-I", "-c", "import sys; sys.path.insert(0, sys.argv[1]); import sendMessage",
+                             str(tmp_path / "task")], cwd=tmp_path, capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
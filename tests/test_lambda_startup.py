@@ -0,0 +1,29 @@
+import subprocess
+import sys
+
+from conftest import REPO_ROOT
+
+CHECK_LAZY_TABLE = """
+import sys
+sys.path[:0] = [sys.argv[1] + "/backend", sys.argv[1] + "/Lambda"]
+import sendMessage
+assert sendMessage.dynamodb is None and sendMessage.chat_history_table is None, "created during init"
+table = sendMessage.history_writer.table
+assert table is not None and table.name == "test-chat-history"
+assert sendMessage.get_chat_history_table() is table and sendMessage.history_writer.table is table
+"""
+
+
+def test_history_table_is_created_on_first_use():
+    # A fresh interpreter, like a new Lambda container
+    result = subprocess.run([sys.executable, "-c", CHECK_LAZY_TABLE, REPO_ROOT], capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
+
+
+def test_writer_without_table_skips_storage(send_message, monkeypatch):
+    monkeypatch.setattr(send_message, "CHAT_HISTORY_TABLE", None)
+    monkeypatch.setattr(send_message, "chat_history_table", None)
+    writer = send_message.HistoryWriter()
+    writer.add("chat-1", "user", "Hello")
+    writer.flush()
+    assert writer.table is None and not writer.pending and writer.counters["written"] == 0
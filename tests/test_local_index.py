@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+import ingest_documents
+from local_index import HashingEmbedder, LocalVectorIndex, chunk_text
+
+DOCUMENTS = {
+    "japan/kyoto.md": "Kyoto temples are busiest in cherry blossom season. Visit Fushimi Inari early in the morning.",
+    "japan/osaka.txt": "Osaka street food: takoyaki and okonomiyaki in Dotonbori, best in the evening.",
+    "portugal/lisbon.html": "<html><head><style>p {}</style></head><body><p>Lisbon trams climb the hills of Alfama."
+                            "</p><script>ignored()</script><p>Tram 28 gets crowded.</p></body></html>",
+    "notes.pdf": "Not a supported document type.",
+}
+
+
+@pytest.fixture
+def index(tmp_path):
+    source = tmp_path / "docs"
+    for name, text in DOCUMENTS.items():
+        (source / name).parent.mkdir(parents=True, exist_ok=True)
+        (source / name).write_text(text, encoding="utf-8")
+    assert ingest_documents.main([str(source), "--index-dir", str(tmp_path / "index"), "--dimensions", "256",
+                                  "--location-prefix", "s3://travel-docs/"]) == 0
+    return LocalVectorIndex.load(str(tmp_path / "index"))
+
+
+def test_ingest_reads_supported_documents(index):
+    locations = sorted(passage["location"] for passage in index.passages)
+    assert locations == ["s3://travel-docs/japan/kyoto.md", "s3://travel-docs/japan/osaka.txt",
+                         "s3://travel-docs/portugal/lisbon.html"]
+    lisbon = next(p["text"] for p in index.passages if p["location"].endswith("lisbon.html"))
+    assert "Tram 28" in lisbon and "ignored" not in lisbon and "<p>" not in lisbon
+
+
+def test_reload_is_memory_mapped(index):
+    assert isinstance(index.embeddings, np.memmap)
+    assert index.embeddings.shape == (3, 256) and index.embeddings.dtype == np.float32
+    assert isinstance(index.embedder, HashingEmbedder) and index.embedder.dimensions == 256 # From the manifest
+    np.testing.assert_allclose(np.linalg.norm(index.embeddings, axis=1), 1.0, rtol=1e-5)
+
+
+def test_top_k_ordering(index):
+    [results] = index.query(["Which Kyoto temples should I visit early in the morning?"], k=3)
+    assert len(results) == 3
+    assert results[0]["location"].endswith("kyoto.md")
+    scores = [result["score"] for result in results]
+    assert scores == sorted(scores, reverse=True)
+
+
+def test_batch_queries_and_k_larger_than_index(index):
+    results = index.query(["takoyaki in Dotonbori", "Lisbon trams in Alfama"], k=10)
+    assert [len(r) for r in results] == [3, 3]
+    assert results[0][0]["location"].endswith("osaka.txt")
+    assert results[1][0]["location"].endswith("lisbon.html")
+
+
+def test_min_score_filters_weak_matches(index):
+    [everything] = index.query(["Lisbon trams in Alfama"], k=3)
+    [filtered] = index.query(["Lisbon trams in Alfama"], k=3, min_score=0.3)
+    assert filtered and len(filtered) < len(everything)
+    assert all(result["score"] >= 0.3 for result in filtered)
+    assert index.query(["Lisbon trams in Alfama"], k=3, min_score=1.01) == [[]]
+
+
+def test_blocked_search_matches_a_full_scan(tmp_path):
+    rng = np.random.default_rng(7)
+    passages = [{"text": " ".join(rng.choice(["kyoto", "osaka", "lisbon", "tram", "temple", "food", "night",
+                                              "market", "museum", "beach"], 6)), "location": f"doc-{i}"}
+                for i in range(200)]
+    index = LocalVectorIndex.build(str(tmp_path / "index"), passages, HashingEmbedder(64))
+    queries = index.embedder.embed(["kyoto temple market", "lisbon tram night"])
+    full_scores, full_indices = index.search(queries, k=5)
+    block_scores, block_indices = index.search(queries, k=5, block_rows=16)
+    np.testing.assert_allclose(block_scores, full_scores, rtol=1e-6)
+    expected = np.sort(queries @ np.asarray(index.embeddings).T, axis=1)[:, ::-1][:, :5]
+    np.testing.assert_allclose(full_scores, expected, rtol=1e-6)
+    assert (np.diff(full_scores, axis=1) <= 0).all()
+
+
+def test_empty_index(tmp_path):
+    index = LocalVectorIndex.build(str(tmp_path / "index"), [], HashingEmbedder(32))
+    assert index.query(["anything"]) == [[]]
+
+
+def test_chunk_text_overlaps_and_respects_max_chars():
+    text = " ".join(f"Sentence number {i} about travel." for i in range(100))
+    passages = chunk_text(text, max_chars=200, overlap_chars=50)
+    assert len(passages) > 1 and all(len(p) <= 200 + 50 + 2 for p in passages)
+    assert passages[1].split("\n\n")[0] in passages[0] # Starts with the tail of the previous passage
@@ -0,0 +1,117 @@
+import json
+
+import pytest
+
+from fakes import FakeLambdaContext
+from metrics import MetricsRegistry, StageTimer
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_counter_and_gauge_rendering():
+    registry = MetricsRegistry()
+    errors = registry.counter("errors_total", "Errors by code.", ("operation", "code"))
+    running = registry.gauge("running", "Requests in flight.")
+    errors.inc(operation="InvokeModel", code="ThrottlingException")
+    errors.inc(2, operation="InvokeModel", code="ThrottlingException")
+    errors.inc(operation="Retrieve", code="AccessDenied")
+    running.set(3)
+    assert registry.render() == (
+        "# HELP errors_total Errors by code.\n"
+        "# TYPE errors_total counter\n"
+        'errors_total{operation="InvokeModel",code="ThrottlingException"} 3\n'
+        'errors_total{operation="Retrieve",code="AccessDenied"} 1\n'
+        "# HELP running Requests in flight.\n"
+        "# TYPE running gauge\n"
+        "running 3\n"
+    )
+
+
+def test_histogram_buckets_are_cumulative():
+    registry = MetricsRegistry()
+    latency = registry.histogram("latency_seconds", "Latency.", ("endpoint",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.7, 5.0):
+        latency.observe(value, endpoint="/api/chat")
+    lines = registry.render().splitlines()
+    assert lines[1] == "# TYPE latency_seconds histogram"
+    assert lines[2:] == [
+        'latency_seconds_bucket{endpoint="/api/chat",le="0.1"} 1',
+        'latency_seconds_bucket{endpoint="/api/chat",le="1.0"} 3',
+        'latency_seconds_bucket{endpoint="/api/chat",le="+Inf"} 4',
+        'latency_seconds_sum{endpoint="/api/chat"} 6.25',
+        'latency_seconds_count{endpoint="/api/chat"} 4',
+    ]
+
+
+def test_label_values_are_escaped():
+    registry = MetricsRegistry()
+    counter = registry.counter("odd_total", "Odd labels.", ("value",))
+    counter.inc(value='say "hi"\\n\nnext')
+    assert 'odd_total{value="say \\"hi\\"\\\\n\\nnext"} 1' in registry.render()
+
+
+def test_wrong_labels_are_rejected():
+    counter = MetricsRegistry().counter("calls_total", "Calls.", ("operation",))
+    with pytest.raises(ValueError):
+        counter.inc(model="x")
+
+
+def test_collectors_run_before_rendering():
+    registry = MetricsRegistry()
+    queue = registry.gauge("queue_length", "Queued requests.")
+    registry.add_collector(lambda: queue.set(7))
+    assert "queue_length 7" in registry.render()
+
+
+def test_stage_timer_emits_sampled_lines():
+    clock = FakeClock()
+    timer = StageTimer("sendMessage", clock=clock)
+    with timer.stage("bedrock"):
+        clock.now += 0.25
+    timer.add("bedrock", 0.05) # Stages entered twice accumulate
+    timer.mark("first_frame")
+    timer.fields["cacheStatus"] = "MISS"
+    lines = []
+    assert not timer.emit(sample_rate=0.0, emit_line=lines.append)
+    assert timer.emit(sample_rate=0.0, force=True, emit_line=lines.append)
+    assert timer.emit(sample_rate=1.0, emit_line=lines.append)
+    record = json.loads(lines[0])
+    assert record == {"metric": "sendMessage", "total_ms": 250.0, "stages_ms": {"bedrock": 300.0, "first_frame": 250.0},
+                      "cacheStatus": "MISS"}
+
+
+def test_lambda_emits_errors_even_when_unsampled(send_message, monkeypatch):
+    lines = []
+    emit = StageTimer.emit
+    monkeypatch.setattr(send_message, "METRICS_SAMPLE_RATE", 0.0)
+    monkeypatch.setattr(send_message, "cold_start", False)
+    monkeypatch.setattr(StageTimer, "emit", lambda self, sample_rate, force=False: emit(self, sample_rate, force, lines.append))
+    body = {"requestContext": {"connectionId": "conn-1", "domainName": "test.local", "stage": "test"},
+            "body": json.dumps({"message": "Best time to visit Kyoto?"})}
+    send_message.lambda_handler(body, FakeLambdaContext("req-1"))
+    assert lines == []
+
+    def broken_sender(*args, **kwargs):
+        raise RuntimeError("boom")
+    monkeypatch.setattr(send_message, "FrameSender", broken_sender)
+    with pytest.raises(RuntimeError):
+        send_message.lambda_handler(body, FakeLambdaContext("req-2"))
+    [line] = lines
+    assert json.loads(line)["error"] is True and json.loads(line)["requestId"] == "req-2"
+
+
+def test_metrics_endpoint(backend):
+    client = backend.app.test_client()
+    client.get("/api/health")
+    response = client.get("/api/metrics")
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == MetricsRegistry.CONTENT_TYPE
+    text = response.get_data(as_text=True)
+    assert "# TYPE api_request_duration_seconds histogram" in text
+    assert 'api_request_duration_seconds_count{endpoint="/api/health",method="GET",status="200"}' in text
@@ -0,0 +1,146 @@
+import pytest
+from botocore.exceptions import ClientError
+
+from bedrock_scheduler import LoadShedError
+from model_router import ModelHealth, ModelRouter
+
+FAST, MID, BIG = "anthropic.claude-3-haiku-20240307-v1:0", "amazon.titan-text-lite-v1", "anthropic.claude-3-sonnet-20240229-v1:0"
+SHORT_PROMPT = "What time is it?"
+PLANNING_PROMPT = ("Plan a five day itinerary in Kyoto and compare the routes, budget and schedule for each day, "
+                   "with recommendations for food and trade-offs between the options.")
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def client_error(code, status=400):
+    return ClientError({"Error": {"Code": code, "Message": code}, "ResponseMetadata": {"HTTPStatusCode": status}},
+                       "InvokeModel")
+
+
+class FailingModels:
+    """Wraps a fake bedrock-runtime client so calls to some models raise a given error."""
+
+    def __init__(self, runtime, errors):
+        self.runtime = runtime
+        self.errors = errors
+        self.calls = []
+
+    def invoke_model(self, modelId, **kwargs):
+        self.calls.append(modelId)
+        if modelId in self.errors:
+            raise self.errors[modelId]
+        return self.runtime.invoke_model(modelId=modelId, **kwargs)
+
+    def invoke_model_with_response_stream(self, modelId, **kwargs):
+        self.calls.append(modelId)
+        if modelId in self.errors:
+            raise self.errors[modelId]
+        return self.runtime.invoke_model_with_response_stream(modelId=modelId, **kwargs)
+
+
+class SheddingScheduler:
+    budget_seconds = 5.0
+
+    def call(self, fn, budget_seconds=None, max_attempts=None):
+        raise LoadShedError("Request shed: test")
+
+
+def test_candidates_start_at_the_tier_matching_the_prompt():
+    router = ModelRouter([FAST, MID, BIG])
+    assert router.candidates(SHORT_PROMPT) == [FAST, MID, BIG]
+    assert router.candidates(PLANNING_PROMPT) == [MID, BIG, FAST]
+    # A long conversation pushes the same prompt to a more capable tier
+    assert router.candidates(PLANNING_PROMPT, context_tokens=3000) == [BIG, MID, FAST]
+
+
+def test_models_slower_than_the_budget_move_to_the_back():
+    router = ModelRouter([FAST, MID, BIG], clock=FakeClock())
+    router.record(FAST, 3.0, True)
+    assert router.candidates(SHORT_PROMPT, budget_seconds=5.0) == [FAST, MID, BIG]
+    assert router.candidates(SHORT_PROMPT, budget_seconds=1.0) == [MID, BIG, FAST]
+
+
+def test_cooldown_grows_with_consecutive_failures_and_resets_on_success():
+    clock = FakeClock()
+    health = ModelHealth(base_cooldown=2.0, max_cooldown=5.0, clock=clock)
+    cooldowns = []
+    for _ in range(3):
+        health.record(1.0, False)
+        cooldowns.append(health.cooldown_until - clock.now)
+    assert cooldowns == [2.0, 4.0, 5.0]
+    clock.now += 5.0
+    assert not health.cooling_down()
+    health.record(1.0, True)
+    health.record(1.0, False)
+    assert health.cooldown_until - clock.now == 2.0
+
+
+def test_error_rate_decays_while_a_model_gets_no_traffic():
+    clock = FakeClock()
+    health = ModelHealth(alpha=0.5, error_half_life=60.0, clock=clock)
+    health.record(1.0, False)
+    assert health.error_rate() == 0.5
+    clock.now += 60.0
+    assert health.error_rate() == pytest.approx(0.25)
+
+
+def test_failing_model_is_tried_last_until_it_recovers():
+    clock = FakeClock()
+    router = ModelRouter([FAST, MID], clock=clock, base_cooldown=2.0)
+    router.record(FAST, 0.1, False)
+    assert router.candidates(SHORT_PROMPT) == [MID, FAST]
+    clock.now += 2.0
+    assert router.candidates(SHORT_PROMPT) == [FAST, MID]
+
+
+def test_upstream_failure_fails_over_and_is_recorded(backend, monkeypatch):
+    monkeypatch.setattr(backend, "model_router", ModelRouter([FAST, MID]))
+    runtime = FailingModels(backend.bedrock_runtime, {FAST: client_error("ServiceUnavailableException", 503)})
+    monkeypatch.setattr(backend, "bedrock_runtime", runtime)
+    reply = backend.invoke_bedrock_model(SHORT_PROMPT, budget_seconds=5.0)
+    assert runtime.calls == [FAST, MID] and reply != backend.SERVER_BUSY_MESSAGE
+    stats = backend.model_router.stats()
+    assert stats[FAST]["failures"] == 1 and stats[FAST]["cooling_down"]
+    assert stats[MID]["calls"] == 1 and stats[MID]["failures"] == 0
+    assert backend.model_router.candidates(SHORT_PROMPT) == [MID, FAST]
+
+
+@pytest.mark.parametrize("error", [client_error("AccessDeniedException", 403), client_error("ValidationException")])
+def test_rejected_requests_fail_over_without_penalizing_the_model(backend, monkeypatch, error):
+    monkeypatch.setattr(backend, "model_router", ModelRouter([FAST, MID]))
+    runtime = FailingModels(backend.bedrock_runtime, {FAST: error})
+    monkeypatch.setattr(backend, "bedrock_runtime", runtime)
+    backend.invoke_bedrock_model(SHORT_PROMPT, budget_seconds=5.0)
+    assert runtime.calls == [FAST, MID]
+    assert backend.model_router.stats()[FAST]["calls"] == 0
+
+
+def test_unsupported_model_is_not_recorded(backend, monkeypatch):
+    monkeypatch.setattr(backend, "model_router", ModelRouter(["unknown.model-v1", MID]))
+    backend.invoke_bedrock_model(SHORT_PROMPT, budget_seconds=5.0)
+    stats = backend.model_router.stats()
+    assert stats["unknown.model-v1"]["calls"] == 0 and stats[MID]["calls"] == 1
+
+
+def test_shed_requests_are_not_recorded(backend, monkeypatch):
+    monkeypatch.setattr(backend, "model_router", ModelRouter([FAST, MID]))
+    monkeypatch.setattr(backend, "bedrock_scheduler", SheddingScheduler())
+    assert backend.invoke_bedrock_model(SHORT_PROMPT) == backend.SERVER_BUSY_MESSAGE
+    with pytest.raises(LoadShedError):
+        backend.open_model_stream(SHORT_PROMPT)
+    assert all(model["calls"] == 0 for model in backend.model_router.stats().values())
+
+
+def test_stream_fails_over_to_the_next_model(backend, monkeypatch):
+    monkeypatch.setattr(backend, "model_router", ModelRouter([FAST, MID]))
+    runtime = FailingModels(backend.bedrock_runtime, {FAST: client_error("ModelTimeoutException", 408)})
+    monkeypatch.setattr(backend, "bedrock_runtime", runtime)
+    model_id, response = backend.open_model_stream(SHORT_PROMPT)
+    assert model_id == MID and response is not None
+    assert backend.model_router.stats()[FAST]["failures"] == 1
@@ -0,0 +1,122 @@
+import pytest
+
+from prewarm import Prewarmer, PrewarmRunning, in_hours, rank_queries
+
+HOUR_MS = 3600 * 1000
+NOW_MS = 1000 * HOUR_MS
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+def group(query, count=2, score=1.0):
+    return {"query": query, "prompt": query.capitalize() + "?", "count": count, "score": score}
+
+
+def test_rank_queries_groups_normalized_prompts():
+    entries = [(NOW_MS - HOUR_MS, "Best ramen in Tokyo?"), (NOW_MS, "best ramen in tokyo"),
+               (NOW_MS - 2 * HOUR_MS, "BEST RAMEN IN TOKYO!"), (NOW_MS, "Museums in Lisbon"), (NOW_MS, "museums in lisbon."),
+               (NOW_MS, "Asked once")]
+    ranked = rank_queries(entries, NOW_MS)
+    assert [(g["query"], g["count"]) for g in ranked] == [("best ramen in tokyo", 3), ("museums in lisbon", 2)]
+    assert ranked[0]["prompt"] == "best ramen in tokyo" # The latest phrasing
+
+
+def test_rank_queries_prefers_recent_questions():
+    half_life_ms = 72 * HOUR_MS
+    entries = [(NOW_MS - 2 * half_life_ms, "old favourite")] * 3 + [(NOW_MS, "new trend")] * 2
+    ranked = rank_queries(entries, NOW_MS, half_life_hours=72)
+    assert [g["query"] for g in ranked] == ["new trend", "old favourite"]
+    assert ranked[0]["score"] == 2.0 and ranked[1]["score"] == 0.75
+
+
+def test_rank_queries_skips_long_and_empty_messages():
+    entries = [(NOW_MS, "x" * 301)] * 3 + [(NOW_MS, "?!")] * 3
+    assert rank_queries(entries, NOW_MS) == []
+
+
+@pytest.mark.parametrize("hours, hour, expected", [
+    ("", 13, True),
+    ("1-6", 1, True), ("1-6", 5, True), ("1-6", 6, False), ("1-6", 0, False),
+    ("22-5", 23, True), ("22-5", 0, True), ("22-5", 4, True), ("22-5", 5, False), ("22-5", 12, False),
+    ("3", 3, True), ("3", 4, False),
+])
+def test_in_hours(hours, hour, expected):
+    assert in_hours(hours, hour) is expected
+
+
+def prewarmer(warm=lambda prompt: True, cached=(), **kwargs):
+    clock = FakeClock()
+    lookups = []
+
+    def is_cached(prompt):
+        lookups.append(prompt)
+        return prompt in cached
+
+    instance = Prewarmer(is_cached, warm, clock=clock, sleep=clock.sleep, **kwargs)
+    return instance, lookups, clock
+
+
+def test_only_top_k_candidates_are_looked_up():
+    ranked = [group(f"question {i}") for i in range(1000)]
+    instance, lookups, _ = prewarmer(cached={"Question 0?"}, rate_per_second=0)
+    report = instance.run(ranked, top_k=10)
+    assert len(lookups) == 10 and report["cache_lookups"] == 10
+    assert report["already_cached"] == 1 and report["warmed"] == 9
+    # Candidates past the top-k count as uncached, so the gain is exact
+    assert report["hit_rate"]["logged"] == {"before": 0.001, "after": 0.01, "gain": 0.009}
+
+
+def test_full_projection_is_opt_in():
+    ranked = [group(f"question {i}") for i in range(50)]
+    instance, lookups, _ = prewarmer(cached={"Question 40?"}, rate_per_second=0, project_all=True)
+    report = instance.run(ranked, top_k=5)
+    assert len(lookups) == 50
+    assert report["hit_rate"]["logged"]["before"] == 0.02 and report["hit_rate"]["logged"]["after"] == 0.12
+
+
+def test_call_budget_stops_the_run():
+    ranked = [group(f"question {i}") for i in range(10)]
+    instance, _, _ = prewarmer(rate_per_second=0, max_calls=3)
+    report = instance.run(ranked, top_k=10)
+    assert report["warmed"] == 3 and report["skipped"] == 7
+    assert report["stopped"] == "call budget exhausted"
+
+
+def test_time_budget_stops_the_run():
+    ranked = [group(f"question {i}") for i in range(10)]
+    instance, _, clock = prewarmer(rate_per_second=1, max_seconds=4.5)
+    report = instance.run(ranked, top_k=10)
+    assert report["warmed"] == 4 and report["stopped"] == "time budget exhausted"
+    assert clock.now <= 4.5 # Paced one call per second
+
+
+def test_repeated_failures_stop_the_run():
+    ranked = [group(f"question {i}") for i in range(10)]
+    results = iter([True, False, True, False, False, False])
+    instance, _, _ = prewarmer(warm=lambda prompt: next(results), rate_per_second=0, max_consecutive_failures=3)
+    report = instance.run(ranked, top_k=10)
+    assert (report["warmed"], report["failed"], report["skipped"]) == (2, 4, 4)
+    assert report["stopped"].startswith("repeated failures")
+    assert [q["status"] for q in report["queries"][:6]] == ["warmed", "failed", "warmed", "failed", "failed", "failed"]
+
+
+def test_concurrent_runs_are_rejected():
+    instance = None
+
+    def warm(prompt):
+        with pytest.raises(PrewarmRunning):
+            instance.run([group("nested")])
+        return True
+
+    instance, _, _ = prewarmer(warm=warm, rate_per_second=0)
+    assert instance.run([group("question")])["warmed"] == 1
+    assert instance.last_report["warmed"] == 1
@@ -0,0 +1,88 @@
+import json
+
+import pytest
+
+from model_adapters import adapter_for, prompt_cache_min_tokens
+from model_router import ModelRouter
+
+CACHING_MODEL = "anthropic.claude-3-7-sonnet-20250219-v1:0"
+NON_CACHING_MODEL = "anthropic.claude-3-sonnet-20240229-v1:0"
+LONG_SYSTEM_PROMPT = "You are Travel Genie, a friendly travel assistant. " * 120 # ~1,500 tokens
+
+
+def system_blocks(body):
+    return json.loads(body)["system"]
+
+
+@pytest.fixture
+def cached_backend(backend, monkeypatch):
+    """The backend routing every direct call to a caching-capable model, with prompt caching enabled."""
+    monkeypatch.setattr(backend, "PROMPT_CACHE_ENABLED", True)
+    monkeypatch.setattr(backend, "SYSTEM_PROMPT", LONG_SYSTEM_PROMPT)
+    monkeypatch.setattr(backend, "prompt_prefixes", {})
+    monkeypatch.setattr(backend, "model_router", ModelRouter([CACHING_MODEL]))
+    return backend
+
+
+def test_allowlist():
+    assert prompt_cache_min_tokens(CACHING_MODEL) == 1024
+    assert prompt_cache_min_tokens("us.anthropic.claude-3-5-haiku-20241022-v1:0") == 2048
+    assert prompt_cache_min_tokens(NON_CACHING_MODEL) is None
+    assert prompt_cache_min_tokens("amazon.titan-text-express-v1") is None
+
+
+def test_build_payload_respects_cache_flag():
+    adapter = adapter_for(CACHING_MODEL)
+    assert "cache_control" not in adapter.build_payload("Hi", system_prompt="Be brief.")["system"][0]
+    assert adapter.build_payload("Hi", system_prompt="Be brief.", cache=True)["system"][0]["cache_control"] == {"type": "ephemeral"}
+
+
+def test_disabled_by_default(backend):
+    assert backend.PROMPT_CACHE_ENABLED is False
+    assert not backend.wants_prompt_cache(CACHING_MODEL)
+
+
+def test_non_allowlisted_model_gets_no_cache_control(cached_backend):
+    body = cached_backend.build_model_payload(NON_CACHING_MODEL, "Where should I stay in Kyoto?")
+    assert all("cache_control" not in block for block in system_blocks(body))
+    assert cached_backend.build_model_payload(CACHING_MODEL, "Where should I stay in Kyoto?") != body
+
+
+def test_allowlisted_model_gets_cache_control(cached_backend):
+    body = cached_backend.build_model_payload(CACHING_MODEL, "Where should I stay in Kyoto?")
+    assert system_blocks(body)[-1]["cache_control"] == {"type": "ephemeral"}
+
+
+def test_short_system_prompt_is_not_cached(cached_backend, monkeypatch):
+    monkeypatch.setattr(cached_backend, "SYSTEM_PROMPT", "Be brief.")
+    body = cached_backend.build_model_payload(CACHING_MODEL, "Where should I stay in Kyoto?")
+    assert all("cache_control" not in block for block in system_blocks(body))
+
+
+def test_fake_rejects_cache_control_for_non_caching_model(backend):
+    body = adapter_for(NON_CACHING_MODEL).encode_body(
+        adapter_for(NON_CACHING_MODEL).prepare_prefix(LONG_SYSTEM_PROMPT, cache=True), "Hi")
+    with pytest.raises(Exception, match="ValidationException"):
+        backend.bedrock_runtime.invoke_model(body=body, modelId=NON_CACHING_MODEL)
+
+
+def test_second_call_reads_from_cache(cached_backend):
+    first, second = {}, {}
+    cached_backend.invoke_bedrock_model("Where should I stay in Kyoto?", usage=first)
+    cached_backend.invoke_bedrock_model("What should I eat in Osaka?", usage=second)
+
+    assert first["model"] == CACHING_MODEL
+    assert first["cache_write_tokens"] > 0 and not first.get("cache_read_tokens")
+    assert second["cache_read_tokens"] == first["cache_write_tokens"]
+    assert not second.get("cache_write_tokens")
+
+
+def test_metrics_expose_cache_counters(cached_backend):
+    cached_backend.invoke_bedrock_model("Where should I stay in Kyoto?")
+    cached_backend.invoke_bedrock_model("What should I eat in Osaka?")
+
+    metrics = cached_backend.app.test_client().get("/api/metrics").get_data(as_text=True)
+    for direction in ("cache_read", "cache_write"):
+        lines = [line for line in metrics.splitlines() if line.startswith("bedrock_tokens_total")
+                 and f'direction="{direction}"' in line and CACHING_MODEL in line]
+        assert lines and float(lines[0].rsplit(" ", 1)[1]) > 0
@@ -0,0 +1,134 @@
+import gzip
+import json
+
+import pytest
+
+import response_format
+from conftest import fast_config
+from fakes import FakeBedrockAgentRuntime
+from response_format import choose_encoding, compact_citations, format_kb_response, truncate_snippet
+
+SHARED = {"text": "Fushimi Inari is open all night.", "location": "s3://kb/kyoto.md"}
+CITATIONS = [
+    {"references": [SHARED, {"text": "Osaka has great street food.", "location": "s3://kb/osaka.md"}]},
+    {"references": [SHARED]},
+    {"references": []},
+]
+
+
+@pytest.fixture
+def kb_backend(backend, monkeypatch):
+    """backend/app.py answering /api/ask-kb from a fake Knowledge Base with large citations."""
+    from answer_cache import AnswerCache, LRUCache
+    monkeypatch.setattr(backend, "bedrock_agent_runtime", FakeBedrockAgentRuntime(fast_config(citations=4, reference_chars=1500)))
+    monkeypatch.setattr(backend, "retrieval_source", None)
+    monkeypatch.setattr(backend, "answer_cache", AnswerCache(LRUCache(64)))
+    return backend
+
+
+def ask_kb(backend, accept_encoding=None, **fields):
+    headers = {"Accept-Encoding": accept_encoding} if accept_encoding else {}
+    return backend.app.test_client().post("/api/ask-kb", json={"message": "Kyoto temples?", **fields}, headers=headers)
+
+
+def test_truncate_snippet_cuts_at_a_word_boundary():
+    assert truncate_snippet("short", 10) == "short"
+    assert truncate_snippet("one two three four", 0) == "one two three four"
+    assert truncate_snippet("one two three four", 10) == "one two ..."
+    assert truncate_snippet("x" * 30, 10) == "x" * 10 + " ..." # No space in reach: hard cut
+    assert truncate_snippet(None, 10) is None
+
+
+def test_compact_citations_store_each_reference_once():
+    compact = compact_citations(CITATIONS)
+    assert compact["references"] == [SHARED, {"text": "Osaka has great street food.", "location": "s3://kb/osaka.md"}]
+    assert compact["citations"] == [{"refs": [0, 1]}, {"refs": [0]}] # Citations without references are dropped
+    assert len(json.dumps(compact)) < len(json.dumps(CITATIONS))
+
+
+def test_format_kb_response_in_both_formats():
+    response = {"reply": "Go early.", "citations": CITATIONS}
+    compact = format_kb_response(response, "compact", snippet_chars=10)
+    assert compact["reply"] == "Go early." and compact["citations"] == [{"refs": [0, 1]}, {"refs": [0]}]
+    assert compact["references"][0]["text"] == "Fushimi ..."
+    assert format_kb_response(response, "full") is response
+    full = format_kb_response(response, "full", snippet_chars=10)
+    assert full["citations"][1]["references"][0]["text"] == "Fushimi ..." and "references" not in full
+
+
+def test_choose_encoding_with_brotli(monkeypatch):
+    monkeypatch.setattr(response_format, "ENCODING_PREFERENCE", ("br", "gzip"))
+    assert choose_encoding("gzip, deflate, br") == "br"
+    assert choose_encoding("br;q=0, gzip;q=0.5") == "gzip"
+    assert choose_encoding("*") == "br"
+    assert choose_encoding("identity") is None
+    assert choose_encoding(None) is None
+
+
+def test_choose_encoding_without_brotli(monkeypatch):
+    monkeypatch.setattr(response_format, "ENCODING_PREFERENCE", ("gzip",))
+    assert choose_encoding("gzip, deflate, br") == "gzip"
+    assert choose_encoding("br") is None
+    assert choose_encoding("*, gzip;q=0") is None
+
+
+def test_large_responses_are_compressed(kb_backend):
+    response = ask_kb(kb_backend, accept_encoding="gzip")
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in response.headers["Vary"]
+    body = gzip.decompress(response.data)
+    assert int(response.headers["X-Payload-Bytes"]) == len(body) > len(response.data)
+    assert json.loads(body)["reply"]
+
+
+def test_brotli_is_preferred_when_installed(kb_backend):
+    if response_format.brotli is None:
+        pytest.skip("brotli is not installed")
+    response = ask_kb(kb_backend, accept_encoding="gzip, br")
+    assert response.headers["Content-Encoding"] == "br"
+    assert int(response.headers["X-Payload-Bytes"]) == len(response_format.brotli.decompress(response.data))
+
+
+def test_small_or_unaccepted_responses_are_not_compressed(kb_backend, monkeypatch):
+    response = ask_kb(kb_backend)
+    assert "Content-Encoding" not in response.headers
+    assert int(response.headers["X-Payload-Bytes"]) == len(response.data)
+
+    monkeypatch.setattr(kb_backend, "COMPRESSION_MIN_BYTES", 10 ** 6)
+    response = ask_kb(kb_backend, accept_encoding="gzip")
+    assert "Content-Encoding" not in response.headers and "Vary" not in response.headers
+    assert int(response.headers["X-Payload-Bytes"]) == len(response.data)
+
+
+def test_streamed_responses_are_not_compressed(backend):
+    response = backend.app.test_client().post("/api/chat/stream", json={"message": "Hi"},
+                                              headers={"Accept-Encoding": "gzip"})
+    assert response.mimetype == "text/event-stream"
+    assert "Content-Encoding" not in response.headers and "X-Payload-Bytes" not in response.headers
+    assert b"event: done" in response.data
+
+
+def test_compact_and_full_citations_on_the_wire(kb_backend):
+    compact = ask_kb(kb_backend, citation_format="compact", snippet_chars=100).get_json()
+    assert all(len(ref["text"]) <= 104 for ref in compact["references"])
+    assert all(ref < len(compact["references"]) for citation in compact["citations"] for ref in citation["refs"])
+    full = ask_kb(kb_backend, citation_format="full", snippet_chars=0).get_json()
+    assert "references" not in full and all("references" in citation for citation in full["citations"])
+
+
+def exposed_headers(response):
+    return {name.strip().lower() for name in response.headers["Access-Control-Expose-Headers"].split(",")}
+
+
+def test_cors_exposes_the_custom_headers(kb_backend):
+    response = kb_backend.app.test_client().post("/api/ask-kb", json={"message": "Kyoto temples?"},
+                                                 headers={"Origin": "https://app.example.com"})
+    assert {"x-payload-bytes", "x-cache"} <= exposed_headers(response)
+    assert response.headers["X-Cache"] == "MISS"
+
+
+def test_asgi_cors_exposes_the_custom_headers(backend):
+    from starlette.testclient import TestClient
+    import asgi
+    response = TestClient(asgi.app).get("/api/health", headers={"Origin": "https://app.example.com"})
+    assert {"x-payload-bytes", "x-cache"} <= exposed_headers(response)
@@ -0,0 +1,118 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+from retrieval import RetrievalCache, dedupe_passages, fit_passages, passages_size, retrieval_cache_key
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def passage(text, location="s3://kb/doc"):
+    return {"text": text, "location": location, "score": 0.5}
+
+
+def test_cache_key_normalizes_the_query():
+    assert retrieval_cache_key("Best ramen in Tokyo?", "kb:1", 5) == retrieval_cache_key("  best RAMEN in tokyo? ", "kb:1", 5)
+    assert retrieval_cache_key("Best ramen in Tokyo?", "kb:1", 5) != retrieval_cache_key("Best ramen in Tokyo?", "kb:1", 10)
+    assert retrieval_cache_key("Best ramen in Tokyo?", "kb:1", 5) != retrieval_cache_key("Best ramen in Tokyo?", "kb:2", 5)
+
+
+def test_cache_entries_expire():
+    clock = FakeClock()
+    cache = RetrievalCache(ttl_seconds=10, clock=clock)
+    cache.put("q", [passage("Kyoto temples")])
+    assert cache.get("q") == [passage("Kyoto temples")]
+    clock.now += 10
+    assert cache.get("q") is None
+    stats = cache.stats()
+    assert stats["hits"] == 1 and stats["misses"] == 1 and stats["expirations"] == 1
+    assert stats["entries"] == 0 and stats["bytes"] == 0
+
+
+def test_cache_evicts_least_recently_used_by_bytes():
+    entry = [passage("x" * 100)]
+    cache = RetrievalCache(max_bytes=passages_size(entry) * 2)
+    cache.put("a", entry)
+    cache.put("b", entry)
+    cache.get("a") # "b" is now the least recently used
+    cache.put("c", entry)
+    assert cache.get("b") is None and cache.get("a") and cache.get("c")
+    assert cache.stats()["evictions"] == 1 and cache.bytes <= cache.max_bytes
+    # An entry larger than the whole cache is not stored, and evicts nothing
+    cache.put("huge", [passage("x" * 1000)])
+    assert cache.get("huge") is None and cache.stats()["entries"] == 2
+
+
+def test_dedupe_keeps_the_first_of_near_duplicates():
+    kyoto = "Fushimi Inari shrine in Kyoto is best visited early in the morning before the crowds arrive."
+    passages = [passage(kyoto, "s3://kb/1"), passage(kyoto + " Bring water.", "s3://kb/2"),
+                passage("Osaka street food is best in Dotonbori in the evening.", "s3://kb/3"), passage("")]
+    kept = dedupe_passages(passages, threshold=0.8)
+    assert [p["location"] for p in kept] == ["s3://kb/1", "s3://kb/3"]
+    assert len(dedupe_passages(passages, threshold=1.01)) == 3 # Only empty passages are dropped
+
+
+def test_fit_passages_cuts_at_a_word_boundary():
+    passages = [passage("a" * 300), passage("word " * 100), passage("never reached")]
+    fitted = fit_passages(passages, max_chars=550, min_chars=200)
+    assert len(fitted) == 2 and fitted[0]["text"] == "a" * 300
+    assert fitted[1]["text"].endswith(" ...") and len(fitted[1]["text"]) <= 250 + len(" ...")
+    assert not fitted[1]["text"][:-4].endswith(" ")
+    # Too little budget left for a useful part of the next passage: it is dropped instead
+    assert len(fit_passages(passages, max_chars=400, min_chars=200)) == 1
+
+
+def test_retrieve_then_generate_caches_the_search(split_backend):
+    first = split_backend.retrieve_then_generate("Where should I eat in Osaka?")
+    second = split_backend.retrieve_then_generate("where should I eat in osaka?")
+    assert "error" not in first and first["reply"] and first["citations"]
+    assert second["citations"] == first["citations"]
+    assert split_backend.bedrock_agent_runtime.stats.calls == {"Retrieve": 1}
+    assert split_backend.retrieval_cache.stats()["hits"] == 1
+
+
+def test_retrieve_then_generate_reports_retrieval_errors(split_backend, monkeypatch):
+    def fail(**kwargs):
+        raise ClientError({"Error": {"Code": "ResourceNotFoundException", "Message": "No such KB"}}, "Retrieve")
+    monkeypatch.setattr(split_backend.bedrock_agent_runtime, "retrieve", fail)
+    assert "error" in split_backend.retrieve_then_generate("Where should I eat in Osaka?")
+
+
+def test_prefetch_warms_the_retrieval_cache(split_backend, monkeypatch):
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(split_backend, "retrieval_executor", executor)
+    client = split_backend.app.test_client()
+    response = client.post("/api/retrieve", json={"message": "Lisbon trams", "prefetch": True})
+    assert response.status_code == 202
+    executor.shutdown(wait=True)
+
+    response = client.post("/api/retrieve", json={"message": "Lisbon trams"})
+    assert response.status_code == 200 and response.headers["X-Retrieval-Cache"] == "HIT"
+    assert response.get_json()["passages"]
+    assert split_backend.bedrock_agent_runtime.stats.calls == {"Retrieve": 1}
+
+
+def test_failed_prefetch_is_logged(split_backend, monkeypatch, caplog):
+    def fail(**kwargs):
+        raise ClientError({"Error": {"Code": "ThrottlingException", "Message": "Slow down"}}, "Retrieve")
+    monkeypatch.setattr(split_backend.bedrock_agent_runtime, "retrieve", fail)
+    monkeypatch.setattr(split_backend.bedrock_scheduler, "max_attempts", 1)
+    executor = ThreadPoolExecutor(max_workers=1)
+    monkeypatch.setattr(split_backend, "retrieval_executor", executor)
+    response = split_backend.app.test_client().post("/api/retrieve", json={"message": "Lisbon trams", "prefetch": True})
+    assert response.status_code == 202
+    executor.shutdown(wait=True)
+    assert "Retrieval prefetch failed" in caplog.text
+    assert 'operation="RetrievePrefetch",code="ThrottlingException"' in split_backend.metrics.render()
+
+
+def test_batch_kb_items_share_the_ask_kb_cache_entry(split_backend):
+    split_backend.handle_kb_message("Best time to visit Kyoto?")
+    result = split_backend.run_batch_item(0, "Best time to visit Kyoto?", "kb", bypass_cache=False)
+    assert result["ok"] and result["cache"] == "HIT-LOCAL"
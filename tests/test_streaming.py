@@ -0,0 +1,87 @@
+import json
+
+from botocore.exceptions import ClientError
+
+ANTHROPIC = "anthropic.claude-3-sonnet-20240229-v1:0"
+TITAN = "amazon.titan-text-express-v1"
+
+
+def parse_sse(body):
+    """Returns [(event, data), ...] from a text/event-stream body."""
+    frames = []
+    for frame in body.strip().split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in frame.splitlines())
+        frames.append((fields["event"], json.loads(fields["data"])))
+    return frames
+
+
+def chunk(payload):
+    return {"chunk": {"bytes": json.dumps(payload).encode("utf-8")}}
+
+
+def test_parse_anthropic_chunks(backend):
+    assert backend.parse_stream_chunk(ANTHROPIC, {"type": "content_block_delta",
+                                                  "delta": {"type": "text_delta", "text": "Kyo"}})[0] == "Kyo"
+    text, usage = backend.parse_stream_chunk(ANTHROPIC, {"type": "message_delta", "delta": {"stop_reason": "end_turn"},
+                                                         "usage": {"output_tokens": 12}})
+    assert text == "" and usage["output_tokens"] == 12
+    text, usage = backend.parse_stream_chunk(ANTHROPIC, {"type": "message_stop", "amazon-bedrock-invocationMetrics": {
+        "inputTokenCount": 40, "outputTokenCount": 12, "cacheReadInputTokenCount": 30, "invocationLatency": 900,
+        "firstByteLatency": 200}})
+    assert text == ""
+    assert usage == {"input_tokens": 40, "output_tokens": 12, "cache_read_tokens": 30, "bedrock_latency_ms": 900,
+                     "bedrock_first_byte_latency_ms": 200}
+
+
+def test_parse_titan_chunks(backend):
+    text, usage = backend.parse_stream_chunk(TITAN, {"outputText": "Lisbon", "index": 0, "completionReason": "FINISH",
+                                                     "amazon-bedrock-invocationMetrics": {"inputTokenCount": 5,
+                                                                                          "outputTokenCount": 2}})
+    assert text == "Lisbon" and usage["input_tokens"] == 5 and usage["output_tokens"] == 2
+
+
+def test_stream_ends_with_done(backend):
+    response = backend.app.test_client().post("/api/chat/stream", json={"message": "Two days in Lisbon?"})
+    assert response.mimetype == "text/event-stream"
+    frames = parse_sse(response.get_data(as_text=True))
+
+    events = [event for event, _ in frames]
+    assert events[-1] == "done" and events.count("done") == 1
+    assert set(events[:-1]) == {"delta"}
+    reply = "".join(data["text"] for event, data in frames if event == "delta")
+    assert reply.startswith("Here is some travel advice about 'Two days in Lisbon?'")
+
+    done = frames[-1][1]
+    assert done["model"] == ANTHROPIC
+    assert done["usage"]["output_tokens"] > 0 and done["timing"]["total_ms"] >= done["timing"]["time_to_first_token_ms"]
+    # The completed reply becomes the session's latest turn
+    assert backend.conversations.get_or_create(done["session_id"]).turns[-1] == ("Two days in Lisbon?", reply)
+
+
+def test_error_mid_stream(backend, monkeypatch):
+    def broken_stream():
+        yield chunk({"type": "message_start", "message": {"usage": {"input_tokens": 10}}})
+        yield chunk({"type": "content_block_delta", "delta": {"type": "text_delta", "text": "Start in "}})
+        raise ClientError({"Error": {"Code": "ModelStreamErrorException", "Message": "Stream failed"}},
+                          "InvokeModelWithResponseStream")
+
+    monkeypatch.setattr(backend.bedrock_runtime, "invoke_model_with_response_stream",
+                        lambda **kwargs: {"body": broken_stream()})
+    response = backend.app.test_client().post("/api/chat/stream", json={"message": "Two days in Lisbon?",
+                                                                        "session_id": "stream-error"})
+    frames = parse_sse(response.get_data(as_text=True))
+
+    assert frames == [("delta", {"text": "Start in "}),
+                      ("error", {"error": "Sorry, there was an AWS error: ModelStreamErrorException"})]
+    assert backend.conversations.get_or_create("stream-error").turns == [] # A partial reply is not kept
+
+
+def test_throttled_stream_reports_busy(backend, monkeypatch):
+    def throttled(**kwargs):
+        raise ClientError({"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}},
+                          "InvokeModelWithResponseStream")
+
+    monkeypatch.setattr(backend.bedrock_runtime, "invoke_model_with_response_stream", throttled)
+    monkeypatch.setattr(backend.bedrock_scheduler, "call", lambda fn, **kwargs: fn())
+    frames = parse_sse(backend.app.test_client().post("/api/chat/stream", json={"message": "Hi"}).get_data(as_text=True))
+    assert frames == [("error", {"error": backend.SERVER_BUSY_MESSAGE})]